@@ -1,2 +1,11 @@
 from .utils import *
 from .zap import *
+from .cache import *
+from .sweep import *
+from .svd import *
+from .skymodel import *
+from .server import *
+from .planner import *
+from .storage import *
+from .stream import *
+from .workqueue import *
@@ -1,13 +1,362 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
 import logging
+import multiprocessing
+import os
+import signal
 import sys
+import threading
 
-from zap.zap import process, CFTYPE_OPTIONS, __version__
+from zap.cache import StageCache
+from zap.planner import plan
+from zap.server import serve, DEFAULT_PORT
+from zap.storage import convert_cube, CHUNK_LAYOUTS
+from zap.stream import process_stream
+from zap.svd import GramPCA
+from zap.sweep import sweep
+from zap.workqueue import WorkQueue, run_worker
+from zap.zap import (process, Cancelled, ExecutionContext, CFTYPE_OPTIONS,
+                     OPTIMIZE_OPTIONS, __version__)
 
 
-def main():
+def _run(func, debug, *args, **kwargs):
+    """Run a command, exiting with an error message on failure."""
+    try:
+        return func(*args, **kwargs)
+    except KeyboardInterrupt:
+        sys.exit('Interrupted!')
+    except Cancelled as e:
+        sys.exit('Cancelled: %s' % e)
+    except Exception as e:
+        if debug:
+            import traceback
+            traceback.print_exc()
+        sys.exit('Failed to process file: %s' % e)
+
+
+def _progress_callback(mode):
+    """Return a function printing the progress events, either as a progress
+    bar on stderr or as JSON lines on stdout."""
+    if mode is None:
+        return None
+
+    def print_json(event):
+        print(json.dumps(event._asdict()), flush=True)
+
+    def print_bar(event, width=30):
+        n = int(round(width * event.fraction))
+        eta = '' if event.eta is None else ' ETA %4.0fs' % event.eta
+        sys.stderr.write('\r%-12s [%s%s] %3.0f%%%s' % (
+            event.stage, '#' * n, '.' * (width - n), 100 * event.fraction,
+            eta.ljust(10)))
+        if event.fraction >= 1:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+
+    return print_json if mode == 'json' else print_bar
+
+
+def _cancel_event():
+    """Return an event which is set on SIGTERM, to stop cleanly."""
+    cancel = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: cancel.set())
+    return cancel
+
+
+def _parse_nevals(value):
+    if value is None:
+        return []
+    return [int(x) for x in value.split(',')]
+
+
+def _parse_roi(value):
+    if value is None or os.path.exists(value):
+        return value
+    try:
+        return tuple(slice(*[int(v) if v else None for v in part.split(':')])
+                     for part in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid ROI: {}'.format(value))
+
+
+def main_sweep(argv):
+    parser = argparse.ArgumentParser(
+        prog='zap sweep',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Run ZAP with several combinations of parameters, '
+        'sharing the preparation steps.'
+    )
+    addarg = parser.add_argument
+    addarg('incube', help='Input datacube path')
+    addarg('--debug', '-d', action='store_true',
+           help='show debug info')
+    addarg('--overwrite', action='store_true',
+           help='overwrite output files if they already exists')
+    addarg('--no-clean', action='store_true',
+           help='disable NaN values interpolation')
+    addarg('--ncpu', type=int, default=None,
+           help='maximum number of cpus to use, all by default')
+    addarg('--nthreads', type=int, default=None,
+           help='maximum number of threads used by the linear algebra '
+           'libraries, not limited by default')
+    addarg('--njobs', type=int, default=None,
+           help='number of variants processed in parallel')
+    addarg('--mask', help='mask file to exclude sources')
+    addarg('--zlevel', default='median',
+           help='method for the zeroth order sky removal: none, sigclip or '
+           'median')
+    addarg('--cftype', default='median',
+           help='comma-separated list of methods for the continuum filter: '
+           '{}'.format(', '.join(CFTYPE_OPTIONS)))
+    addarg('--cfwidth', default='300',
+           help='comma-separated list of window sizes for the continuum '
+           'filter')
+    addarg('--cfwidthSVD', type=int, default=None,
+           help='window size for the continuum filter for the SVD '
+           'computation, same as --cfwidth by default')
+    addarg('--nevals', default='auto',
+           help='semicolon-separated list of number of eigenspectra, each '
+           'one being "auto" or a comma-separated list of values per segment')
+    addarg('--outcube', help='pattern for the output datacubes, which can '
+           'contain {cftype}, {cfwidth} and {nevals}')
+    addarg('--summary', help='output file for the summary table')
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    nevals = [None if nev == 'auto' else _parse_nevals(nev)
+              for nev in args.nevals.split(';')]
+    table = _run(
+        sweep, args.debug, args.incube, cftypes=args.cftype.split(','),
+        cfwidths=[int(x) for x in args.cfwidth.split(',')], nevals=nevals,
+        cfwidthSVD=args.cfwidthSVD, clean=not args.no_clean, mask=args.mask,
+        zlevel=args.zlevel, njobs=args.njobs,
+        context=ExecutionContext(ncpu=args.ncpu, nthreads=args.nthreads),
+        outcubefits=args.outcube, overwrite=args.overwrite)
+    table.pprint(max_lines=-1, max_width=-1)
+    if args.summary is not None:
+        table.write(args.summary, overwrite=args.overwrite)
+
+
+def main_serve(argv):
+    parser = argparse.ArgumentParser(
+        prog='zap serve',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Run a ZAP service on a local HTTP port, keeping the '
+        'workers and the SVD bases in memory.'
+    )
+    addarg = parser.add_argument
+    addarg('--debug', '-d', action='store_true',
+           help='show debug info')
+    addarg('--host', default='127.0.0.1', help='address to listen on')
+    addarg('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    addarg('--njobs', type=int, default=1,
+           help='number of jobs run concurrently')
+    addarg('--ncpu', type=int, default=None,
+           help='maximum number of cpus used by each job, all by default')
+    addarg('--nthreads', type=int, default=None,
+           help='maximum number of threads used by the linear algebra '
+           'libraries, not limited by default')
+    addarg('--maxmem', type=float, default=None,
+           help='memory budget for the running jobs in GB, half of the '
+           'physical memory by default')
+    addarg('--nbases', type=int, default=4,
+           help='number of SVD bases kept in memory')
+    addarg('--cache', help='directory for the cache of intermediate results')
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    maxmem = None if args.maxmem is None else int(args.maxmem * 1024**3)
+    cache = None if args.cache is None else StageCache(args.cache)
+    _run(serve, args.debug, host=args.host, port=args.port,
+         njobs=args.njobs, maxmem=maxmem,
+         context=ExecutionContext(ncpu=args.ncpu, nthreads=args.nthreads),
+         nbases=args.nbases, cache=cache)
+
+
+def main_queue(argv):
+    parser = argparse.ArgumentParser(
+        prog='zap queue',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Add jobs to a work queue on a shared filesystem, '
+        'processed by "zap worker". The cubes whose job is already done or '
+        'queued are skipped.'
+    )
+    addarg = parser.add_argument
+    addarg('queue', help='directory of the queue')
+    addarg('incube', nargs='*', help='input datacube paths')
+    addarg('--debug', '-d', action='store_true',
+           help='show debug info')
+    addarg('--status', action='store_true',
+           help='print the number of jobs in each state, and the errors of '
+           'the failed jobs')
+    addarg('--no-clean', action='store_true',
+           help='disable NaN values interpolation')
+    addarg('--mask', help='mask file to exclude sources')
+    addarg('--outcube', '-o', default='{name}_ZAP.fits',
+           help='pattern for the output datacubes, which can contain {name} '
+           '(the input file name without extension)')
+    addarg('--skycube', help='pattern for the output sky datacubes')
+    addarg('--zlevel', default='median',
+           help='method for the zeroth order sky removal: none, sigclip or '
+           'median')
+    addarg('--cftype', default='median',
+           help='method for the continuum filter: {}'
+           .format(', '.join(CFTYPE_OPTIONS)))
+    addarg('--cfwidthSVD', type=int, default=300,
+           help='window size for the median continuum filter, '
+           'for the SVD computation')
+    addarg('--cfwidthSP', type=int, default=300,
+           help='window size for the median continuum filter')
+    addarg('--nevals', help='number of eigenspectra used for each segment')
+    addarg('--optimize', choices=OPTIMIZE_OPTIONS, default='full',
+           help='method to find the number of eigenspectra')
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    queue = WorkQueue(args.queue)
+    for cubefits in args.incube:
+        jobid = _run(queue.add, args.debug, cubefits,
+                     outcubefits=args.outcube, skycubefits=args.skycube,
+                     clean=not args.no_clean, mask=args.mask,
+                     zlevel=args.zlevel, cftype=args.cftype,
+                     cfwidthSVD=args.cfwidthSVD, cfwidthSP=args.cfwidthSP,
+                     nevals=_parse_nevals(args.nevals),
+                     optimize=args.optimize)
+        if jobid is not None:
+            print('queued', jobid)
+    if args.status:
+        print(json.dumps(queue.status()))
+        for job in queue.results('failed'):
+            print('failed', job['id'], job['error'])
+
+
+def _worker_process(path, **kwargs):
+    run_worker(path, cancel=_cancel_event(), **kwargs)
+
+
+def main_worker(argv):
+    parser = argparse.ArgumentParser(
+        prog='zap worker',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Process the jobs of a work queue on a shared '
+        'filesystem. Several workers can run on the same queue, from one or '
+        'several nodes, and the jobs of killed workers are requeued.'
+    )
+    addarg = parser.add_argument
+    addarg('queue', help='directory of the queue')
+    addarg('--debug', '-d', action='store_true',
+           help='show debug info')
+    addarg('--njobs', type=int, default=1,
+           help='number of worker processes started on this node')
+    addarg('--wait', action='store_true',
+           help='wait for new jobs when the queue is empty')
+    addarg('--poll', type=float, default=10,
+           help='interval in seconds between the checks of the queue with '
+           '--wait')
+    addarg('--max-jobs', type=int, default=None,
+           help='maximum number of jobs processed by each worker')
+    addarg('--timeout', type=float, default=600,
+           help='time in seconds after which a running job that is not '
+           'updated is requeued')
+    addarg('--max-attempts', type=int, default=3,
+           help='number of attempts before a job is marked as failed')
+    addarg('--ncpu', type=int, default=None,
+           help='maximum number of cpus used by each job, all by default')
+    addarg('--nthreads', type=int, default=None,
+           help='maximum number of threads used by the linear algebra '
+           'libraries, not limited by default')
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    kwargs = dict(wait=args.wait, poll=args.poll, max_jobs=args.max_jobs,
+                  timeout=args.timeout, max_attempts=args.max_attempts,
+                  context=ExecutionContext(ncpu=args.ncpu,
+                                           nthreads=args.nthreads))
+    if args.njobs == 1:
+        _run(_worker_process, args.debug, args.queue, **kwargs)
+        return
+
+    workers = [multiprocessing.Process(target=_worker_process,
+                                       args=(args.queue, ), kwargs=kwargs)
+               for _ in range(args.njobs)]
+    for p in workers:
+        p.start()
+    try:
+        for p in workers:
+            p.join()
+    except KeyboardInterrupt:
+        sys.exit('Interrupted!')
+    finally:
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+
+
+def _parse_chunks(value):
+    if value in CHUNK_LAYOUTS:
+        return value
+    try:
+        return tuple(int(x) for x in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid chunks: {}'.format(value))
+
+
+def main_convert(argv):
+    parser = argparse.ArgumentParser(
+        prog='zap convert',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Convert a FITS cube to a chunked HDF5 (.h5, .hdf5) or '
+        'Zarr (.zarr) file, which can be used as input of ZAP.'
+    )
+    addarg = parser.add_argument
+    addarg('incube', help='input datacube path')
+    addarg('outcube', help='output HDF5 or Zarr path')
+    addarg('--debug', '-d', action='store_true',
+           help='show debug info')
+    addarg('--overwrite', action='store_true',
+           help='overwrite the output file if it already exists')
+    addarg('--chunks', type=_parse_chunks, default='bricks',
+           help='chunk layout: {} or the chunk shape "nz,ny,nx"'.format(
+               ', '.join(CHUNK_LAYOUTS)))
+    addarg('--no-compress', action='store_true',
+           help='store the chunks uncompressed')
+    addarg('--nthreads', type=int, default=1,
+           help='number of threads converting the chunks')
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    _run(convert_cube, args.debug, args.incube, args.outcube,
+         chunks=args.chunks, compress=not args.no_compress,
+         nthreads=args.nthreads, overwrite=args.overwrite)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['sweep']:
+        return main_sweep(argv[1:])
+    if argv[:1] == ['serve']:
+        return main_serve(argv[1:])
+    if argv[:1] == ['queue']:
+        return main_queue(argv[1:])
+    if argv[:1] == ['worker']:
+        return main_worker(argv[1:])
+    if argv[:1] == ['convert']:
+        return main_convert(argv[1:])
+
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description='ZAP (the Zurich Atmosphere Purge) is a high precision '
@@ -25,10 +374,23 @@ def main():
            help='disable NaN values interpolation')
     addarg('--ncpu', type=int, default=None,
            help='maximum number of cpus to use, all by default')
+    addarg('--nthreads', type=int, default=None,
+           help='maximum number of threads used by the linear algebra '
+           'libraries, not limited by default')
     addarg('--mask', help='mask file to exclude sources')
     addarg('--outcube', '-o', default='DATACUBE_FINAL_ZAP.fits',
            help='output datacube path')
     addarg('--skycube', help='output sky datacube path')
+    addarg('--skymodel', help='output low-rank sky model path')
+    addarg('--compress', help='write the output cubes tile-compressed: '
+           'lossless, quantized, or a compression type (RICE_1, GZIP_1, '
+           'GZIP_2, HCOMPRESS_1)')
+    addarg('--mask-edges', type=float, nargs='?', const=50, default=None,
+           help='mask the edges of the cube, with the given percentage of '
+           'NaN values (50 if not given)')
+    addarg('--roi', type=_parse_roi,
+           help='region of interest to process, either "y0:y1,x0:x1" or a '
+           'mask file (>=1 for the spaxels to process)')
     addarg('--varcurve', help='output variance curves')
     addarg('--zlevel', default='median',
            help='method for the zeroth order sky removal: none, sigclip or '
@@ -42,30 +404,107 @@ def main():
     addarg('--cfwidthSP', type=int, default=300,
            help='window size for the median continuum filter')
     addarg('--nevals', help='number of eigenspectra used for each segment')
-    args = parser.parse_args()
+    addarg('--svd', choices=('pca', 'gram'),
+           help='SVD engine: scikit-learn PCA, or PCA computed from the '
+           'covariance matrix accumulated by blocks, which uses less memory. '
+           'Chosen to fit in --memory-limit if given, pca otherwise')
+    addarg('--optimize', choices=OPTIMIZE_OPTIONS,
+           help='method to find the number of eigenspectra, when --nevals is '
+           'not given: incremental is faster but computes only the needed '
+           'eigenvectors. Chosen to fit in --memory-limit if given, full '
+           'otherwise')
+    addarg('--cache', help='directory used to cache the intermediate '
+           'results, to speed up successive runs on the same cube')
+    addarg('--cache-size', type=float, default=None,
+           help='maximum size of the cache in GB, unlimited by default')
+    addarg('--progress', choices=('bar', 'json'),
+           help='report the progress, with a progress bar or with JSON lines '
+           '(stage, fraction, elapsed, eta)')
+    addarg('--memory-limit', type=float, default=None,
+           help='memory limit in GB: the SVD engine and the optimization '
+           'method are chosen to fit in this limit')
+    addarg('--dry-run', action='store_true',
+           help='print the execution plan, with the estimated memory and '
+           'runtime of each stage, without processing the cube')
+    addarg('--skyseg', help='limits of the SVD segments in Angstroms, '
+           'comma-separated, one segment by default')
+    addarg('--stream', action='store_true',
+           help='process the cube one wavelength chunk (SVD segment) at a '
+           'time, which uses much less memory. Only the median and none '
+           'continuum filters are supported')
+    args = parser.parse_args(argv)
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    if args.nevals is not None:
-        nevals = [int(x) for x in args.nevals.split(',')]
-    else:
-        nevals = []
+    nevals = _parse_nevals(args.nevals)
+    skyseg = None
+    if args.skyseg is not None:
+        skyseg = [float(x) for x in args.skyseg.split(',')]
 
-    try:
-        process(
-            args.incube, outcubefits=args.outcube, clean=not args.no_clean,
-            skycubefits=args.skycube, mask=args.mask, zlevel=args.zlevel,
+    if args.stream:
+        for opt in ('roi', 'skymodel', 'varcurve', 'mask_edges', 'cache',
+                    'compress', 'memory_limit'):
+            if getattr(args, opt) is not None:
+                parser.error('--{} cannot be used with --stream'.format(
+                    opt.replace('_', '-')))
+        if args.dry_run:
+            parser.error('--dry-run cannot be used with --stream')
+        _run(process_stream, args.debug, args.incube,
+             outcubefits=args.outcube, clean=not args.no_clean,
+             skycubefits=args.skycube, mask=args.mask, zlevel=args.zlevel,
+             cftype=args.cftype, cfwidthSVD=args.cfwidthSVD,
+             cfwidthSP=args.cfwidthSP, nevals=nevals, skyseg=skyseg,
+             pca_class=GramPCA if args.svd == 'gram' else None,
+             optimize=args.optimize or 'full', overwrite=args.overwrite,
+             context=ExecutionContext(ncpu=args.ncpu, nthreads=args.nthreads),
+             progress=_progress_callback(args.progress),
+             cancel=_cancel_event())
+        return
+
+    settings = dict(
+        pca_class=GramPCA if args.svd == 'gram' else None,
+        optimize=args.optimize or 'full',
+        context=ExecutionContext(ncpu=args.ncpu, nthreads=args.nthreads))
+    if args.dry_run or args.memory_limit is not None:
+        maxmem = None
+        if args.memory_limit is not None:
+            maxmem = int(args.memory_limit * 1024**3)
+        optimize = args.optimize or ('full' if nevals else None)
+        runplan = _run(
+            plan, args.debug, args.incube, maxmem=maxmem, ncpu=args.ncpu,
+            nthreads=args.nthreads, clean=not args.no_clean,
+            zlevel=args.zlevel, cftype=args.cftype,
             cfwidthSVD=args.cfwidthSVD, cfwidthSP=args.cfwidthSP,
-            cftype=args.cftype, overwrite=args.overwrite, ncpu=args.ncpu,
-            varcurvefits=args.varcurve, nevals=nevals)
-    except KeyboardInterrupt:
-        sys.exit('Interrupted!')
-    except Exception as e:
-        if args.debug:
-            import traceback
-            traceback.print_exc()
-        sys.exit('Failed to process file: %s' % e)
+            mask=args.mask, svd=args.svd, optimize=optimize,
+            skycube=args.skycube is not None, compress=args.compress,
+            skyseg=skyseg)
+        if args.dry_run:
+            print(runplan)
+            return
+        if not runplan.within_limit:
+            sys.exit('Failed to process file: the estimated peak memory '
+                     '({:.0f} MB) exceeds the limit ({:.0f} MB)'.format(
+                         runplan.peak / 1024**2, maxmem / 1024**2))
+        settings = runplan.process_kwargs()
+
+    cache = None
+    if args.cache is not None:
+        maxsize = None
+        if args.cache_size is not None:
+            maxsize = int(args.cache_size * 1024**3)
+        cache = StageCache(args.cache, maxsize=maxsize)
+
+    _run(process, args.debug, args.incube, outcubefits=args.outcube,
+         clean=not args.no_clean, skycubefits=args.skycube, mask=args.mask,
+         skymodelfits=args.skymodel, roi=args.roi,
+         maskedges=args.mask_edges,
+         zlevel=args.zlevel, cfwidthSVD=args.cfwidthSVD,
+         cfwidthSP=args.cfwidthSP, cftype=args.cftype,
+         overwrite=args.overwrite, varcurvefits=args.varcurve, nevals=nevals,
+         cache=cache, progress=_progress_callback(args.progress),
+         cancel=_cancel_event(), compress=args.compress, skyseg=skyseg,
+         **settings)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from time import time
+
+__all__ = ['StageCache']
+
+logger = logging.getLogger(__name__)
+
+
+def file_checksum(filename, blocksize=2**22):
+    """Compute the SHA1 checksum of a file, reading it by blocks."""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def array_checksum(arr):
+    """Compute the SHA1 checksum of the content of an array."""
+    return hashlib.sha1(np.ascontiguousarray(arr).view(np.uint8)).hexdigest()
+
+
+class StageCache(object):
+
+    """Content-addressed on-disk cache of the intermediate stages of ZAP.
+
+    Each stage (extraction, zlevel, continuum filter, normalization, SVD) is
+    stored in a directory whose name is a hash of the checksum of the input
+    file and of the parameters of this stage and of all the previous ones.
+    Changing a parameter thus only invalidates the following stages. Arrays
+    are stored as ``.npy`` files, and are memory-mapped when loaded, other
+    objects (e.g. the PCA models) are pickled.
+
+    When the total size of the cache exceeds ``maxsize``, the least recently
+    used entries are removed.
+
+    Parameters
+    ----------
+    directory : str
+        Path of the cache directory, created if needed.
+    maxsize : int
+        Maximum size of the cache in bytes, unlimited by default.
+
+    """
+
+    INDEX = 'checksums.json'
+
+    def __init__(self, directory, maxsize=None):
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return '<StageCache({}, maxsize={})>'.format(self.directory,
+                                                    self.maxsize)
+
+    def checksum(self, filename):
+        """Return the checksum of a file.
+
+        Checksums are remembered in an index, using the file path, size and
+        modification time, to avoid reading again unchanged files.
+
+        """
+        path = os.path.realpath(filename)
+        st = os.stat(path)
+        indexfile = os.path.join(self.directory, self.INDEX)
+        try:
+            with open(indexfile) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+
+        stamp = [st.st_size, st.st_mtime_ns]
+        if path in index and index[path][:2] == stamp:
+            return index[path][2]
+
+        t0 = time()
+        checksum = file_checksum(path)
+        logger.debug('Checksum of %s computed in %.2f sec.', filename,
+                     time() - t0)
+        index[path] = stamp + [checksum]
+        self._atomic_write(indexfile, json.dumps(index).encode())
+        return checksum
+
+    def key(self, parent, stage, **params):
+        """Compute the key of a stage from its parent key and parameters."""
+        params = {k: array_checksum(v) if isinstance(v, np.ndarray) else v
+                  for k, v in params.items()}
+        desc = json.dumps([parent, stage, params], sort_keys=True,
+                          default=str)
+        return '{}-{}'.format(stage, hashlib.sha1(desc.encode()).hexdigest())
+
+    def load(self, key):
+        """Load the content of an entry, or return None if it is missing.
+
+        Arrays are memory-mapped in copy-on-write mode, so they can be
+        modified in memory without changing the cached files.
+
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+
+        data = {}
+        for fname in os.listdir(path):
+            name, ext = os.path.splitext(fname)
+            fpath = os.path.join(path, fname)
+            if ext == '.npy':
+                data[name] = np.load(fpath, mmap_mode='c')
+            elif ext == '.pkl':
+                with open(fpath, 'rb') as f:
+                    data.update(pickle.load(f))
+
+        # mark the entry as recently used
+        os.utime(path)
+        logger.debug('Loaded %s from the cache', key)
+        return data
+
+    def save(self, key, data):
+        """Save a dict of arrays and objects in a new entry."""
+        path = os.path.join(self.directory, key)
+        if os.path.isdir(path):
+            return
+
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        objects = {}
+        for name, value in data.items():
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(tmpdir, name + '.npy'), value)
+            else:
+                objects[name] = value
+        if objects:
+            with open(os.path.join(tmpdir, 'objects.pkl'), 'wb') as f:
+                pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        try:
+            os.rename(tmpdir, path)
+        except OSError:
+            # another process saved the same entry in the meantime
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        else:
+            logger.debug('Saved %s to the cache', key)
+            self.evict(keep=key)
+
+    def entries(self):
+        """Return the list of (key, size, access time) for all entries."""
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((key, size, os.stat(path).st_mtime))
+        return entries
+
+    @property
+    def size(self):
+        """Total size of the cache entries, in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries to fit in ``maxsize``."""
+        if self.maxsize is None:
+            return
+
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.maxsize:
+                break
+            if key == keep:
+                continue
+            logger.debug('Evicting %s from the cache', key)
+            shutil.rmtree(os.path.join(self.directory, key),
+                          ignore_errors=True)
+            total -= size
+
+        if total > self.maxsize:
+            logger.warning('Cache entry %s is bigger than the cache size',
+                           keep)
+
+    def clear(self):
+        """Remove all the entries."""
+        for key, _, _ in self.entries():
+            shutil.rmtree(os.path.join(self.directory, key),
+                          ignore_errors=True)
+
+    def _atomic_write(self, filename, content):
+        fd, tmpname = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmpname, filename)
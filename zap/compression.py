@@ -0,0 +1,120 @@
+import inspect
+import logging
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+# Presets for the ``compress`` parameter: 'lossless' uses GZIP with byte
+# shuffling on the unquantized floats, 'quantized' uses RICE on floats
+# quantized to 1/16 of the noise, with a dithering that preserves the zeros.
+COMPRESSION_PRESETS = {
+    'lossless': dict(compression_type='GZIP_2', quantize_level=0),
+    'quantized': dict(compression_type='RICE_1', quantize_level=16,
+                      quantize_method=2),
+}
+
+# The tile shape parameter was renamed in Astropy 5.3
+_TILE_SHAPE_ARG = ('tile_shape' if 'tile_shape' in inspect.signature(
+    fits.CompImageHDU.__init__).parameters else 'tile_size')
+
+
+def compression_settings(compress):
+    """Return the `~astropy.io.fits.CompImageHDU` parameters for
+    ``compress``, which can be a preset ('lossless' or 'quantized'), a
+    compression type (e.g. 'RICE_1', 'GZIP_2'), or a dict of parameters."""
+    if compress is None:
+        return None
+    if isinstance(compress, dict):
+        return dict(compress)
+    if compress in COMPRESSION_PRESETS:
+        return dict(COMPRESSION_PRESETS[compress])
+    if isinstance(compress, str):
+        return dict(compression_type=compress.upper())
+    raise ValueError('compress must be a preset ({}), a compression type or a '
+                     'dict, got {!r}'.format(', '.join(COMPRESSION_PRESETS),
+                                             compress))
+
+
+def image_hdu(data, header=None, compress=None, name=None):
+    """Create an image extension, tile-compressed if ``compress`` is given.
+
+    By default a tile is a plane of the cube, which allows to decompress the
+    planes independently.
+
+    """
+    settings = compression_settings(compress)
+    if settings is None:
+        return fits.ImageHDU(data=data, header=header, name=name)
+
+    if data is not None and data.ndim == 3 and \
+            'tile_shape' not in settings and 'tile_size' not in settings:
+        shape = (1, ) + data.shape[1:]
+        if _TILE_SHAPE_ARG == 'tile_size':
+            shape = shape[::-1]
+        settings[_TILE_SHAPE_ARG] = shape
+    return fits.CompImageHDU(data=data, header=header, name=name, **settings)
+
+
+def find_image_hdu(hdul, index=0):
+    """Return the index of the HDU containing the data of ``hdul[index]``.
+
+    A tile-compressed image cannot be stored in the primary HDU, so if the
+    primary HDU is empty and followed by a compressed image, the latter is
+    used.
+
+    """
+    if index == 0 and hdul[0].header.get('NAXIS', 0) == 0 and \
+            len(hdul) > 1 and isinstance(hdul[1], fits.CompImageHDU):
+        return 1
+    return index
+
+
+def read_image(hdu, nthreads=1, nplanes=None):
+    """Return the data of an HDU.
+
+    For a tile-compressed cube the tiles are decompressed by blocks of planes
+    in ``nthreads`` threads (the Astropy codecs release the GIL), otherwise
+    the (possibly memory-mapped) data is returned.
+
+    """
+    if not isinstance(hdu, fits.CompImageHDU) or \
+            not hasattr(hdu, 'section') or len(hdu.shape) != 3:
+        return hdu.data
+
+    nz = hdu.shape[0]
+    if nplanes is None:
+        # blocks aligned on the tiles, a few blocks per thread
+        ztile = hdu._header.get('ZTILE3', 1)
+        nblocks = max(1, 4 * nthreads)
+        nplanes = ztile * max(1, -(-nz // (ztile * nblocks)))
+
+    section = hdu.section
+    data = np.empty(hdu.shape, dtype=section[:1].dtype)
+
+    def read(start):
+        data[start:start + nplanes] = section[start:start + nplanes]
+
+    logger.debug('Decompressing %s with %d threads', hdu.name, nthreads)
+    if nthreads == 1:
+        for k in range(0, nz, nplanes):
+            read(k)
+    else:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(read, range(0, nz, nplanes)))
+    return data
+
+
+def write_image(filename, data, header, compress=None, overwrite=False):
+    """Write a cube to a FITS file, in the primary HDU or, if ``compress`` is
+    given, in a tile-compressed extension."""
+    if compress is None:
+        hdul = fits.HDUList([fits.PrimaryHDU(data=data, header=header)])
+    else:
+        hdul = fits.HDUList([fits.PrimaryHDU(),
+                             image_hdu(data, header=header,
+                                       compress=compress)])
+    hdul.writeto(filename, overwrite=overwrite)
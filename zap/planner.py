@@ -0,0 +1,384 @@
+import logging
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from .storage import open_cube
+from .svd import GramPCA
+from .utils import NanIndex
+from .zap import (ExecutionContext, NCPU, OPTIMIZE_OPTIONS, SKYSEG,
+                  _segment_ranges, _wavelength_axis)
+
+__all__ = ['plan', 'Plan']
+
+logger = logging.getLogger(__name__)
+
+# Rough throughputs of one core, used to estimate the runtime of the stages.
+# They were measured on a typical node and are only meant to give the order
+# of magnitude of the runtime, and to compare the settings.
+DISK_BANDWIDTH = 300e6       # bytes/s, read or write of a FITS file
+DECOMPRESS_BANDWIDTH = 80e6  # bytes/s, tile decompression or compression
+MEMORY_BANDWIDTH = 2e9       # bytes/s, copies and element-wise operations
+MEDIAN_RATE = 6e7            # samples * cfwidth / s, median continuum filter
+FASTMEDIAN_RATE = 7e6        # samples/s, 'fastmedian' continuum filter
+ZLEVEL_RATE = 4e7            # samples/s, median zlevel
+SIGCLIP_RATE = 2e6           # samples/s, sigma-clipped zlevel
+FLOPS = 1.5e10               # flop/s, linear algebra
+
+# SVD engines tried by the planner, from the fastest to the least
+# memory-hungry
+SVD_ENGINES = ('pca', 'gram')
+
+# Number of eigenvectors assumed for the estimates of the incremental mode
+INCREMENTAL_NCOMP = 100
+
+
+class Plan(object):
+
+    """Execution plan of a ZAP run, computed by :func:`~zap.plan`.
+
+    Attributes
+    ----------
+    shape : tuple
+        Shape of the cube.
+    itemsize : int
+        Size in bytes of the values of the cube.
+    nspaxels : int
+        Number of spaxels extracted in the stack.
+    nsky : int
+        Number of spaxels used for the zlevel and the SVD.
+    nfix : int
+        Number of NaN values interpolated by the cleaning.
+    svd : str
+        SVD engine, 'pca' (Scikit-learn) or 'gram' (`~zap.GramPCA`).
+    optimize : str
+        Method used to find the number of eigenspectra.
+    context : `~zap.ExecutionContext`
+        The processes, threads and block size used for the run.
+    stages : `~astropy.table.Table`
+        Estimated peak memory (bytes) and runtime (seconds) of each stage.
+    maxmem : int
+        The memory limit in bytes, if any.
+
+    """
+
+    def __init__(self, shape, itemsize, nspaxels, nsky, nfix, svd, optimize,
+                 context, stages, maxmem=None):
+        self.shape = shape
+        self.itemsize = itemsize
+        self.nspaxels = nspaxels
+        self.nsky = nsky
+        self.nfix = nfix
+        self.svd = svd
+        self.optimize = optimize
+        self.context = context
+        self.stages = stages
+        self.maxmem = maxmem
+
+    def __repr__(self):
+        return ('<Plan(shape={}, svd={}, optimize={}, peak={:.0f} MB, '
+                'time={:.0f} s)>'.format(self.shape, self.svd, self.optimize,
+                                         self.peak / 1024**2, self.time))
+
+    @property
+    def peak(self):
+        """Estimated peak memory of the run, in bytes."""
+        return int(self.stages['memory'].max())
+
+    @property
+    def time(self):
+        """Estimated runtime of the run, in seconds."""
+        return float(self.stages['time'].sum())
+
+    @property
+    def within_limit(self):
+        """True if the peak memory is within the memory limit."""
+        return self.maxmem is None or self.peak <= self.maxmem
+
+    @property
+    def pca_class(self):
+        """The ``pca_class`` parameter of :func:`~zap.process`."""
+        return GramPCA if self.svd == 'gram' else None
+
+    def process_kwargs(self):
+        """Return the parameters of :func:`~zap.process` for this plan."""
+        return dict(pca_class=self.pca_class, optimize=self.optimize,
+                    context=self.context)
+
+    def __str__(self):
+        mb = 1024**2
+        lines = ['Cube {} ({:.0f} MB), {} spaxels extracted, {} used for the '
+                 'SVD, {} NaN values interpolated'.format(
+                     'x'.join(str(n) for n in self.shape),
+                     np.prod(self.shape) * self.itemsize / mb,
+                     self.nspaxels, self.nsky, self.nfix),
+                 'Settings: svd={}, optimize={}, ncpu={}, nthreads={}, '
+                 'nplanes={}'.format(self.svd, self.optimize,
+                                     self.context.ncpu, self.context.nthreads,
+                                     self.context.nplanes),
+                 '',
+                 '{:<12} {:>12} {:>10}'.format('stage', 'memory (MB)',
+                                               'time (s)')]
+        for row in self.stages:
+            lines.append('{:<12} {:>12.0f} {:>10.1f}'.format(
+                row['stage'], row['memory'] / mb, row['time']))
+        lines.append('{:<12} {:>12.0f} {:>10.1f}'.format(
+            'peak/total', self.peak / mb, self.time))
+        if self.maxmem is not None:
+            lines.append('')
+            lines.append('Memory limit: {:.0f} MB, {}'.format(
+                self.maxmem / mb, 'fits' if self.within_limit else
+                'the estimated peak memory exceeds the limit'))
+        return '\n'.join(lines)
+
+
+def _svd_cost(m, n, svd, optimize, itemsize, ncomp=None):
+    """Memory and number of operations of the SVD of a (m, n) matrix, for
+    ``ncomp`` components (all if None)."""
+    k = min(m, n)
+    if optimize == 'incremental' and ncomp is None:
+        ncomp = min(INCREMENTAL_NCOMP, k)
+    # covariance matrix and its tridiagonal reduction, for the incremental
+    # estimate of the number of components
+    est_mem = 2 * n * n * 8 if optimize == 'incremental' else 0
+    est_flop = m * n * n + 4 * n**3 / 3 if optimize == 'incremental' else 0
+
+    if svd == 'gram':
+        # Gram matrix, its decomposition and a block of samples
+        mem = 3 * n * n * 8 + GramPCA().blocksize * n * 8
+        flop = m * n * n + (9 if ncomp is None else 4) * n**3
+    elif ncomp is None:
+        # centered copy, U, Vt and workspace of the full SVD
+        mem = (m * n + m * k + k * n + 5 * k * k) * itemsize
+        flop = 4 * m * n * k
+    else:
+        # centered copy and Lanczos vectors of ARPACK
+        mem = (m * n + 3 * ncomp * (m + n)) * itemsize
+        flop = 40 * m * n * ncomp
+    # components kept in the model
+    kept = (k if ncomp is None else ncomp) * n * 8
+    return max(mem, est_mem), est_flop + flop, kept
+
+
+def _estimate(shape, itemsize, nsp, nsky, nfix, svd, optimize, context,
+              cftype='median', cfwidth=(300, ), zlevel='median', sky=False,
+              compressed=False, compress=False, skycube=False,
+              seglen=None):
+    """Return the table of the estimated memory and runtime of each stage.
+
+    The memory of a stage is the sum of the arrays alive during the stage and
+    of its temporary arrays. See :class:`~zap.Zap` for the arrays.
+    ``seglen`` gives the number of planes of each SVD segment, one segment by
+    default. The segments are decomposed one after the other, so the peak
+    memory of the SVD is the one of the longest segment.
+
+    """
+    nz, ny, nx = shape
+    if seglen is None:
+        seglen = (nz, )
+    ncpu = context.ncpu
+    nthreads = context.nthreads or ncpu
+    nplanes = min(context.nplanes, nz)
+    cube = nz * ny * nx * itemsize
+    nanindex = nz * ((ny * nx + 7) // 8) + ny * nx * 8
+    block = nplanes * ny * nx * itemsize
+    stack = nz * nsp * itemsize
+    skystack = nz * nsky * itemsize
+    stack64 = nz * nsp * 8
+    ncont = 0 if cftype == 'none' else len(cfwidth)
+
+    stages = []
+
+    def add(name, memory, time):
+        stages.append((name, int(memory), float(time)))
+
+    if compressed:
+        add('read', cube + block,
+            cube / (DECOMPRESS_BANDWIDTH * min(ncpu, nz)))
+    else:
+        add('read', cube, cube / DISK_BANDWIDTH)
+
+    # (z, y, x) positions and values of the NaNs, and their 27 neighbors
+    fix = nfix * 32
+    add('nanclean', cube + nanindex + fix + nfix * 27 * 8 + block // 4,
+        cube / MEMORY_BANDWIDTH + nfix * 27 / ZLEVEL_RATE)
+
+    base = cube + nanindex + stack
+    add('extract', base + fix + block, 2 * cube / MEMORY_BANDWIDTH)
+
+    if zlevel == 'median':
+        add('zlevel', base + ncpu * nplanes * nsky * itemsize,
+            nz * nsky / (ZLEVEL_RATE * ncpu))
+    elif zlevel == 'sigclip':
+        add('zlevel', base + (2 if sky else 1) * skystack,
+            nz * nsky / (SIGCLIP_RATE * ncpu))
+    else:
+        add('zlevel', base, 0)
+
+    # the continua, the results of the chunks and the filtered copy of the
+    # stack, then the normalized stack
+    if cftype == 'none':
+        cont_time = stack / MEMORY_BANDWIDTH
+    elif cftype == 'fit':
+        cont_time = 100 * nz * nsp / FLOPS
+    elif cftype == 'fastmedian':
+        cont_time = ncont * nz * nsp / (FASTMEDIAN_RATE * ncpu)
+    else:
+        cont_time = sum(nz * nsp * w / (MEDIAN_RATE * ncpu) for w in cfwidth)
+    add('continuum', base + (2 * ncont + 1) * stack, cont_time)
+    base += ncont * stack + stack
+    add('normalize', base + max(seglen) * nsp * 8,
+        3 * stack / MEMORY_BANDWIDTH)
+
+    # input of the SVD: sky spaxels and normalized stack computed with the
+    # continuum for the SVD
+    svd_input = 0
+    if ncont > 1:
+        svd_input = (3 if sky else 1) * skystack
+    elif sky:
+        svd_input = skystack
+    costs = [_svd_cost(nsky, n, svd, optimize, itemsize) for n in seglen]
+    kept = sum(c[2] for c in costs)
+    add('svd', base + svd_input + max(c[0] for c in costs) + kept,
+        sum(c[1] for c in costs) / (FLOPS * nthreads))
+
+    # the continuum for the SVD is deleted after the SVD
+    if ncont > 1:
+        base -= (ncont - 1) * stack
+    base += kept
+    maxcomp = nsky if optimize == 'full' else min(INCREMENTAL_NCOMP, nsky)
+    add('reconstruct', base + 3 * stack64,
+        sum(4 * nsp * n * min(maxcomp, n) for n in seglen) /
+        (FLOPS * nthreads))
+    base += stack64
+    add('remold', base + stack64 + cube, (stack64 + cube) / MEMORY_BANDWIDTH)
+    base += cube
+    out = 2 if skycube else 1
+    add('write', base + (cube if skycube else 0),
+        out * cube / (DECOMPRESS_BANDWIDTH * ncpu if compress else
+                      DISK_BANDWIDTH))
+
+    return Table(rows=stages, names=('stage', 'memory', 'time'),
+                 dtype=('U12', 'i8', 'f8'))
+
+
+def plan(cubefits, maxmem=None, ncpu=None, nthreads=None, clean=True,
+         zlevel='median', cftype='median', cfwidthSVD=300, cfwidthSP=300,
+         mask=None, svd=None, optimize=None, skycube=False, compress=None,
+         skyseg=None):
+    """Estimate the memory and runtime of a ZAP run, and choose the settings
+    fitting in a memory limit.
+
+    Only the header and the NaN map of the cube are read (the NaN map is
+    computed by blocks of planes, from the memory-mapped or tile-compressed
+    data), to find the number of spaxels extracted in the stack and the
+    number of NaN values to interpolate. The peak memory of each stage is
+    estimated from the arrays alive during the stage and its temporary
+    arrays, and the runtime from rough throughputs, so the estimates are
+    approximations which are useful to choose the resources of a job.
+
+    If ``svd`` or ``optimize`` is None, the planner chooses it: the default
+    settings of :func:`~zap.process` are used if they fit in ``maxmem``,
+    otherwise the incremental optimization and the `~zap.GramPCA` engine are
+    tried. If no setting fits, the plan with the smallest peak memory is
+    returned, with ``within_limit`` set to False. The size of the blocks of
+    planes (``ExecutionContext.nplanes``) is not tuned, as it changes the
+    peak memory only marginally: the estimates use the default size.
+
+    Parameters
+    ----------
+    cubefits : str
+        Input FITS file.
+    maxmem : int
+        Memory limit in bytes.
+    ncpu : int
+        Number of processes, default to the number of CPUs.
+    nthreads : int
+        Number of threads of the linear algebra libraries, default to
+        ``ncpu`` for the estimates.
+    svd : {'pca', 'gram'}
+        SVD engine, chosen by the planner if None.
+    optimize : {'full', 'incremental'}
+        Method to find the number of eigenspectra, chosen by the planner if
+        None.
+    skycube : bool
+        If True, the sky cube is also written.
+    compress : str or dict
+        Compression of the output cubes (see :func:`~zap.process`).
+    skyseg : list
+        Limits of the SVD segments in Angstroms, `SKYSEG` if not given.
+
+    The other parameters are those of :func:`~zap.process`.
+
+    Returns
+    -------
+    `~zap.Plan`
+
+    """
+    if svd is not None and svd not in SVD_ENGINES:
+        raise ValueError('svd must be {}, got {}'.format(
+            ' or '.join(SVD_ENGINES), svd))
+    if optimize is not None and optimize not in OPTIMIZE_OPTIONS:
+        raise ValueError('optimize must be full or incremental, got {}'
+                         .format(optimize))
+
+    with open_cube(cubefits) as cube:
+        shape = cube.shape
+        if len(shape) != 3:
+            raise ValueError('the data is not a cube')
+        # integers are converted to floats
+        itemsize = max(np.dtype(cube.dtype).itemsize, 4)
+        compressed = cube.compressed
+        header = cube.header.copy()
+        if cube.instrument == 'WIFES':
+            header['CUNIT3'] = 'Angstrom'
+        logger.info('Computing the NaN map of %s', cubefits)
+        # the uncompressed FITS data is memory-mapped
+        data = cube.read() if cube.format == 'fits' and not compressed \
+            else cube.section
+        nanindex = NanIndex(data)
+        del data
+
+    nz = shape[0]
+    count = nanindex.count
+    if clean:
+        valid = count <= 0.25 * nz
+        nfix = int(count[valid & (count > 0)].sum())
+    else:
+        valid = count == 0
+        nfix = 0
+    nsp = int(np.count_nonzero(valid))
+    nsky = nsp
+    if mask is not None:
+        if isinstance(mask, str):
+            mask = fits.getdata(mask)
+        nsky = int(np.count_nonzero(valid & (np.asarray(mask) == 0)))
+
+    # skyseg gives the limits between the segments
+    laxis = _wavelength_axis(header, nz)[1]
+    pranges = _segment_ranges(laxis, SKYSEG if skyseg is None else skyseg)[1]
+    seglen = tuple(int(pmax - pmin) for pmin, pmax in pranges)
+    cfwidth = ((cfwidthSP, ) if cfwidthSVD is None or cfwidthSVD == cfwidthSP
+               else (cfwidthSP, cfwidthSVD))
+    ncpu = ncpu or NCPU
+
+    context = ExecutionContext(ncpu=ncpu, nthreads=nthreads, maxmem=maxmem)
+    plans = []
+    for svd_ in ((svd, ) if svd else SVD_ENGINES):
+        for opt in ((optimize, ) if optimize else OPTIMIZE_OPTIONS):
+            stages = _estimate(
+                shape, itemsize, nsp, nsky, nfix, svd_, opt, context,
+                cftype=cftype, cfwidth=cfwidth, zlevel=zlevel,
+                sky=mask is not None, compressed=compressed,
+                compress=compress is not None, skycube=skycube,
+                seglen=seglen)
+            p = Plan(shape, itemsize, nsp, nsky, nfix, svd_, opt, context,
+                     stages, maxmem=maxmem)
+            if p.within_limit:
+                return p
+            plans.append(p)
+
+    p = min(plans, key=lambda p: p.peak)
+    logger.warning('The estimated peak memory (%.0f MB) exceeds the limit '
+                   '(%.0f MB)', p.peak / 1024**2, maxmem / 1024**2)
+    return p
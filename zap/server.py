@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from .zap import (process, cube_nbytes, ExecutionContext, MemoryBudget,
+                  BASIS_ATTRS, MEMORY_FACTOR, SVDoutput, Zap, _BasisCache)
+
+__all__ = ['ZapServer', 'serve', 'submit']
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+
+# parameters of process and SVDoutput that can be given with a job
+PROCESS_PARAMS = ('outcubefits', 'clean', 'zlevel', 'cftype', 'cfwidthSVD',
+                  'cfwidthSP', 'nevals', 'skycubefits', 'skymodelfits',
+                  'mask', 'overwrite', 'varcurvefits', 'optimize', 'compress',
+                  'skyseg')
+BASIS_PARAMS = ('cubefits', 'clean', 'zlevel', 'cftype', 'cfwidth', 'mask',
+                'skyseg')
+
+
+def _total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class ZapServer(object):
+
+    """A long-running ZAP service, keeping a pool of workers and the SVD bases
+    in memory.
+
+    Jobs are given as dicts with the ``cubefits`` to process, the parameters
+    of :func:`~zap.process`, and optionally an ``extSVD`` which is either the
+    path of a cube or a dict with the parameters of :func:`~zap.SVDoutput`.
+    The bases computed for ``extSVD`` are kept in a LRU cache, so processing
+    several exposures of the same field with the same basis only costs the
+    projection and reconstruction.
+
+    Jobs are run by a pool of threads. Before starting, a job waits until its
+    estimated memory usage fits in ``maxmem`` with the running jobs (a job is
+    always started when no other one is running). The parallel steps of the
+    jobs (zlevel and continuum filter) run in a pool of ``ncpu`` processes
+    created once with the server, instead of forking new processes for each
+    job, unless the context already gives an executor.
+
+    Parameters
+    ----------
+    njobs : int
+        Number of jobs run concurrently.
+    maxmem : int
+        Memory budget for the running jobs in bytes, by default the one of the
+        context or half of the physical memory.
+    nbases : int
+        Maximum number of SVD bases kept in memory.
+    ncpu : int
+        Number of processes used by each job for the parallel steps.
+    cache : str or `~zap.StageCache`
+        On-disk cache of the intermediate results, shared by the jobs.
+    context : `~zap.ExecutionContext`
+        Resources used by the jobs, by default a context with ``ncpu``
+        processes.
+
+    """
+
+    def __init__(self, njobs=1, maxmem=None, nbases=4, ncpu=None, cache=None,
+                 context=None):
+        context = ExecutionContext.create(context, ncpu=ncpu)
+        self._pool = None
+        if context.executor is None:
+            # the worker processes are kept for all the jobs, and shut down
+            # with the server
+            self._pool = ProcessPoolExecutor(max_workers=context.ncpu)
+            context = ExecutionContext(
+                ncpu=context.ncpu, executor=self._pool,
+                nthreads=context.nthreads, maxmem=context.maxmem,
+                nplanes=context.nplanes)
+        if maxmem is None:
+            maxmem = context.maxmem
+        if maxmem is None:
+            total = _total_memory()
+            maxmem = total // 2 if total else None
+        self.context = context
+        self.njobs = njobs
+        self.maxmem = maxmem
+        self._budget = MemoryBudget(maxmem)
+        self._lock = threading.Lock()
+        self.cache = cache
+        self.bases = _BasisCache(nbases)
+        self._executor = ThreadPoolExecutor(max_workers=njobs)
+        self._running = 0
+        self._queued = 0
+        self._done = 0
+
+    def status(self):
+        """Return a dict describing the state of the server."""
+        with self._lock:
+            return dict(running=self._running, queued=self._queued,
+                        done=self._done, memory=self._budget.used,
+                        maxmem=self.maxmem, njobs=self.njobs,
+                        bases=[key[0] for key in self.bases.keys()])
+
+    def submit(self, job):
+        """Queue a job, and return a Future with its result."""
+        job = dict(job)
+        if 'cubefits' not in job:
+            raise ValueError('the job must give a cubefits')
+        extsvd = job.pop('extSVD', None)
+        cubefits = job.pop('cubefits')
+        unknown = set(job) - set(PROCESS_PARAMS)
+        if unknown:
+            raise ValueError('unknown parameters: {}'.format(
+                ', '.join(sorted(unknown))))
+        if isinstance(extsvd, str):
+            extsvd = {'cubefits': extsvd}
+        if extsvd is not None:
+            unknown = set(extsvd) - set(BASIS_PARAMS)
+            if unknown or 'cubefits' not in extsvd:
+                raise ValueError('extSVD must give a cubefits and only the '
+                                 'parameters: {}'.format(
+                                     ', '.join(BASIS_PARAMS)))
+
+        nbytes = MEMORY_FACTOR * cube_nbytes(cubefits)
+        with self._lock:
+            self._queued += 1
+        return self._executor.submit(self._run, cubefits, job, extsvd,
+                                     nbytes, time())
+
+    def _basis(self, params):
+        """Return the basis for the given SVDoutput parameters."""
+        path = os.path.realpath(params['cubefits'])
+        key = (path, os.stat(path).st_mtime_ns,
+               json.dumps(params, sort_keys=True, default=str))
+
+        def compute():
+            zobj = SVDoutput(cache=self.cache, context=self.context, **params)
+            # only keep what is used by process
+            basis = Zap.__new__(Zap)
+            for attr in BASIS_ATTRS:
+                setattr(basis, attr, getattr(zobj, attr))
+            return basis
+
+        return self.bases.get(key, compute)
+
+    def _run(self, cubefits, params, extsvd, nbytes, tsubmit):
+        self._budget.acquire(nbytes)
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+
+        try:
+            t0 = time()
+            result = dict(cubefits=cubefits, tqueue=t0 - tsubmit,
+                          tbasis=0, basis_cached=None)
+            if extsvd is not None:
+                params['extSVD'], result['basis_cached'] = \
+                    self._basis(extsvd)
+                result['tbasis'] = time() - t0
+
+            t1 = time()
+            params.setdefault('outcubefits', 'DATACUBE_ZAP.fits')
+            process(cubefits, cache=self.cache, context=self.context,
+                    **params)
+            result['tprocess'] = time() - t1
+            for name in ('outcubefits', 'skycubefits', 'skymodelfits',
+                         'varcurvefits'):
+                if params.get(name) is not None:
+                    result[name] = params[name]
+            logger.info('Processed %s in %.2f sec.', cubefits, time() - t0)
+            return result
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._done += 1
+            self._budget.release(nbytes)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self._reply(200, self.server.zap.status())
+        else:
+            self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/process':
+            self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode())
+            future = self.server.zap.submit(job)
+        except (ValueError, TypeError, OSError) as e:
+            self._reply(400, {'status': 'error', 'error': str(e)})
+            return
+
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error('Job failed: %s', e)
+            self._reply(500, {'status': 'error', 'error': str(e)})
+        else:
+            result['status'] = 'ok'
+            self._reply(200, result)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+def serve(host='127.0.0.1', port=DEFAULT_PORT, **kwargs):
+    """Run a ZAP service on a local HTTP port, until interrupted.
+
+    ``POST /process`` with a JSON job (see :class:`~zap.ZapServer`) runs the
+    job and returns the output paths and timings, ``GET /status`` returns the
+    state of the server. The other parameters are passed to
+    :class:`~zap.ZapServer`.
+
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.zap = ZapServer(**kwargs)
+    logger.info('ZAP server listening on http://%s:%d', host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.zap.shutdown(wait=False)
+
+
+def submit(cubefits, url='http://127.0.0.1:{}'.format(DEFAULT_PORT),
+           timeout=None, **params):
+    """Send a job to a ZAP service started with :func:`~zap.serve`.
+
+    The parameters are those of :func:`~zap.process`, and ``extSVD`` can be
+    the path of a cube or a dict of parameters for :func:`~zap.SVDoutput`.
+    Returns the dict sent back by the server, with the output paths and
+    the timings.
+
+    """
+    # the server may run in another directory
+    job = dict(params, cubefits=cubefits)
+    if isinstance(job.get('extSVD'), str):
+        job['extSVD'] = {'cubefits': job['extSVD']}
+    for params in (job, job.get('extSVD') or {}):
+        for name in ('cubefits', 'outcubefits', 'skycubefits', 'skymodelfits',
+                     'varcurvefits', 'mask'):
+            if isinstance(params.get(name), str):
+                params[name] = os.path.abspath(params[name])
+
+    req = Request(url.rstrip('/') + '/process',
+                  data=json.dumps(job).encode(),
+                  headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(req, timeout=timeout) as f:
+            return json.loads(f.read().decode())
+    except HTTPError as e:
+        raise RuntimeError('ZAP job failed: {}'.format(
+            json.loads(e.read().decode()).get('error')))
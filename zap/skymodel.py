@@ -0,0 +1,195 @@
+import logging
+import numpy as np
+from astropy.io import fits
+
+__all__ = ['SkyModel']
+
+logger = logging.getLogger(__name__)
+
+
+def write_skymodel(zobj, filename, header, overwrite=False):
+    """Write the low-rank model of the sky subtracted by a ``Zap`` object.
+
+    The sky subtracted in each valid spaxel is the zlevel plus, for each
+    segment, the reconstruction from the eigenspectra multiplied by the
+    variance of the spaxel. So instead of the full cube, this stores the
+    zlevel, the eigenspectra and their mean, the coefficients and variances
+    per spaxel, and the bit-packed map of the NaN values.
+
+    """
+    nz, ny, nx = zobj.cube.shape
+    header = header.copy()
+    header['ZAPSKNZ'] = (nz, 'ZAP sky model, cube size along z')
+    header['ZAPSKNY'] = (ny, 'ZAP sky model, cube size along y')
+    header['ZAPSKNX'] = (nx, 'ZAP sky model, cube size along x')
+    if zobj.notch_limits is not None:
+        header['ZAPNTCH'] = ('{}:{}'.format(*zobj.notch_limits),
+                             'Notch filter region (pixels)')
+
+    hdul = [fits.PrimaryHDU(header=header),
+            fits.ImageHDU(data=zobj.zlsky, name='ZLSKY'),
+            fits.ImageHDU(data=np.array([zobj.y, zobj.x], dtype=np.int32),
+                          name='SPAXELS'),
+            fits.ImageHDU(data=zobj.variancearray.astype(np.float32),
+                          name='VARIANCE')]
+
+    for i, (model, coef) in enumerate(zip(zobj.models, zobj._coefs)):
+        pmin, pmax = zobj.pranges[i]
+        ncomp = model.components_.shape[0]
+        comp = model.components_.astype(np.float32) if ncomp else None
+        coef = coef.astype(np.float32) if ncomp else None
+        hdu = fits.ImageHDU(data=comp, name='COMP{}'.format(i))
+        hdu.header['PMIN'] = (pmin, 'first pixel of the segment')
+        hdu.header['PMAX'] = (pmax, 'last pixel of the segment + 1')
+        hdu.header['NCOMP'] = (ncomp, 'number of eigenspectra')
+        hdul.append(hdu)
+        hdul.append(fits.ImageHDU(data=model.mean_, name='MEAN{}'.format(i)))
+        hdul.append(fits.ImageHDU(data=coef, name='COEF{}'.format(i)))
+
+    hdul.append(fits.ImageHDU(data=zobj.nanindex.bits, name='NANMASK'))
+    if zobj.edgemask is not None:
+        hdul.append(fits.ImageHDU(data=zobj.edgemask.astype(np.uint8),
+                                  name='EDGEMASK'))
+    fits.HDUList(hdul).writeto(filename, overwrite=overwrite)
+    logger.info('Sky model file saved to %s', filename)
+
+
+class SkyModel(object):
+
+    """Reader for the low-rank sky model written by
+    :meth:`~zap.Zap.writeskymodel`.
+
+    The sky is reconstructed on demand for any region and wavelength range,
+    reading only the needed parts of the file. Indexing is done like for the
+    cube, with ``(z, y, x)`` slices or integers::
+
+        sky = SkyModel('SKYMODEL.fits')
+        spec = sky[:, 20, 30]
+        subcube = sky[1000:2000, 10:50, 10:50]
+
+    The result is the same as the cube written by
+    :meth:`~zap.Zap.writeskycube`, i.e. the input cube minus the clean cube.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the sky model FITS file.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._hdul = fits.open(filename)
+        self.header = hdr = self._hdul[0].header
+        self.shape = (hdr['ZAPSKNZ'], hdr['ZAPSKNY'], hdr['ZAPSKNX'])
+        self.zlsky = self._hdul['ZLSKY'].data
+        self.y, self.x = self._hdul['SPAXELS'].data
+        self.variancearray = self._hdul['VARIANCE'].data
+
+        self.notch_limits = None
+        if 'ZAPNTCH' in hdr:
+            self.notch_limits = [int(v) for v in hdr['ZAPNTCH'].split(':')]
+
+        self.pranges = []
+        i = 0
+        while 'COMP{}'.format(i) in self._hdul:
+            h = self._hdul['COMP{}'.format(i)].header
+            self.pranges.append((h['PMIN'], h['PMAX']))
+            i += 1
+
+        # index of the spaxels in the model, -1 if not processed by ZAP
+        self._column = np.full(self.shape[1:], -1)
+        self._column[self.y, self.x] = np.arange(self.y.size)
+
+    def __repr__(self):
+        return '<SkyModel(shape={}, nseg={})>'.format(self.shape,
+                                                       len(self.pranges))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._hdul.close()
+
+    def _segment(self, i):
+        """Return the eigenspectra, mean and coefficients of a segment."""
+        ncomp = self._hdul['COMP{}'.format(i)].header['NCOMP']
+        mean = self._hdul['MEAN{}'.format(i)].data
+        if ncomp == 0:
+            return (np.zeros((0, mean.size)), mean,
+                    np.zeros((self.y.size, 0)))
+        return (self._hdul['COMP{}'.format(i)].data, mean,
+                self._hdul['COEF{}'.format(i)].data)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        key = key + (slice(None), ) * (3 - len(key))
+        squeeze = tuple(i for i, k in enumerate(key)
+                        if isinstance(k, (int, np.integer)))
+        key = [slice(k, k + 1 or None) if i in squeeze else k
+               for i, k in enumerate(key)]
+        res = self.get(*key)
+        return res.squeeze(axis=squeeze) if squeeze else res
+
+    def get(self, z=slice(None), y=slice(None), x=slice(None), nans=True):
+        """Reconstruct the sky for a region of the cube.
+
+        Parameters
+        ----------
+        z, y, x : slice
+            The region to reconstruct, default to the whole cube.
+        nans : bool
+            If True (default), the NaN values of the input cube are
+            reinserted.
+
+        Returns
+        -------
+        ndarray
+            The (nz, ny, nx) sky cube for the region.
+
+        """
+        nz, ny, nx = self.shape
+        zidx = np.arange(nz)[z]
+        yidx = np.arange(ny)[y]
+        xidx = np.arange(nx)[x]
+        out = np.zeros((zidx.size, yidx.size, xidx.size), dtype=np.float32)
+
+        # spaxels of the region that were processed by ZAP
+        cols = self._column[np.ix_(yidx, xidx)]
+        valid = cols >= 0
+        cols = cols[valid]
+        if cols.size > 0:
+            sky = np.empty((zidx.size, cols.size))
+            sky[:] = self.zlsky[zidx, np.newaxis]
+            for i, (pmin, pmax) in enumerate(self.pranges):
+                insegment = (zidx >= pmin) & (zidx < pmax)
+                if not insegment.any():
+                    continue
+                lz = zidx[insegment] - pmin
+                comp, mean, coef = self._segment(i)
+                recon = np.dot(coef[cols], comp[:, lz]) + mean[lz]
+                recon *= self.variancearray[i, cols][:, np.newaxis]
+                sky[insegment] += recon.T
+            out[:, valid] = sky
+
+        if nans:
+            bits = self._hdul['NANMASK'].data[zidx]
+            bad = np.unpackbits(bits, axis=1, count=ny * nx).astype(bool)
+            bad = bad.reshape(-1, ny, nx)[:, yidx][:, :, xidx]
+            out[bad] = np.nan
+            if 'EDGEMASK' in self._hdul:
+                edges = self._hdul['EDGEMASK'].data.astype(bool)
+                out[:, edges[np.ix_(yidx, xidx)]] = np.nan
+            if self.notch_limits is not None:
+                lmin, lmax = self.notch_limits
+                out[(zidx >= lmin) & (zidx <= lmax)] = np.nan
+
+        return out
+
+    def to_cube(self):
+        """Reconstruct the full sky cube."""
+        return self.get()
@@ -0,0 +1,355 @@
+import logging
+import numpy as np
+import os
+import shutil
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+from .compression import find_image_hdu, read_image
+
+__all__ = ['open_cube', 'write_cube', 'convert_cube', 'CHUNK_LAYOUTS']
+
+logger = logging.getLogger(__name__)
+
+# Presets for the chunk layout of the HDF5 and Zarr cubes. Zap reads the
+# whole cube, with the chunks read in parallel threads, and extracts the
+# stack from the cube in memory, so for process the layout only changes the
+# number of chunks. The layout matters for the partial reads (``section``):
+# - 'spectra': full spectra of small tiles of spaxels, to read the spectra of
+#   a region,
+# - 'planes': blocks of full planes, to read blocks of planes (streaming by
+#   wavelength chunks),
+# - 'bricks': blocks of 32x32 spaxels and a few hundred planes, which are
+#   read efficiently for both access patterns.
+CHUNK_LAYOUTS = ('spectra', 'planes', 'bricks')
+
+# Target size of the chunks in bytes
+CHUNK_SIZE = 2**20
+
+HDF5_EXTENSIONS = ('.h5', '.hdf5', '.hdf')
+
+
+def cube_format(path):
+    """Return the format of a cube from its file name: 'hdf5', 'zarr' or
+    'fits'."""
+    ext = os.path.splitext(path.rstrip('/'))[1].lower()
+    if ext in HDF5_EXTENSIONS:
+        return 'hdf5'
+    if ext == '.zarr':
+        return 'zarr'
+    return 'fits'
+
+
+def chunk_shape(shape, layout='bricks', itemsize=4, size=CHUNK_SIZE):
+    """Return the shape of the chunks for a cube of the given shape, with a
+    layout of `CHUNK_LAYOUTS` or a tuple, and chunks of about ``size``
+    bytes."""
+    nz, ny, nx = shape
+    nitems = max(1, size // itemsize)
+    if isinstance(layout, (tuple, list)):
+        if len(layout) != 3:
+            raise ValueError('chunks must have 3 values, got {}'.format(
+                layout))
+        chunks = layout
+    elif layout == 'spectra':
+        tile = max(1, int(np.sqrt(nitems / nz)))
+        chunks = (nz, tile, tile)
+    elif layout == 'planes':
+        chunks = (max(1, nitems // (ny * nx)), ny, nx)
+    elif layout == 'bricks':
+        chunks = (max(1, nitems // 32**2), 32, 32)
+    else:
+        raise ValueError('chunks must be a tuple or one of {}, got {!r}'
+                         .format(', '.join(CHUNK_LAYOUTS), layout))
+    return tuple(int(min(c, s)) for c, s in zip(chunks, shape))
+
+
+def _chunk_slices(shape, chunks):
+    """Iterate on the slices of the chunks of an array."""
+    ranges = [range(0, s, c) for s, c in zip(shape, chunks)]
+    for start in product(*ranges):
+        yield tuple(slice(i, min(i + c, s))
+                    for i, c, s in zip(start, chunks, shape))
+
+
+def _map_chunks(func, shape, chunks, nthreads=1):
+    """Call ``func`` on the slices of the chunks, in ``nthreads`` threads."""
+    slices = _chunk_slices(shape, chunks)
+    if nthreads == 1:
+        for sl in slices:
+            func(sl)
+    else:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(func, slices))
+
+
+def _import(name):
+    try:
+        return __import__(name)
+    except ImportError:
+        raise ImportError('{} is needed to use the {} cubes'.format(
+            name, name.upper() if name == 'h5py' else name.capitalize()))
+
+
+def _instrument_mode(header):
+    """Return the instrument mode of a MUSE cube, from its primary header,
+    None otherwise."""
+    if header.get('INSTRUME') == 'MUSE':
+        return header.get('HIERARCH ESO INS MODE')
+    return None
+
+
+def _cube_hdu(hdul):
+    """Return the index of the HDU with the header of the cube, and the HDU
+    with its data, for the supported instruments."""
+    instrument = hdul[0].header.get('INSTRUME')
+    if instrument == 'MUSE':
+        return 1, hdul[1]
+    if instrument in ('KCWI', 'FOCAS', 'WIFES'):
+        index = find_image_hdu(hdul)
+        if instrument == 'WIFES' and 'WIFES REDUCED DATA' in hdul:
+            return index, hdul['WIFES REDUCED DATA']
+        return index, hdul[index]
+    raise ValueError('unsupported instrument %s' % instrument)
+
+
+def _compressed(data):
+    """Return True if a HDF5 dataset or a Zarr array is compressed."""
+    if hasattr(data, 'compression'):
+        return data.compression is not None
+    if hasattr(data, 'compressors'):
+        # Zarr 3, whose ``compressor`` raises an error for the v3 arrays
+        return len(data.compressors) > 0
+    return data.compressor is not None
+
+
+class _CubeFile(object):
+
+    """Base class of the cube readers, used as context managers."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def instrument(self):
+        return self.primary_header.get('INSTRUME')
+
+    @property
+    def ins_mode(self):
+        return _instrument_mode(self.primary_header)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+class _FitsCube(_CubeFile):
+
+    """Cube of a FITS file. ``index`` is the index of the HDU with the header
+    of the cube, used to merge the output cube in the input file."""
+
+    format = 'fits'
+    chunks = None
+
+    def __init__(self, path):
+        self._hdul = fits.open(path)
+        self.primary_header = self._hdul[0].header
+        self.index, self._hdu = _cube_hdu(self._hdul)
+        self.header = self._hdul[self.index].header
+        self.shape = self._hdu.shape
+
+    @property
+    def compressed(self):
+        return isinstance(self._hdu, fits.CompImageHDU)
+
+    @property
+    def dtype(self):
+        return self._hdu.section[:1].dtype
+
+    @property
+    def section(self):
+        """Object giving blocks of planes without reading the full cube."""
+        return self._hdu.section
+
+    def read(self, nthreads=1):
+        return read_image(self._hdu, nthreads=nthreads)
+
+    def close(self):
+        self._hdul.close()
+
+
+class _ChunkedCube(_CubeFile):
+
+    """Cube of a HDF5 file or a Zarr group, with the headers stored as
+    attributes."""
+
+    index = None
+
+    def __init__(self, path):
+        self.format = cube_format(path)
+        if self.format == 'hdf5':
+            self._file = _import('h5py').File(path, 'r')
+            group = self._file
+        else:
+            self._file = None
+            group = _import('zarr').open_group(path, mode='r')
+        self._data = group['DATA']
+        self.header = fits.Header.fromstring(group.attrs['header'])
+        self.primary_header = fits.Header.fromstring(
+            group.attrs['primary_header'])
+        self.shape = self._data.shape
+        self.dtype = self._data.dtype
+        self.chunks = self._data.chunks
+        self.compressed = _compressed(self._data)
+
+    @property
+    def section(self):
+        return self._data
+
+    def read(self, nthreads=1):
+        """Read the cube, with the chunks read in ``nthreads`` threads (for
+        HDF5 the reads are serialized by h5py)."""
+        data = np.empty(self.shape, dtype=self.dtype)
+
+        def read(sl):
+            data[sl] = self._data[sl]
+
+        logger.debug('Reading %d chunks with %d threads',
+                     np.prod([-(-s // c) for s, c in
+                              zip(self.shape, self.chunks)]), nthreads)
+        _map_chunks(read, self.shape, self.chunks, nthreads=nthreads)
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def open_cube(path):
+    """Open a cube stored in a FITS file, a HDF5 file (.h5, .hdf5) or a Zarr
+    group (.zarr), to use as a context manager.
+
+    The returned object gives the ``header`` of the cube, the
+    ``primary_header`` (with the instrument), the ``shape``, a ``section``
+    giving blocks of planes without reading the full cube, and a ``read``
+    method returning the full cube (for the chunked cubes, the chunks are
+    read in parallel threads).
+
+    """
+    if cube_format(path) == 'fits':
+        return _FitsCube(path)
+    return _ChunkedCube(path)
+
+
+def _create_cube(path, shape, dtype, header, primary_header=None,
+                 chunks='bricks', compress=True, overwrite=False):
+    """Create an empty chunked cube, and return the dataset and the object
+    to close."""
+    if os.path.exists(path):
+        if not overwrite:
+            raise OSError('File {!r} already exists.'.format(path))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    # the FITS data are big-endian
+    dtype = np.dtype(dtype).newbyteorder('=')
+    chunks = chunk_shape(shape, chunks, itemsize=dtype.itemsize)
+    if cube_format(path) == 'hdf5':
+        group = _import('h5py').File(path, 'w')
+        options = dict(compression='gzip', compression_opts=1,
+                       shuffle=True) if compress else {}
+        data = group.create_dataset('DATA', shape=shape, dtype=dtype,
+                                    chunks=chunks, **options)
+        closing = group
+    else:
+        group = _import('zarr').open_group(path, mode='w')
+        if hasattr(group, 'create_array'):
+            # Zarr 3
+            create = group.create_array
+            options = {} if compress else dict(compressors=None)
+        else:
+            create = group.create_dataset
+            options = {} if compress else dict(compressor=None)
+        data = create('DATA', shape=shape, dtype=dtype, chunks=chunks,
+                      **options)
+        closing = None
+    group.attrs['header'] = header.tostring()
+    group.attrs['primary_header'] = (primary_header or fits.Header()) \
+        .tostring()
+    return data, closing
+
+
+def write_cube(path, data, header, primary_header=None, chunks='bricks',
+               compress=True, nthreads=1, overwrite=False):
+    """Write a cube to a chunked HDF5 file (.h5, .hdf5) or Zarr group
+    (.zarr).
+
+    Parameters
+    ----------
+    path : str
+        Output file, its extension gives the format.
+    data : ndarray
+        The (nz, ny, nx) cube.
+    header, primary_header : `~astropy.io.fits.Header`
+        Headers of the cube and of the primary HDU of the original FITS file,
+        stored as attributes.
+    chunks : str or tuple
+        Shape of the chunks, or a layout of `CHUNK_LAYOUTS`.
+    compress : bool
+        If True (default), the chunks are compressed losslessly (GZIP with
+        byte shuffling for HDF5, the default codec of Zarr).
+    nthreads : int
+        Number of threads writing the chunks (for HDF5 the writes are
+        serialized by h5py).
+
+    """
+    out, closing = _create_cube(path, data.shape, data.dtype, header,
+                                primary_header=primary_header, chunks=chunks,
+                                compress=compress, overwrite=overwrite)
+
+    def write(sl):
+        out[sl] = data[sl]
+
+    try:
+        _map_chunks(write, data.shape, out.chunks, nthreads=nthreads)
+    finally:
+        if closing is not None:
+            closing.close()
+
+
+def convert_cube(cubefits, outfile, chunks='bricks', compress=True,
+                 nthreads=1, overwrite=False):
+    """Convert the cube of a FITS file to a chunked HDF5 file (.h5, .hdf5) or
+    Zarr group (.zarr), which can be used as input of ZAP.
+
+    The cube is read by slabs of chunks, so the full cube is never loaded,
+    and the slabs are converted in ``nthreads`` threads. Only the cube and
+    its headers are converted, not the other extensions (e.g. the variance of
+    MUSE cubes). See :func:`~zap.write_cube` for the other parameters.
+
+    """
+    with open_cube(cubefits) as cube:
+        out, closing = _create_cube(
+            outfile, cube.shape, cube.dtype, cube.header,
+            primary_header=cube.primary_header, chunks=chunks,
+            compress=compress, overwrite=overwrite)
+        section = cube.section
+
+        def convert(sl):
+            out[sl] = section[sl]
+
+        # slabs of chunks with full rows, a FITS section is read by rows
+        slab = out.chunks[:2] + cube.shape[2:]
+        logger.info('Converting %s to %s, chunks %s', cubefits, outfile,
+                    out.chunks)
+        try:
+            _map_chunks(convert, cube.shape, slab, nthreads=nthreads)
+        finally:
+            if closing is not None:
+                closing.close()
@@ -0,0 +1,267 @@
+import logging
+import numpy as np
+import os
+from astropy.io import fits
+from time import time
+from types import SimpleNamespace
+
+from .storage import open_cube
+from .utils import NanIndex
+from .zap import (SKYSEG, ExecutionContext, Zap, _Monitor, _interpolate_nans,
+                  _neighbors, _newheader, _notch_limits, _segment_ranges,
+                  _wavelength_axis, __version__)
+
+__all__ = ['process_stream']
+
+logger = logging.getLogger(__name__)
+
+# Continuum filters supported by the streaming mode, which need only a halo
+# of planes around each chunk (the polynomial fit uses the whole spectrum)
+STREAM_CFTYPES = ('median', 'none')
+
+
+def process_stream(cubefits, outcubefits='DATACUBE_ZAP.fits', clean=True,
+                   zlevel='median', cftype='median', cfwidthSVD=300,
+                   cfwidthSP=300, nevals=[], skycubefits=None, mask=None,
+                   skyseg=None, pca_class=None, n_components=None,
+                   optimize='full', overwrite=False, ncpu=None, context=None,
+                   progress=None, cancel=None):
+    """Performs the ZAP sky subtraction one wavelength chunk at a time.
+
+    The chunks are the SVD segments, defined by the wavelength limits
+    ``skyseg`` (`SKYSEG` by default). For each chunk, the planes of the chunk
+    and a halo of half the continuum filter width on each side are read,
+    cleaned, extracted, zlevel-subtracted and continuum-filtered, then the
+    SVD and the reconstruction are computed on the planes of the chunk, and
+    the clean planes are appended to the output file. The peak memory thus
+    scales with the length of the chunks instead of the full spectral axis.
+
+    The result is the same as with :func:`~zap.process` with the same
+    segments, as the NaN map is computed in a first pass over the cube: the
+    spaxels rejected by the NaN cleaning are the same for all chunks. The
+    zlevel is computed per plane, so it does not depend on the chunks.
+
+    Only the 'median' and 'none' continuum filters are supported, and the
+    output cube is written as a single image (like
+    :meth:`~zap.Zap.writecube`), without the other extensions of the input
+    file.
+
+    Parameters
+    ----------
+    cubefits : str
+        Input FITS file, containing a cube with data in the first extension,
+        or chunked HDF5 or Zarr file (see :func:`~zap.convert_cube`).
+    outcubefits : str
+        Output FITS file. Default to `DATACUBE_ZAP.fits`.
+    skyseg : list
+        Limits of the chunks in Angstroms. If not given, `SKYSEG` is used,
+        which by default gives only one chunk.
+    nevals : list
+        Number of eigenspectra used for each chunk: either a single value
+        used for all the chunks, or one value per chunk.
+    ncpu : int
+        Number of processes for the continuum filter, used if ``context`` is
+        not given.
+
+    The other parameters are those of :func:`~zap.process`.
+
+    """
+    logger.info('Running ZAP %s in streaming mode !', __version__)
+    t0 = time()
+    if cftype not in STREAM_CFTYPES:
+        raise ValueError('the streaming mode supports only the {} continuum '
+                         'filters, got {}'.format(
+                             ' and '.join(STREAM_CFTYPES), cftype))
+    for filename in (outcubefits, skycubefits):
+        if filename is not None and os.path.exists(filename):
+            if not overwrite:
+                raise IOError('Output file "{0}" exists'.format(filename))
+            # a streaming HDU is appended to an existing file
+            os.remove(filename)
+
+    context = ExecutionContext.create(context, ncpu=ncpu)
+    monitor = _Monitor(progress=progress, cancel=cancel)
+    if isinstance(mask, str):
+        logger.info('Selecting sky spaxels from %s', mask)
+        mask = fits.getdata(mask)
+
+    with open_cube(cubefits) as cube, context.limits():
+        header = cube.header.copy()
+        if cube.instrument == 'WIFES':
+            header['CUNIT3'] = 'Angstrom'
+        nz = cube.shape[0]
+        wcs, laxis = _wavelength_axis(header, nz)
+        notch_limits = _notch_limits(cube.ins_mode, wcs, laxis)
+        reader = _PlaneReader(cube, notch_limits=notch_limits)
+
+        monitor.start('nanclean')
+        nanindex = NanIndex(reader, nplanes=context.nplanes)
+        badmap, nans = _clean_map(nanindex, clean=clean)
+        pranges = _segment_ranges(laxis, SKYSEG if skyseg is None
+                                  else skyseg)[1]
+        nseg = len(pranges)
+        if nseg == 1:
+            logger.warning('Only one chunk, the full cube is processed at '
+                           'once: use skyseg to split the wavelength axis')
+
+        halo = 0 if cftype == 'none' else max(cfwidthSP, cfwidthSVD) // 2 + 2
+        writers = {}
+        segnevals = []
+        monitor.start('stream')
+        for i, (pmin, pmax) in enumerate(pranges):
+            logger.info('Processing planes %d to %d', pmin, pmax - 1)
+            zobj = _process_chunk(
+                reader, laxis, pmin, pmax, halo, badmap, nans, mask,
+                notch_limits, zlevel=zlevel, cftype=cftype,
+                cfwidthSVD=cfwidthSVD, cfwidthSP=cfwidthSP,
+                nevals=_chunk_nevals(nevals, i, nseg), optimize=optimize,
+                pca_class=pca_class, n_components=n_components,
+                context=context, cancel=cancel)
+            segnevals.append(zobj.nevals[0])
+
+            if not writers:
+                hdr = _newheader(SimpleNamespace(
+                    run_zlevel=zobj.run_zlevel, run_clean=clean,
+                    _cftype=cftype, _cfwidth=cfwidthSP, pranges=pranges,
+                    nevals=np.zeros(nseg, dtype=int)), header)
+                shape = (nz, ) + zobj.cleancube.shape[1:]
+                for filename in (outcubefits, skycubefits):
+                    if filename is not None:
+                        writers[filename] = _stream_hdu(
+                            filename, hdr, shape, zobj.cleancube.dtype)
+            if skycubefits is not None:
+                writers[skycubefits].write(zobj.make_skycube())
+            writers[outcubefits].write(zobj.cleancube)
+            del zobj
+            monitor.update((i + 1) / nseg)
+
+    for filename, shdu in writers.items():
+        shdu.close()
+        # the number of eigenspectra is known only at the end
+        with fits.open(filename, mode='update') as hdul:
+            for i, nev in enumerate(segnevals):
+                hdul[0].header['ZAPnev{}'.format(i)] = nev
+        logger.info('Cube file saved to %s', filename)
+    logger.info('Zapped! (took %.2f sec.)', time() - t0)
+
+
+class _PlaneReader(object):
+
+    """Read blocks of planes of a cube (see `~zap.open_cube`), without
+    loading the full cube, with the notch filter region of the AO modes set
+    to zero."""
+
+    def __init__(self, cube, notch_limits=None):
+        self.section = cube.section
+        self.shape = cube.shape
+        self.notch_limits = notch_limits
+
+    def __getitem__(self, planes):
+        start, stop, _ = planes.indices(self.shape[0])
+        data = np.array(self.section[start:stop])
+        if self.notch_limits is not None:
+            lmin, lmax = self.notch_limits
+            data[max(lmin - start, 0):max(lmax + 1 - start, 0)] = 0.0
+        return data
+
+
+def _clean_map(nanindex, clean=True, rejectratio=0.25, boxsz=1):
+    """Return the map of the number of NaN values per spaxel remaining after
+    the NaN cleaning (see ``_nanclean``), and the (z, y, x) positions of the
+    NaN values to interpolate. This uses only the NaN index, the values are
+    interpolated later for each chunk."""
+    if not clean:
+        return nanindex.count, None
+
+    logger.info('Cleaning NaN values in the cube')
+    badmask = nanindex.count > (rejectratio * nanindex.shape[0])
+    logger.info('Rejected %d spaxels with more than %.1f%% NaN pixels',
+                np.count_nonzero(badmask), rejectratio * 100)
+    z, y, x = nanindex.voxels(spaxels=~badmask)
+    logger.info("Fixing %d remaining NaN pixels", len(z))
+
+    # a NaN value cannot be interpolated if all its neighbors are NaN
+    fixed = np.zeros(z.size, dtype=bool)
+    for iz, iy, ix, ins in _neighbors(z, y, x, nanindex.shape, boxsz):
+        fixed[ins] |= ~nanindex.isnan(iz[ins], iy[ins], ix[ins])
+
+    badmap = np.where(badmask, nanindex.count, 0)
+    np.add.at(badmap, (y[~fixed], x[~fixed]), 1)
+    return badmap, (z, y, x)
+
+
+def _chunk_nevals(nevals, i, nseg):
+    """Return the ``nevals`` parameter of the i-th chunk."""
+    nevals = np.atleast_1d(nevals)
+    if nevals.size == 0:
+        return []
+    if len(nevals) != nseg:
+        return nevals[:1].tolist()
+    return nevals[i:i + 1].tolist()
+
+
+def _process_chunk(reader, laxis, pmin, pmax, halo, badmap, nans, mask,
+                   notch_limits, zlevel='median', cftype='median',
+                   cfwidthSVD=300, cfwidthSP=300, nevals=[], optimize='full',
+                   pca_class=None, n_components=None, context=None,
+                   cancel=None, boxsz=1):
+    """Run ZAP on the planes ``pmin`` to ``pmax`` of the cube, with a halo of
+    planes for the continuum filter, and return the Zap object cropped to
+    these planes."""
+    nz = reader.shape[0]
+    start, stop = max(pmin - halo, 0), min(pmax + halo, nz)
+    # the interpolation of the NaN values uses the neighbor planes
+    rstart, rstop = max(start - boxsz, 0), min(stop + boxsz, nz)
+    raw = reader[rstart:rstop]
+    block = raw[start - rstart:stop - rstart]
+
+    zobj = Zap.from_array(block, wave=laxis[start:stop], inplace=True,
+                          pca_class=pca_class, n_components=n_components,
+                          context=context, cancel=cancel)
+    zobj._badmap = badmap
+    if nans is not None:
+        z, y, x = nans
+        sel = (z >= start) & (z < stop)
+        z, y, x = z[sel], y[sel], x[sel]
+        values = _interpolate_nans(raw, z, y, x, boxsz=boxsz,
+                                   shape=reader.shape, zoffset=rstart)
+        zobj._nanfix = (z - start, y, x, values)
+        zobj.run_clean = True
+    if notch_limits is not None:
+        # the halves before and after the notch filter may be empty
+        zobj.notch_limits = np.clip(np.asarray(notch_limits) - start, 0,
+                                    stop - start)
+
+    zobj._extract()
+    if mask is not None:
+        zobj._selectsky(mask)
+    zobj._zlevel(calctype=zlevel)
+    zobj._continuumfilter(cfwidth=cfwidthSP, cftype=cftype,
+                          cfwidthSVD=cfwidthSVD)
+
+    # keep only the planes of the chunk
+    rows = slice(pmin - start, pmax - start)
+    for name in ('cube', 'laxis', 'zlsky', 'stack', 'contarray',
+                 'contarraySVD', 'normstack'):
+        arr = getattr(zobj, name)
+        if arr is not None:
+            setattr(zobj, name, arr[rows])
+    zobj.pranges = np.array([(0, pmax - pmin)])
+    zobj.lranges = np.array([(laxis[pmin], laxis[pmax - 1])])
+    zobj.nanindex = NanIndex(zobj.cube, nplanes=zobj.context.nplanes)
+
+    zobj._normalize_variance()
+    zobj._reconstruct_sky(nevals=nevals, optimize=optimize)
+    if notch_limits is not None:
+        lmin, lmax = np.asarray(notch_limits) - pmin
+        zobj.cleancube[max(lmin, 0):max(lmax + 1, 0)] = np.nan
+    return zobj
+
+
+def _stream_hdu(filename, header, shape, dtype):
+    """Create a FITS file with a primary HDU of the given shape, whose data
+    is written by blocks of planes."""
+    # a zero-strided array gives the header of the cube without allocating it
+    data = np.broadcast_to(np.zeros(1, dtype=dtype), shape)
+    header = fits.PrimaryHDU(data=data, header=header).header
+    return fits.StreamingHDU(filename, header)
@@ -0,0 +1,292 @@
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.linalg import eigh, qr
+from scipy.linalg.blas import dsyrk
+
+__all__ = ['GramPCA', 'SubspacePCA']
+
+logger = logging.getLogger(__name__)
+
+# Attributes of a fitted model, computed by the decomposition
+FITTED_ATTRS = ('mean_', 'components_', 'explained_variance_',
+                'explained_variance_ratio_', 'singular_values_',
+                'n_components_', 'n_features_in_')
+
+
+def _accumulate(X, gram=None, total=None):
+    """Add the Gram matrix and the sum of the rows of a block of samples."""
+    X = np.asarray(X, dtype=float)
+    if gram is None:
+        gram = np.zeros((X.shape[1], X.shape[1]), order='F')
+        total = np.zeros(X.shape[1])
+    # only the upper triangle is computed
+    gram = dsyrk(1.0, X, beta=1.0, c=gram, trans=1, overwrite_c=1)
+    total += X.sum(axis=0)
+    return gram, total
+
+
+class GramPCA(object):
+
+    """PCA computed from the covariance matrix, accumulated by blocks.
+
+    For the tall-skinny matrices used by ZAP (many spaxels, a few thousands
+    wavelengths), this avoids to work on the full matrix and on its centered
+    copy: the (nfeatures, nfeatures) Gram matrix is accumulated by blocks of
+    samples, which can be read from a memory-mapped array or given one by one
+    with :meth:`partial_fit`, and it is then decomposed. The memory usage is
+    thus O(nfeatures**2) plus one block. With :meth:`partial_fit` the
+    decomposition is computed only when the model is used, i.e. when one of
+    its attributes (``components_``, ``mean_``, ...) is accessed.
+
+    This class provides the subset of the `sklearn.decomposition.PCA` API
+    used by ZAP, so it can be given as ``pca_class`` to :func:`~zap.process`.
+
+    Parameters
+    ----------
+    n_components : int
+        Number of components to keep, all by default.
+    blocksize : int
+        Number of samples per block.
+    n_jobs : int
+        Number of threads used to accumulate the blocks. Each thread uses its
+        own Gram matrix, the default is to use one thread (the matrix products
+        already use a multi-threaded BLAS).
+
+    """
+
+    def __init__(self, n_components=None, blocksize=4096, n_jobs=1):
+        self.n_components = n_components
+        self.blocksize = blocksize
+        self.n_jobs = n_jobs
+        self._reset()
+
+    def __getattr__(self, name):
+        # called only for the missing attributes: after partial_fit, the
+        # accumulated matrix is decomposed when the model is first used
+        if name in FITTED_ATTRS and self.__dict__.get('_gram') is not None:
+            self._decompose()
+            return self.__dict__[name]
+        raise AttributeError('{!r} object has no attribute {!r}'.format(
+            type(self).__name__, name))
+
+    def _reset(self):
+        self._gram = None
+        self._sum = None
+        self.n_samples_ = 0
+
+    def partial_fit(self, X):
+        """Add a block of samples (nsamples, nfeatures) to the model.
+
+        Only the covariance matrix is updated, the decomposition is computed
+        when the model is used.
+
+        """
+        self._gram, self._sum = _accumulate(X, self._gram, self._sum)
+        self.n_samples_ += X.shape[0]
+        for attr in FITTED_ATTRS:
+            self.__dict__.pop(attr, None)
+        return self
+
+    def fit(self, X):
+        """Fit the model with X (nsamples, nfeatures), reading it by blocks.
+        """
+        self._reset()
+        blocks = [X[i:i + self.blocksize]
+                  for i in range(0, X.shape[0], self.blocksize)]
+        njobs = min(self.n_jobs or 1, len(blocks))
+        if njobs > 1:
+            # each thread accumulates the blocks with the same index modulo
+            # njobs, and the partial matrices are summed at the end
+            def run(i):
+                gram = total = None
+                for block in blocks[i::njobs]:
+                    gram, total = _accumulate(block, gram, total)
+                return gram, total
+
+            with ThreadPoolExecutor(max_workers=njobs) as executor:
+                parts = list(executor.map(run, range(njobs)))
+            self._gram = sum(p[0] for p in parts)
+            self._sum = sum(p[1] for p in parts)
+        else:
+            for block in blocks:
+                self._gram, self._sum = _accumulate(block, self._gram,
+                                                    self._sum)
+        self.n_samples_ = X.shape[0]
+        self._decompose()
+        return self
+
+    def _decompose(self):
+        nsamples = self.n_samples_
+        nfeat = self._gram.shape[0]
+        self.mean_ = self._sum / nsamples
+        cov = self._gram - nsamples * np.outer(self.mean_, self.mean_)
+        cov /= max(nsamples - 1, 1)
+
+        # as for sklearn, the number of components is limited by the rank
+        nmax = min(nsamples, nfeat)
+        ncomp = nmax if self.n_components is None else \
+            min(int(self.n_components), nmax)
+        w, v = eigh(cov, lower=False, subset_by_index=(nfeat - ncomp,
+                                                       nfeat - 1))
+        w, v = w[::-1], v[:, ::-1]
+        np.clip(w, 0, None, out=w)
+
+        self.n_components_ = ncomp
+        self.n_features_in_ = nfeat
+        self.components_ = np.ascontiguousarray(v.T)
+        self.explained_variance_ = w
+        self.explained_variance_ratio_ = w / np.trace(cov)
+        self.singular_values_ = np.sqrt(w * max(nsamples - 1, 1))
+
+    def transform(self, X):
+        """Project X on the components."""
+        return np.dot(X - self.mean_, self.components_.T)
+
+    def inverse_transform(self, X):
+        """Transform projected data back to its original space."""
+        return np.dot(X, self.components_) + self.mean_
+
+
+class SubspacePCA(GramPCA):
+
+    """PCA computed by block subspace iteration, warm-started from an initial
+    basis.
+
+    When the eigenspaces change slowly, e.g. for consecutive exposures of the
+    same field, the components of a previous decomposition are a very good
+    starting point: a few iterations, each costing two matrix products with
+    the data, are enough to refine them on the new data, instead of a full
+    decomposition. The convergence of each component is measured by the norm
+    of its residual ``|C v - lambda v|``, relative to the largest eigenvalue.
+    If the iteration does not converge after ``maxiter`` iterations, the full
+    decomposition of the covariance matrix is computed.
+
+    Parameters
+    ----------
+    n_components : int
+        Number of components to compute, by default the number of rows of
+        ``init``.
+    init : ndarray
+        The (ncomp, nfeatures) initial components. Random vectors are used to
+        complete it if needed.
+    maxiter : int
+        Maximum number of iterations.
+    tol : float
+        Tolerance on the relative residuals.
+    oversampling : int
+        Number of additional vectors in the subspace, which speed up the
+        convergence of the last components.
+    random_state : int
+        Seed of the random vectors.
+    blocksize : int
+        Number of samples per block for the products with the data.
+
+    Attributes
+    ----------
+    converged_ : bool
+        True if the iteration converged, False if the full decomposition was
+        used.
+    n_iter_ : int
+        Number of iterations.
+    residuals_ : ndarray
+        Relative residuals of the components.
+
+    """
+
+    def __init__(self, n_components=None, init=None, maxiter=100, tol=1e-5,
+                 oversampling=10, random_state=0, blocksize=4096):
+        super(SubspacePCA, self).__init__(n_components=n_components,
+                                          blocksize=blocksize)
+        self.init = init
+        self.maxiter = maxiter
+        self.tol = tol
+        self.oversampling = oversampling
+        self.random_state = random_state
+
+    def _blocks(self, X):
+        """Iterate on the blocks of samples of X, converted to float64."""
+        for i in range(0, X.shape[0], self.blocksize):
+            yield np.asarray(X[i:i + self.blocksize], dtype=float)
+
+    def fit(self, X):
+        """Fit the model with X (nsamples, nfeatures).
+
+        X is kept in its dtype (e.g. float32), the products are computed in
+        float64 by blocks of ``blocksize`` samples.
+
+        """
+        X = np.asarray(X)
+        if not np.issubdtype(X.dtype, np.floating):
+            X = X.astype(float)
+        nsamples, nfeat = X.shape
+        init = np.zeros((0, nfeat)) if self.init is None else \
+            np.atleast_2d(self.init)
+        if init.shape[1] != nfeat:
+            raise ValueError('init must have {} features, got {}'
+                             .format(nfeat, init.shape[1]))
+
+        nmax = min(nsamples, nfeat)
+        ncomp = init.shape[0] if self.n_components is None else \
+            int(self.n_components)
+        ncomp = min(max(ncomp, 1), nmax)
+        nvec = min(ncomp + self.oversampling, nmax)
+
+        mean = X.mean(axis=0, dtype=float)
+        norm = max(nsamples - 1, 1)
+
+        def covdot(V):
+            # product of the covariance matrix with V, without centering X
+            XtXV = np.zeros((nfeat, V.shape[1]))
+            for block in self._blocks(X):
+                XtXV += np.dot(block.T, np.dot(block, V))
+            return (XtXV - nsamples * np.outer(mean, np.dot(mean, V))) / norm
+
+        # initial subspace, completed with random vectors
+        rng = np.random.RandomState(self.random_state)
+        V = rng.standard_normal((nfeat, nvec))
+        ninit = min(init.shape[0], nvec)
+        V[:, :ninit] = init[:ninit].T
+        V = qr(V, mode='economic')[0]
+
+        self.converged_ = False
+        for it in range(1, self.maxiter + 1):
+            W = covdot(V)
+            # Rayleigh-Ritz: eigen decomposition in the subspace
+            w, S = eigh(np.dot(V.T, W))
+            w, S = w[::-1], S[:, ::-1]
+            V, W = np.dot(V, S), np.dot(W, S)
+            res = np.linalg.norm(W[:, :ncomp] - V[:, :ncomp] * w[:ncomp],
+                                 axis=0) / max(abs(w[0]), np.finfo(float).tiny)
+            if res.max() < self.tol:
+                self.converged_ = True
+                break
+            V = qr(W, mode='economic')[0]
+
+        self.n_iter_ = it
+        self.residuals_ = res
+        if not self.converged_:
+            logger.warning('Subspace iteration did not converge after %d '
+                           'iterations (residual %.2g), computing the full '
+                           'decomposition', it, res.max())
+            full = GramPCA(n_components=ncomp,
+                           blocksize=self.blocksize).fit(X)
+            for attr in ('components_', 'explained_variance_',
+                         'explained_variance_ratio_', 'singular_values_'):
+                setattr(self, attr, getattr(full, attr))
+            w = self.explained_variance_
+        else:
+            w = np.clip(w[:ncomp], 0, None)
+            self.components_ = np.ascontiguousarray(V[:, :ncomp].T)
+            self.explained_variance_ = w
+            sumsq = sum(np.einsum('ij,ij->', block, block)
+                        for block in self._blocks(X))
+            total = sumsq / norm - nsamples / norm * np.dot(mean, mean)
+            self.explained_variance_ratio_ = w / total
+            self.singular_values_ = np.sqrt(w * norm)
+
+        self.mean_ = mean
+        self.n_samples_ = nsamples
+        self.n_components_ = ncomp
+        self.n_features_in_ = nfeat
+        return self
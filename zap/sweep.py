@@ -0,0 +1,254 @@
+import copy
+import logging
+import numpy as np
+from astropy.table import Table
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import time
+from types import SimpleNamespace
+
+from .zap import ExecutionContext, Zap, _deviation
+
+__all__ = ['sweep']
+
+logger = logging.getLogger(__name__)
+
+
+def sweep(cubefits, cftypes=('median', ), cfwidths=(300, ), nevals=(None, ),
+          cfwidthSVD=None, clean=True, zlevel='median', mask=None,
+          ncpu=None, njobs=None, pca_class=None, n_components=None,
+          outcubefits=None, overwrite=False, context=None):
+    """Run ZAP with several combinations of parameters on the same cube.
+
+    The cube is read, NaN-cleaned, extracted and zlevel-subtracted only once.
+    Then the continuum filter is run once for each combination of ``cftypes``
+    and ``cfwidths``, and the SVD and reconstruction are run for each value of
+    ``nevals``. The variants are processed in parallel with threads, since
+    most of the time is spent in the linear algebra routines. A variant is
+    prepared only when one of the ``njobs`` threads is available, and its
+    arrays are released once it is done, so the memory used depends on
+    ``njobs`` and not on the number of variants.
+
+    Parameters
+    ----------
+    cubefits : str
+        Input FITS file, containing a cube with data in the first extension.
+    cftypes : list of str
+        Methods for the continuum filter.
+    cfwidths : list of int
+        Window sizes for the continuum filter (``cfwidthSP`` in
+        :func:`~zap.process`).
+    nevals : list
+        Number of eigenspectra used for the reconstruction, either an int, a
+        list with a value per segment, or None to use the automatic
+        selection done by :meth:`~zap.Zap.optimize`.
+    cfwidthSVD : int or float
+        Window size for the continuum filter used for the SVD computation.
+        If None (default), the same value than for the subtraction is used
+        for each variant. Otherwise the SVD is computed only once for each
+        ``cftype``.
+    clean : bool
+        If True (default value), the NaN values are cleaned.
+    zlevel : str
+        Method for the zeroth order sky removal: `none`, `sigclip` or `median`
+        (default).
+    mask : str or numpy.ndarray
+        A 2D mask (>=1 for objects, 0 for sky). The masked spaxels are
+        excluded from the zlevel and SVD computation, and from the residual
+        statistics.
+    ncpu : int
+        Number of processes used for the continuum filter.
+    njobs : int
+        Number of variants processed in parallel, by default the number of
+        processes of the context.
+    outcubefits : str
+        If given, the cleaned cube of each variant is saved. This must be a
+        pattern which can contain ``{cftype}``, ``{cfwidth}`` and ``{nevals}``
+        fields, e.g. ``'ZAP_{cftype}_{cfwidth}_{nevals}.fits'``.
+    overwrite : bool
+        Overwrite the output cubes if they exist.
+    context : `~zap.ExecutionContext`
+        Resources used for the run, by default a context with ``ncpu``
+        processes.
+
+    Returns
+    -------
+    astropy.table.Table
+        A summary table, with one row per variant giving the residual RMS on
+        the sky spaxels of the continuum-subtracted cleaned stack, and the time
+        spent for the continuum filter, the SVD and the reconstruction. For
+        the 'fastmedian' variants, if 'median' is also in ``cftypes``, the
+        ``cfdevmax`` and ``cfdevrms`` columns give the maximum and the RMS
+        deviation of the continuum from the exact median with the same width
+        (see :func:`~zap.fastmedian_deviation`).
+
+    """
+    logger.info('Running ZAP sweep on %s', cubefits)
+    t0 = time()
+    context = ExecutionContext.create(context, ncpu=ncpu)
+    with context.limits():
+        table = _sweep(cubefits, cftypes, cfwidths, nevals, cfwidthSVD, clean,
+                       zlevel, mask, njobs or context.ncpu, pca_class,
+                       n_components, outcubefits, overwrite, context)
+    logger.info('Sweep done! (took %.2f sec.)', time() - t0)
+    return table
+
+
+def _sweep(cubefits, cftypes, cfwidths, nevals, cfwidthSVD, clean, zlevel,
+           mask, njobs, pca_class, n_components, outcubefits, overwrite,
+           context):
+    # Shared preparation: nanclean, extract and zlevel
+    base = Zap(cubefits, pca_class=pca_class, n_components=n_components,
+               context=context)
+    if clean:
+        base._nanclean()
+    base._extract()
+    if mask is not None:
+        base._selectsky(mask)
+    if zlevel.lower() != 'none':
+        base._zlevel(calctype=zlevel)
+    else:
+        base.run_zlevel = 'none'
+
+    # The variants are prepared (continuum filter, which is already
+    # parallelized with processes) in this thread, and their SVD and
+    # reconstruction are run by the executor. At most njobs variants are
+    # alive at once, apart from the variants of the shared SVD and the
+    # median continua used for the deviation of the fastmedian ones.
+    pending = set()
+    bases, prepared, medians, cfdev, futures = {}, {}, {}, {}, {}
+
+    def wait_slot():
+        nonlocal pending
+        while len(pending) >= njobs:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+    def submit(func, *args, **kwargs):
+        future = executor.submit(func, *args, **kwargs)
+        pending.add(future)
+        return future
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        if cfwidthSVD is not None:
+            # Compute the shared SVD for each cftype, only the models are
+            # kept unless the variant is also run
+            for cftype in cftypes:
+                wait_slot()
+                futures[cftype] = submit(
+                    _fit_variant, _prepare_variant(base, cftype, cfwidthSVD))
+            for cftype in cftypes:
+                zobj = futures.pop(cftype).result()
+                bases[cftype] = SimpleNamespace(models=zobj.models,
+                                                _tsvd=zobj._tsvd)
+                if cfwidthSVD in cfwidths:
+                    prepared[cftype, cfwidthSVD] = zobj
+            zobj = None
+
+        # the median variants are prepared first, so their continuum is
+        # kept only until the fastmedian variant with the same width
+        order = sorted(cftypes, key=lambda cftype: cftype == 'fastmedian')
+        for cfwidth in cfwidths:
+            for cftype in order:
+                wait_slot()
+                zobj = prepared.pop((cftype, cfwidth), None)
+                if zobj is None:
+                    zobj = _prepare_variant(base, cftype, cfwidth)
+                if cftype == 'median' and 'fastmedian' in cftypes:
+                    medians[cfwidth] = zobj.contarray
+                elif cftype == 'fastmedian' and cfwidth in medians:
+                    # deviation of the continuum from the median one
+                    cfdev[cftype, cfwidth] = _deviation(
+                        zobj.contarray, medians.pop(cfwidth))
+                futures[cftype, cfwidth] = submit(
+                    _run_variant, zobj, nevals, basis=bases.get(cftype),
+                    outcubefits=outcubefits, overwrite=overwrite)
+                zobj = None
+
+        rows = [row for cftype in cftypes for cfwidth in cfwidths
+                for row in futures[cftype, cfwidth].result()]
+
+    table = Table(rows=rows, names=('cftype', 'cfwidth', 'nevals', 'auto',
+                                    'rms', 'tcont', 'tsvd', 'trecon',
+                                    'outcube'))
+    devs = [cfdev.get((row['cftype'], row['cfwidth']), (np.nan, np.nan))
+            for row in table]
+    table.add_columns([[d[0] for d in devs], [d[1] for d in devs]],
+                      indexes=[5, 5], names=['cfdevmax', 'cfdevrms'])
+    for col in ('rms', 'cfdevmax', 'cfdevrms', 'tcont', 'tsvd', 'trecon'):
+        table[col].format = '.4g'
+    if outcubefits is None:
+        table.remove_column('outcube')
+    return table
+
+
+def _prepare_variant(base, cftype, cfwidth):
+    """Continuum filter and normalization on a shallow copy of ``base``,
+    which shares the stack and the cube."""
+    zobj = copy.copy(base)
+    t0 = time()
+    zobj._continuumfilter(cfwidth=cfwidth, cftype=cftype)
+    zobj._normalize_variance()
+    zobj._tcont = time() - t0
+    zobj._tsvd = 0
+    return zobj
+
+
+def _fit_variant(zobj):
+    t0 = time()
+    zobj._msvd()
+    zobj._tsvd = time() - t0
+    return zobj
+
+
+def _run_variant(zobj, nevals, basis=None, outcubefits=None,
+                 overwrite=False):
+    if basis is None:
+        _fit_variant(zobj)
+        tsvd = zobj._tsvd
+    else:
+        # the components are modified by chooseevals, so the models must not
+        # be shared between threads
+        zobj.models = copy.deepcopy(basis.models)
+        tsvd = basis._tsvd
+    zobj.components = [m.components_.copy() for m in zobj.models]
+
+    rows = []
+    for nev in nevals:
+        t0 = time()
+        if nev is None:
+            zobj.optimize()
+            zobj.chooseevals(nevals=zobj.nevals)
+        else:
+            zobj.chooseevals(nevals=nev)
+        zobj.reconstruct()
+
+        res = zobj.stack - zobj.recon
+        if zobj.contarray is not None:
+            res -= zobj.contarray
+        if zobj.sky is not None:
+            res = res[:, zobj.sky]
+        rms = np.sqrt(np.mean(res**2))
+        del res
+
+        nevstr = ','.join(str(n) for n in np.ravel(zobj.nevals))
+        logger.info('cftype=%s cfwidth=%s nevals=%s: rms=%.4g',
+                    zobj._cftype, zobj._cfwidth, nevstr, rms)
+        trecon = time() - t0
+
+        outcube = ''
+        if outcubefits is not None:
+            outcube = outcubefits.format(
+                cftype=zobj._cftype, cfwidth=zobj._cfwidth,
+                nevals='auto' if nev is None else nevstr)
+            zobj.remold()
+            zobj.mergefits(outcube, overwrite=overwrite)
+            zobj.cleancube = None
+
+        rows.append((zobj._cftype, zobj._cfwidth, nevstr, nev is None, rms,
+                     zobj._tcont, tsvd, trecon, outcube))
+
+    # release the arrays of the variant
+    zobj.contarray = zobj.normstack = zobj.recon = zobj._coefs = None
+    zobj.models = zobj.components = None
+    return rows
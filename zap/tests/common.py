@@ -0,0 +1,59 @@
+import numpy as np
+from astropy.io import fits
+from numpy.testing import assert_allclose, assert_array_equal
+
+# Wavelength axis of the test cubes
+CRVAL3 = 4800.
+CDELT3 = 1.25
+
+
+def make_cube(nz=300, ny=14, nx=16, seed=0, nans=True):
+    """Return a MUSE-like cube with sky lines, noise, an emission-line
+    object, NaN edges and a few isolated NaNs, and its header."""
+    rng = np.random.default_rng(seed)
+    wave = CRVAL3 + CDELT3 * np.arange(nz)
+    lines = np.linspace(wave[10], wave[-10], 10)
+    sky = 10 + 50 * np.exp(-0.5 * ((wave[:, None] - lines) / 2)**2).sum(1)
+    cube = (sky[:, None, None] * (1 + 0.02 * rng.standard_normal((1, ny, nx)))
+            + rng.standard_normal((nz, ny, nx))).astype(np.float32)
+    cube[:, 5:8, 5:8] += (20 * np.exp(-0.5 * ((wave - 4990) / 20)**2)
+                          )[:, None, None]
+    if nans:
+        cube[:, 0, :3] = np.nan
+        cube[rng.integers(0, nz, 20), rng.integers(0, ny, 20),
+             rng.integers(0, nx, 20)] = np.nan
+
+    hdr = fits.Header()
+    hdr['CTYPE1'] = 'RA---TAN'
+    hdr['CTYPE2'] = 'DEC--TAN'
+    hdr['CRPIX1'] = nx / 2
+    hdr['CRPIX2'] = ny / 2
+    hdr['CRVAL1'] = 10.
+    hdr['CRVAL2'] = -30.
+    hdr['CD1_1'] = -5.5e-5
+    hdr['CD2_2'] = 5.5e-5
+    hdr['CTYPE3'] = 'AWAV'
+    hdr['CUNIT3'] = 'Angstrom'
+    hdr['CRPIX3'] = 1
+    hdr['CRVAL3'] = CRVAL3
+    hdr['CD3_3'] = CDELT3
+    return cube, hdr
+
+
+def write_muse_cube(path, **kwargs):
+    """Write a cube like the MUSE ones: empty primary HDU, DATA and STAT
+    extensions."""
+    cube, hdr = make_cube(**kwargs)
+    primary = fits.Header()
+    primary['INSTRUME'] = 'MUSE'
+    fits.HDUList([fits.PrimaryHDU(header=primary),
+                  fits.ImageHDU(cube, hdr, name='DATA'),
+                  fits.ImageHDU(np.ones_like(cube), hdr, name='STAT')]
+                 ).writeto(str(path))
+    return str(path)
+
+
+def assert_same_cube(a, b, atol=0):
+    """Check that two cubes have the same NaNs and close values."""
+    assert_array_equal(np.isnan(a), np.isnan(b))
+    assert_allclose(np.nan_to_num(a), np.nan_to_num(b), rtol=0, atol=atol)
@@ -0,0 +1,16 @@
+import pytest
+from astropy.io import fits
+
+from .common import write_muse_cube
+
+
+@pytest.fixture(scope='session')
+def cubefits(tmp_path_factory):
+    """Path of a small MUSE-like cube."""
+    return write_muse_cube(tmp_path_factory.mktemp('data') / 'CUBE.fits')
+
+
+@pytest.fixture
+def cube(cubefits):
+    """The data of the test cube."""
+    return fits.getdata(cubefits, extname='DATA')
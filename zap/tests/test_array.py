@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import zap
+
+from .common import CDELT3, CRVAL3, assert_same_cube
+
+
+@pytest.fixture(scope='module')
+def ref(cubefits):
+    return zap.process(cubefits, interactive=True, cfwidthSP=50)
+
+
+def test_process_array(cubefits, ref):
+    """A cube given as an array gives the same result as the file."""
+    data, header = fits.getdata(cubefits, extname='DATA', header=True)
+    orig = data.copy()
+    clean = zap.process_array(data, header, cfwidthSP=50)
+    assert_same_cube(clean, ref.cleancube, atol=1e-4)
+    assert_same_cube(data, orig)
+
+    wave = CRVAL3 + CDELT3 * np.arange(data.shape[0])
+    clean, sky = zap.process_array(data, wave=wave, cfwidthSP=50,
+                                   skycube=True)
+    assert_same_cube(clean, ref.cleancube, atol=1e-4)
+    assert_same_cube(sky, ref.make_skycube(), atol=1e-4)
+
+
+def test_process_array_inplace(cubefits, ref):
+    data, header = fits.getdata(cubefits, extname='DATA', header=True)
+    data = data.astype(np.float32)
+    clean = zap.process_array(data, header, cfwidthSP=50, inplace=True)
+    assert clean is data
+    assert_same_cube(data, ref.cleancube, atol=1e-4)
+
+
+def test_from_array(cube):
+    wave = CRVAL3 + CDELT3 * np.arange(cube.shape[0])
+    zobj = zap.Zap.from_array(cube, wave=wave)
+    assert zobj.cubefits is None
+    assert zobj.cube.shape == cube.shape
+
+    with pytest.raises(ValueError):
+        zap.Zap.from_array(cube)
+    with pytest.raises(ValueError):
+        zap.Zap.from_array(cube, header=fits.Header(), wave=wave)
+    with pytest.raises(ValueError):
+        zap.Zap.from_array(cube[0], wave=wave)
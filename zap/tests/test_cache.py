@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import zap
+from zap.cache import StageCache
+
+from .common import assert_same_cube, write_muse_cube
+
+
+def stages(cache):
+    return {key.split('-')[0] for key, _, _ in cache.entries()}
+
+
+def test_process_cache(cubefits, tmp_path):
+    """A run restored from the cache gives the same result."""
+    cache = StageCache(str(tmp_path / 'cache'))
+    ref = zap.process(cubefits, interactive=True, cfwidthSP=50)
+    first = zap.process(cubefits, interactive=True, cfwidthSP=50,
+                        cache=cache)
+    assert stages(cache) == {'extract', 'zlevel', 'continuum', 'normalize',
+                             'svd'}
+    keys = {key for key, _, _ in cache.entries()}
+    second = zap.process(cubefits, interactive=True, cfwidthSP=50,
+                         cache=str(tmp_path / 'cache'))
+    assert {key for key, _, _ in cache.entries()} == keys
+    assert_same_cube(first.cleancube, ref.cleancube)
+    assert_same_cube(second.cleancube, ref.cleancube)
+
+
+def test_process_cache_invalidation(cubefits, tmp_path):
+    """Changing a parameter only invalidates its stage and the next ones."""
+    cache = StageCache(str(tmp_path / 'cache'))
+    zap.process(cubefits, interactive=True, cfwidthSP=50, cache=cache)
+    keys = {key for key, _, _ in cache.entries()}
+    zobj = zap.process(cubefits, interactive=True, cfwidthSP=60,
+                       cache=cache)
+    added = {key.split('-')[0] for key, _, _ in cache.entries()
+             if key not in keys}
+    assert added == {'continuum', 'normalize', 'svd'}
+    ref = zap.process(cubefits, interactive=True, cfwidthSP=60)
+    assert_same_cube(zobj.cleancube, ref.cleancube)
+
+
+def test_stagecache(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'))
+    key = cache.key(None, 'stage', width=50, mask=np.ones(3))
+    assert key.startswith('stage-')
+    assert cache.key(None, 'stage', width=60, mask=np.ones(3)) != key
+    assert cache.key(None, 'stage', width=50, mask=np.zeros(3)) != key
+    assert cache.key('parent', 'stage', width=50, mask=np.ones(3)) != key
+    assert cache.load(key) is None
+
+    arr = np.arange(10.)
+    cache.save(key, {'arr': arr, 'models': [1, 'a'], 'flag': True})
+    data = cache.load(key)
+    assert_array_equal(data['arr'], arr)
+    assert data['models'] == [1, 'a'] and data['flag'] is True
+
+    # the arrays are copy-on-write
+    data['arr'][:] = 0
+    assert_array_equal(cache.load(key)['arr'], arr)
+
+    cache.clear()
+    assert cache.entries() == [] and cache.load(key) is None
+
+
+def test_stagecache_evict(tmp_path):
+    """The least recently used entries are removed to fit in maxsize."""
+    cache = StageCache(str(tmp_path / 'cache'), maxsize=3000)
+    arr = np.zeros(100)
+    for i, name in enumerate('abc'):
+        cache.save(name, {'arr': arr})
+        os.utime(os.path.join(cache.directory, name), (i, i))
+    cache.load('a')
+    cache.save('d', {'arr': arr})
+    assert sorted(key for key, _, _ in cache.entries()) == ['a', 'c', 'd']
+    assert cache.size <= 3000
+
+
+def test_checksum(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'))
+    filename = write_muse_cube(tmp_path / 'CUBE.fits')
+    checksum = cache.checksum(filename)
+    assert cache.checksum(filename) == checksum
+
+    # the checksum is computed again when the file changes
+    with open(filename, 'ab') as f:
+        f.write(b'\0' * 2880)
+    assert cache.checksum(filename) != checksum
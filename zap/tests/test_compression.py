@@ -0,0 +1,26 @@
+import pytest
+from astropy.io import fits
+
+import zap
+
+from .common import assert_same_cube
+
+
+@pytest.mark.parametrize('compress', ['lossless', 'RICE_1'])
+def test_compression(cubefits, tmp_path, compress):
+    """A compressed output can be read back, and used as input."""
+    out = str(tmp_path / 'OUT.fits')
+    zobj = zap.process(cubefits, cfwidthSP=50, interactive=True)
+    zobj.mergefits(out, compress=compress)
+    with fits.open(out) as hdul:
+        assert isinstance(hdul['DATA'], fits.CompImageHDU)
+        data = hdul['DATA'].data
+    if compress == 'lossless':
+        assert_same_cube(data, zobj.cleancube)
+    else:
+        assert_same_cube(data, zobj.cleancube, atol=0.2)
+
+    again = zap.process(out, interactive=True, cfwidthSP=50)
+    assert again.cube.shape == zobj.cube.shape
+
+
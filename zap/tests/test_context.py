@@ -0,0 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from numpy.testing import assert_array_equal
+
+import zap
+
+from .common import assert_same_cube
+
+
+def test_create():
+    context = zap.ExecutionContext.create(ncpu=3)
+    assert context.ncpu == 3
+    assert context.executor is None
+    assert zap.ExecutionContext.create(context) is context
+    assert zap.ExecutionContext.create(context, ncpu=3) is context
+    with pytest.raises(ValueError):
+        zap.ExecutionContext.create(context, ncpu=2)
+    assert zap.ExecutionContext().ncpu == zap.zap.NCPU
+    assert repr(context) == ('<ExecutionContext(ncpu=3, executor=None, '
+                             'nthreads=None, maxmem=None, nplanes=64)>')
+
+
+def test_process_context(cubefits):
+    """Runs with different contexts give the same result, without changing
+    the global NCPU."""
+    ncpu = zap.zap.NCPU
+    ref = zap.process(cubefits, interactive=True, cfwidthSP=50, ncpu=1)
+    assert ref.context.ncpu == 1
+    assert zap.zap.NCPU == ncpu
+
+    with ThreadPoolExecutor(3) as executor:
+        context = zap.ExecutionContext(ncpu=3, executor=executor, nplanes=7)
+        zobj = zap.process(cubefits, interactive=True, cfwidthSP=50,
+                           context=context)
+    assert zobj.context is context
+    assert zap.zap.NCPU == ncpu
+    assert_same_cube(zobj.cleancube, ref.cleancube, atol=1e-4)
+    assert_array_equal(zobj.nevals, ref.nevals)
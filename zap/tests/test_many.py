@@ -0,0 +1,111 @@
+import os
+import threading
+
+import pytest
+from astropy.io import fits
+
+import zap
+from zap.zap import MemoryBudget, _Stage, cube_nbytes
+
+from .common import assert_same_cube, write_muse_cube
+
+
+@pytest.fixture(scope='module')
+def exposures(cubefits, tmp_path_factory):
+    """Three exposures of the same field."""
+    tmpdir = tmp_path_factory.mktemp('many')
+    return [cubefits] + [write_muse_cube(tmpdir / 'CUBE{}.fits'.format(i),
+                                         seed=i) for i in (1, 2)]
+
+
+@pytest.mark.parametrize('batchsize', [1, 2])
+def test_process_many(exposures, tmp_path, batchsize):
+    """Each exposure gives the same result as process with the same SVD."""
+    svd = zap.SVDoutput(exposures[0], cfwidth=50)
+    outfiles = zap.process_many(
+        exposures, outcubefits=str(tmp_path / '{name}_{index}.fits'),
+        cfwidthSP=50, extSVD=svd, batchsize=batchsize, prefetch=1)
+
+    for i, (filename, outfile) in enumerate(zip(exposures, outfiles)):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        assert outfile == str(tmp_path / '{}_{}.fits'.format(name, i))
+        ref = zap.process(filename, interactive=True, cfwidthSP=50,
+                          extSVD=svd)
+        assert_same_cube(fits.getdata(outfile, extname='DATA'),
+                         ref.cleancube, atol=1e-4)
+
+
+def test_process_many_svd(exposures, tmp_path):
+    """Without extSVD, the SVD is computed on the first exposure."""
+    outfiles = [str(tmp_path / 'OUT{}.fits'.format(i)) for i in range(2)]
+    zap.process_many(exposures[1:], outcubefits=outfiles, cfwidthSVD=50,
+                     cfwidthSP=50)
+    svd = zap.SVDoutput(exposures[1], cfwidth=50)
+    ref = zap.process(exposures[2], interactive=True, cfwidthSP=50,
+                      extSVD=svd)
+    assert_same_cube(fits.getdata(outfiles[1], extname='DATA'),
+                     ref.cleancube, atol=1e-4)
+
+
+def test_process_many_invalid(exposures, tmp_path):
+    with pytest.raises(ValueError):
+        zap.process_many(exposures, outcubefits=['OUT.fits'])
+    outfile = str(tmp_path / 'OUT.fits')
+    open(outfile, 'w').close()
+    with pytest.raises(IOError):
+        zap.process_many(exposures[:1], outcubefits=[outfile])
+
+
+def test_memory_budget():
+    budget = MemoryBudget(100)
+    budget.acquire(150)       # always admitted when nothing is reserved
+    assert budget.used == 150
+
+    acquired = threading.Event()
+
+    def acquire():
+        budget.acquire(60)
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.2)
+    assert budget.waiting == 1
+    budget.release(150)
+    assert acquired.wait(5)
+    thread.join()
+    assert budget.used == 60
+
+    budget.acquire(40)
+    assert budget.used == 100
+    budget.close()
+    with pytest.raises(RuntimeError):
+        budget.acquire(10)
+
+
+def test_stage():
+    stage = _Stage(lambda x: 2 * x, range(5), 2)
+    assert list(stage) == [0, 2, 4, 6, 8]
+
+    stage = _Stage(lambda x: 1 / x, [1, 0], 1)
+    assert stage.get() == 1
+    with pytest.raises(ZeroDivisionError):
+        stage.get()
+
+
+def test_cube_nbytes(cubefits):
+    assert cube_nbytes(cubefits) == 300 * 14 * 16 * 4
+
+
+def test_process_many_maxmem(exposures, tmp_path):
+    """With a budget smaller than a batch, the exposures are processed one
+    by one and give the same result."""
+    svd = zap.SVDoutput(exposures[0], cfwidth=50)
+    kwargs = dict(cfwidthSP=50, extSVD=svd, batchsize=3)
+    ref = zap.process_many(exposures, str(tmp_path / 'REF{index}.fits'),
+                           **kwargs)
+    out = zap.process_many(exposures, str(tmp_path / 'OUT{index}.fits'),
+                           maxmem=cube_nbytes(exposures[0]), **kwargs)
+    for reffile, outfile in zip(ref, out):
+        assert_same_cube(fits.getdata(outfile, extname='DATA'),
+                         fits.getdata(reffile, extname='DATA'), atol=1e-4)
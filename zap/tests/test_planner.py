@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import zap
+from zap import GramPCA
+
+STAGES = ['read', 'nanclean', 'extract', 'zlevel', 'continuum', 'normalize',
+          'svd', 'reconstruct', 'remold', 'write']
+
+
+def test_plan(cubefits, cube):
+    p = zap.plan(cubefits, ncpu=2)
+    count = np.isnan(cube).sum(axis=0)
+    valid = count <= 0.25 * cube.shape[0]
+    assert p.shape == cube.shape
+    assert p.nspaxels == p.nsky == np.count_nonzero(valid)
+    assert p.nfix == count[valid].sum()
+    assert list(p.stages['stage']) == STAGES
+    assert p.peak == p.stages['memory'].max()
+    assert p.time == pytest.approx(p.stages['time'].sum())
+    assert p.context.ncpu == 2
+
+    # default settings of process, without limit
+    assert (p.svd, p.optimize) == ('pca', 'full')
+    assert p.within_limit
+    assert p.process_kwargs() == dict(pca_class=None, optimize='full',
+                                      context=p.context)
+    assert 'peak/total' in str(p)
+
+
+def test_plan_maxmem(cubefits):
+    """The settings are chosen to fit in the memory limit."""
+    plans = {(svd, opt): zap.plan(cubefits, svd=svd, optimize=opt)
+             for svd in ('pca', 'gram') for opt in ('full', 'incremental')}
+    default = plans['pca', 'full']
+    smallest = min(plans.values(), key=lambda p: p.peak)
+    assert smallest.peak < default.peak
+
+    p = zap.plan(cubefits, maxmem=default.peak - 1)
+    assert p.within_limit
+    assert p.peak < default.peak
+
+    p = zap.plan(cubefits, maxmem=1)
+    assert not p.within_limit
+    assert (p.svd, p.optimize) == (smallest.svd, smallest.optimize)
+    assert 'exceeds the limit' in str(p)
+
+
+def test_plan_skyseg(cubefits):
+    """The SVD estimates depend on the segments."""
+    stages = zap.plan(cubefits).stages
+    svd1 = stages[stages['stage'] == 'svd'][0]
+    stages = zap.plan(cubefits, skyseg=[4900, 5050]).stages
+    svd3 = stages[stages['stage'] == 'svd'][0]
+    assert svd3['memory'] < svd1['memory']
+    assert svd3['time'] != svd1['time']
+    assert zap.zap.SKYSEG == []
+
+
+def test_plan_invalid(cubefits):
+    with pytest.raises(ValueError):
+        zap.plan(cubefits, svd='lapack')
+    with pytest.raises(ValueError):
+        zap.plan(cubefits, optimize='fast')
+
+
+def test_plan_process(cubefits, tmp_path):
+    """The plan gives the parameters of process."""
+    p = zap.plan(cubefits, svd='gram', optimize='incremental', ncpu=1)
+    kwargs = p.process_kwargs()
+    assert kwargs['pca_class'] is GramPCA
+    zobj = zap.process(cubefits, interactive=True, cfwidthSP=50, **kwargs)
+    assert isinstance(zobj.models[0], GramPCA)
+    assert zobj.context is p.context
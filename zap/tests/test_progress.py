@@ -0,0 +1,51 @@
+import itertools
+import threading
+
+import pytest
+
+import zap
+
+STAGES = ['extract', 'zlevel', 'continuum', 'normalize', 'svd',
+          'reconstruct', 'remold', 'write']
+
+
+def test_progress(cubefits, tmp_path):
+    events = []
+    zap.process(cubefits, outcubefits=str(tmp_path / 'OUT.fits'),
+                cfwidthSP=50, ncpu=2, progress=events.append)
+    stages = [stage for stage, _ in itertools.groupby(e.stage for e in events)]
+    assert stages == STAGES
+
+    for stage, group in itertools.groupby(events, key=lambda e: e.stage):
+        fractions = [e.fraction for e in group]
+        assert fractions[0] == 0
+        assert all(0 <= f <= 1 for f in fractions)
+    assert events[0].eta is None
+    elapsed = [e.elapsed for e in events]
+    assert elapsed == sorted(elapsed)
+
+
+def test_cancel(cubefits, tmp_path):
+    outfile = tmp_path / 'OUT.fits'
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(zap.Cancelled):
+        zap.process(cubefits, outcubefits=str(outfile), cancel=cancel)
+    assert not outfile.exists()
+
+
+@pytest.mark.parametrize('stage', ['zlevel', 'continuum', 'svd'])
+def test_cancel_stage(cubefits, tmp_path, stage):
+    """The run stops at the next check after the event is set."""
+    cancel = threading.Event()
+    events = []
+
+    def progress(event):
+        events.append(event)
+        if event.stage == stage:
+            cancel.set()
+
+    with pytest.raises(zap.Cancelled, match=stage):
+        zap.process(cubefits, outcubefits=str(tmp_path / 'OUT.fits'),
+                    cfwidthSP=50, ncpu=2, progress=progress, cancel=cancel)
+    assert events[-1].stage == stage
@@ -0,0 +1,77 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+from astropy.io import fits
+
+import zap
+from zap.server import ZapServer
+
+from .common import assert_same_cube, write_muse_cube
+
+
+@pytest.fixture
+def server():
+    server = ZapServer(ncpu=2, nbases=1)
+    yield server
+    server.shutdown()
+
+
+def test_submit(server, cubefits, tmp_path):
+    """The jobs give the result of process, and reuse the SVD basis."""
+    assert isinstance(server.context.executor, ProcessPoolExecutor)
+    assert server.context.ncpu == 2
+
+    ref = str(tmp_path / 'REF.fits')
+    zap.process(cubefits, outcubefits=ref, cfwidthSP=50,
+                extSVD=zap.SVDoutput(cubefits, cfwidth=50))
+
+    results = []
+    for i in range(2):
+        out = str(tmp_path / 'OUT{}.fits'.format(i))
+        job = dict(cubefits=cubefits, outcubefits=out, cfwidthSP=50,
+                   extSVD=dict(cubefits=cubefits, cfwidth=50))
+        results.append(server.submit(job).result())
+        assert_same_cube(fits.getdata(out, extname='DATA'),
+                         fits.getdata(ref, extname='DATA'), atol=1e-4)
+
+    assert [res['basis_cached'] for res in results] == [False, True]
+    assert results[0]['outcubefits'] == str(tmp_path / 'OUT0.fits')
+    status = server.status()
+    assert status['done'] == 2
+    assert status['running'] == status['queued'] == status['memory'] == 0
+
+
+def test_basis_lru(server, cubefits, tmp_path):
+    """With nbases=1, a new basis evicts the previous one."""
+    other = write_muse_cube(tmp_path / 'OTHER.fits', seed=1)
+
+    def submit(svdcube):
+        job = dict(cubefits=cubefits, cfwidthSP=50,
+                   outcubefits=str(tmp_path / 'OUT.fits'), overwrite=True,
+                   extSVD=dict(cubefits=svdcube, cfwidth=50))
+        return server.submit(job).result()['basis_cached']
+
+    assert submit(cubefits) is False
+    assert submit(cubefits) is True
+    assert submit(other) is False
+    assert len(server.bases.keys()) == 1
+    assert submit(cubefits) is False
+
+
+def test_submit_invalid(server, cubefits):
+    with pytest.raises(ValueError):
+        server.submit(dict(outcubefits='OUT.fits'))
+    with pytest.raises(ValueError):
+        server.submit(dict(cubefits=cubefits, foo=1))
+    with pytest.raises(ValueError):
+        server.submit(dict(cubefits=cubefits, extSVD=dict(cfwidth=50)))
+
+
+def test_context_executor():
+    """An executor given with the context is used instead of a pool."""
+    with ThreadPoolExecutor(2) as executor:
+        context = zap.ExecutionContext(ncpu=2, executor=executor)
+        server = ZapServer(context=context)
+        assert server.context is context
+        assert server._pool is None
+        server.shutdown()
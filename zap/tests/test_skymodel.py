@@ -0,0 +1,25 @@
+import pytest
+
+import zap
+
+from .common import assert_same_cube
+
+
+def test_skymodel(cubefits, tmp_path):
+    """The sky reconstructed from the low-rank model is the sky cube."""
+    zobj = zap.process(cubefits, interactive=True, cfwidthSP=50)
+    skycube = zobj.make_skycube()
+    filename = str(tmp_path / 'SKYMODEL.fits')
+    zobj.writeskymodel(filename)
+
+    with zap.SkyModel(filename) as sky:
+        assert sky.shape == skycube.shape
+        assert_same_cube(sky.to_cube(), skycube, atol=1e-4)
+        assert_same_cube(sky[100:150, 2:6, 3], skycube[100:150, 2:6, 3],
+                         atol=1e-4)
+
+
+def test_skymodel_before_run(cubefits, tmp_path):
+    zobj = zap.Zap(cubefits)
+    with pytest.raises(ValueError):
+        zobj.writeskymodel(str(tmp_path / 'SKYMODEL.fits'))
@@ -0,0 +1,90 @@
+import pytest
+from astropy.io import fits
+from numpy.testing import assert_array_equal
+
+import zap
+from zap.storage import chunk_shape, cube_format
+
+
+@pytest.fixture(params=['h5', 'zarr'])
+def ext(request):
+    pytest.importorskip('h5py' if request.param == 'h5' else 'zarr')
+    return request.param
+
+
+def test_cube_format():
+    assert cube_format('cube.fits') == 'fits'
+    assert cube_format('cube.H5') == 'hdf5'
+    assert cube_format('cube.zarr/') == 'zarr'
+
+
+def test_chunk_shape():
+    shape = (3000, 300, 320)
+    assert chunk_shape(shape, 'spectra')[0] == 3000
+    assert chunk_shape(shape, 'planes')[1:] == (300, 320)
+    assert chunk_shape(shape, 'bricks')[1:] == (32, 32)
+    assert chunk_shape((10, 20, 30), (100, 5, 5)) == (10, 5, 5)
+    with pytest.raises(ValueError):
+        chunk_shape(shape, 'rows')
+    with pytest.raises(ValueError):
+        chunk_shape(shape, (1, 2))
+
+
+def test_open_fits(cubefits, cube):
+    with zap.open_cube(cubefits) as c:
+        assert c.format == 'fits'
+        assert c.instrument == 'MUSE'
+        assert c.shape == cube.shape
+        assert c.index == 1
+        assert not c.compressed
+        assert_array_equal(c.read(), cube)
+        assert_array_equal(c.section[10:20], cube[10:20])
+
+
+@pytest.mark.parametrize('chunks', ['spectra', 'planes', 'bricks'])
+def test_convert_cube(cubefits, cube, tmp_path, ext, chunks):
+    path = str(tmp_path / 'cube.{}'.format(ext))
+    zap.convert_cube(cubefits, path, chunks=chunks, nthreads=2)
+    with zap.open_cube(path) as c:
+        assert c.format == cube_format(path)
+        assert c.instrument == 'MUSE'
+        assert c.header['CRVAL3'] == fits.getheader(cubefits, 1)['CRVAL3']
+        assert c.chunks == chunk_shape(cube.shape, chunks)
+        assert c.compressed
+        assert_array_equal(c.read(nthreads=2), cube)
+
+    with pytest.raises(OSError):
+        zap.convert_cube(cubefits, path)
+
+
+def test_write_cube(cube, tmp_path, ext):
+    path = str(tmp_path / 'cube.{}'.format(ext))
+    header = fits.Header({'CRVAL3': 4800.})
+    zap.write_cube(path, cube, header, chunks=(50, 7, 8), compress=False)
+    with zap.open_cube(path) as c:
+        assert c.chunks == (50, 7, 8)
+        assert not c.compressed
+        assert c.header['CRVAL3'] == 4800.
+        assert_array_equal(c.read(), cube)
+
+
+def test_process_chunked(cubefits, tmp_path, ext):
+    """A chunked cube gives the same result as the FITS one, and the output
+    can be written in the same format."""
+    path = str(tmp_path / 'cube.{}'.format(ext))
+    zap.convert_cube(cubefits, path)
+    ref = zap.process(cubefits, cfwidthSP=50, interactive=True)
+    zobj = zap.process(path, cfwidthSP=50, interactive=True)
+    assert_array_equal(zobj.cleancube, ref.cleancube)
+
+    out = str(tmp_path / 'out.{}'.format(ext))
+    zobj.mergefits(out)
+    with zap.open_cube(out) as c:
+        assert_array_equal(c.read(), ref.cleancube)
+
+    # the FITS output has the primary header and a DATA extension
+    out = str(tmp_path / 'out.fits')
+    zobj.mergefits(out)
+    with fits.open(out) as hdul:
+        assert hdul[0].header['INSTRUME'] == 'MUSE'
+        assert_array_equal(hdul['DATA'].data, ref.cleancube)
@@ -0,0 +1,48 @@
+import pytest
+from astropy.io import fits
+
+import zap
+from zap.__main__ import main
+
+from .common import assert_same_cube
+
+# limits of the segments, giving 3 segments for the test cube
+SKYSEG = [4900, 5050]
+
+
+def test_process_stream(cubefits, tmp_path):
+    """The streaming mode gives the same result as process, with the chunks
+    used as segments."""
+    kwargs = dict(cfwidthSP=50, cfwidthSVD=100, skyseg=SKYSEG)
+    zobj = zap.process(cubefits, interactive=True, **kwargs)
+
+    out = str(tmp_path / 'STREAM.fits')
+    sky = str(tmp_path / 'SKY.fits')
+    zap.process_stream(cubefits, outcubefits=out, skycubefits=sky, **kwargs)
+    hdr = fits.getheader(out)
+    assert hdr['ZAPnseg'] == 3
+    assert [hdr['ZAPnev%d' % i] for i in range(3)] == list(zobj.nevals)
+    assert_same_cube(fits.getdata(out), zobj.cleancube, atol=1e-4)
+    assert_same_cube(fits.getdata(sky), zobj.make_skycube(), atol=1e-4)
+
+
+def test_process_stream_cftype(cubefits, tmp_path):
+    with pytest.raises(ValueError):
+        zap.process_stream(cubefits, str(tmp_path / 'OUT.fits'),
+                           cftype='fit')
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_main_skyseg(cubefits, tmp_path, stream):
+    """The segments given on the command line are passed to process, without
+    changing the module default."""
+    zobj = zap.process(cubefits, interactive=True, cfwidthSP=50,
+                       cfwidthSVD=50, skyseg=SKYSEG)
+    out = str(tmp_path / 'OUT.fits')
+    argv = [cubefits, '-o', out, '--cfwidthSP', '50', '--cfwidthSVD', '50',
+            '--skyseg', ','.join(str(x) for x in SKYSEG)]
+    main(argv + ['--stream'] if stream else argv)
+    assert zap.zap.SKYSEG == []
+    data, hdr = fits.getdata(out, extname='DATA', header=True)
+    assert hdr['ZAPnseg'] == 3
+    assert_same_cube(data, zobj.cleancube, atol=1e-4)
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+from sklearn.decomposition import PCA
+
+import zap
+from zap import GramPCA, SubspacePCA
+
+from .common import assert_same_cube, write_muse_cube
+
+
+@pytest.fixture
+def data():
+    """Low-rank float32 data with noise, like a normalized stack."""
+    rng = np.random.default_rng(0)
+    x = np.dot(rng.standard_normal((2000, 5)) * [10, 8, 6, 4, 2],
+               rng.standard_normal((5, 120)))
+    return (x + rng.standard_normal(x.shape) + 3).astype(np.float32)
+
+
+def assert_same_components(a, b, atol=1e-6):
+    # the sign of the components is arbitrary
+    assert_allclose(np.abs(np.sum(a * b, axis=1)), 1, atol=atol)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 3])
+def test_grampca(data, n_jobs):
+    ref = PCA(n_components=10).fit(data.astype(float))
+    pca = GramPCA(n_components=10, blocksize=300, n_jobs=n_jobs).fit(data)
+    assert pca.components_.shape == (10, 120)
+    assert_allclose(pca.mean_, ref.mean_, rtol=1e-6)
+    assert_allclose(pca.explained_variance_, ref.explained_variance_,
+                    rtol=1e-6)
+    assert_allclose(pca.explained_variance_ratio_,
+                    ref.explained_variance_ratio_, rtol=1e-6)
+    assert_same_components(pca.components_[:5], ref.components_[:5])
+
+    # round-trip on the subspace of the data
+    proj = pca.transform(data)
+    assert_allclose(pca.inverse_transform(proj), data, atol=5)
+
+
+def test_grampca_partial_fit(data, monkeypatch):
+    ref = GramPCA(n_components=5).fit(data)
+    pca = GramPCA(n_components=5)
+    calls = []
+    decompose = GramPCA._decompose
+    monkeypatch.setattr(GramPCA, '_decompose',
+                        lambda self: calls.append(1) or decompose(self))
+    for i in range(0, len(data), 700):
+        pca.partial_fit(data[i:i + 700])
+    assert pca.n_samples_ == len(data)
+
+    # the matrix is decomposed only once, when the model is used
+    assert not calls
+    assert_allclose(pca.explained_variance_, ref.explained_variance_,
+                    rtol=1e-8)
+    assert_same_components(pca.components_, ref.components_)
+    assert len(calls) == 1
+
+    # a new block invalidates the decomposition
+    pca.partial_fit(data[:10])
+    assert pca.n_components_ == 5
+    assert len(calls) == 2
+
+    with pytest.raises(AttributeError):
+        GramPCA().components_
+
+
+def test_process_grampca(cubefits):
+    ref = zap.process(cubefits, cfwidthSP=50, interactive=True)
+    zobj = zap.process(cubefits, cfwidthSP=50, pca_class=GramPCA,
+                       interactive=True)
+    assert isinstance(zobj.models[0], GramPCA)
+    assert list(zobj.nevals) == list(ref.nevals)
+    assert_same_cube(zobj.cleancube, ref.cleancube, atol=1e-3)
+
+
+def test_subspacepca(data):
+    ref = GramPCA(n_components=5).fit(data)
+    rng = np.random.default_rng(1)
+    init = ref.components_ + 0.05 * rng.standard_normal((5, 120))
+    pca = SubspacePCA(n_components=5, init=init, blocksize=500).fit(data)
+    assert pca.converged_
+    assert pca.n_iter_ < 20
+    assert_allclose(pca.explained_variance_, ref.explained_variance_,
+                    rtol=1e-6)
+    assert_allclose(pca.explained_variance_ratio_,
+                    ref.explained_variance_ratio_[:5], rtol=1e-6)
+    assert_same_components(pca.components_, ref.components_)
+
+
+def test_subspacepca_not_converged(data):
+    """The full decomposition is used if the iteration does not converge."""
+    ref = GramPCA(n_components=3).fit(data)
+    pca = SubspacePCA(n_components=3, maxiter=1).fit(data)
+    assert not pca.converged_
+    assert_allclose(pca.explained_variance_, ref.explained_variance_)
+
+
+def test_subspacepca_init_shape(data):
+    with pytest.raises(ValueError):
+        SubspacePCA(init=np.ones((2, 10))).fit(data)
+
+
+def test_process_initsvd(cubefits, tmp_path):
+    """Starting from the basis of another exposure gives the same result as
+    the full decomposition."""
+    other = write_muse_cube(tmp_path / 'OTHER.fits', seed=1)
+    skymodel = str(tmp_path / 'SKYMODEL.fits')
+    first = zap.process(cubefits, interactive=True, cfwidthSP=50)
+    first.writeskymodel(skymodel)
+    ref = zap.process(other, interactive=True, cfwidthSP=50,
+                      optimize='incremental')
+    for init in (first, skymodel):
+        zobj = zap.process(other, interactive=True, cfwidthSP=50,
+                           initSVD=init)
+        assert isinstance(zobj.models[0], SubspacePCA)
+        assert_array_equal(zobj.nevals, ref.nevals)
+        assert_same_cube(zobj.cleancube, ref.cleancube, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        zap.process(other, interactive=True, initSVD=first, extSVD=first)
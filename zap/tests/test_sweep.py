@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import zap
+
+from .common import assert_same_cube
+
+
+def test_sweep(cubefits, tmp_path):
+    out = str(tmp_path / 'ZAP_{cftype}_{cfwidth}_{nevals}.fits')
+    table = zap.sweep(cubefits, cftypes=('median', 'fastmedian'),
+                      cfwidths=(50, 80), nevals=(None, 3), outcubefits=out,
+                      njobs=2)
+    assert len(table) == 8
+    assert list(table['cftype']) == ['median'] * 4 + ['fastmedian'] * 4
+    assert list(table['cfwidth']) == [50, 50, 80, 80] * 2
+    assert list(table['auto']) == [True, False] * 4
+    assert (table['rms'] > 0).all()
+
+    # deviation of the fastmedian continuum from the median one
+    median = table['cftype'] == 'median'
+    assert np.isnan(table['cfdevmax'][median]).all()
+    assert (table['cfdevmax'][~median] > 0).all()
+    assert (table['cfdevrms'][~median] <= table['cfdevmax'][~median]).all()
+
+    # a variant gives the same cube as process with the same parameters
+    row = table[(table['cftype'] == 'median') & (table['cfwidth'] == 80) &
+                ~table['auto']][0]
+    assert row['nevals'] == '3'
+    ref = zap.process(cubefits, cfwidthSP=80, cfwidthSVD=80, nevals=[3],
+                      interactive=True)
+    assert_same_cube(fits.getdata(row['outcube'], extname='DATA'),
+                     ref.cleancube, atol=1e-4)
+
+
+@pytest.mark.parametrize('cfwidths', [(50, 80), (50, )])
+def test_sweep_shared_svd(cubefits, cfwidths):
+    """With cfwidthSVD the SVD is computed once per cftype, whether or not
+    cfwidthSVD is one of the variants."""
+    table = zap.sweep(cubefits, cfwidths=cfwidths, nevals=(3, ),
+                      cfwidthSVD=80, njobs=1)
+    assert list(table['cfwidth']) == list(cfwidths)
+    assert len(set(table['tsvd'])) == 1
+    assert 'outcube' not in table.colnames
+
+    # same as process, which computes the SVD with cfwidthSVD
+    ref = zap.process(cubefits, cfwidthSP=50, cfwidthSVD=80, nevals=[3],
+                      interactive=True)
+    res = ref.stack - ref.recon - ref.contarray
+    assert table['rms'][0] == pytest.approx(np.sqrt(np.mean(res**2)),
+                                            rel=1e-5)
@@ -0,0 +1,46 @@
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from zap import NanIndex, nan_edges_mask
+
+
+def test_nanindex(cube):
+    index = NanIndex(cube, nplanes=7)
+    nans = np.isnan(cube)
+    assert index.shape == cube.shape
+    assert index.nnan == nans.sum()
+    assert_array_equal(index.count, nans.sum(axis=0))
+    assert_array_equal(index.planes(), nans)
+    assert_array_equal(index.planes(10, 20), nans[10:20])
+
+    z, y, x = index.voxels()
+    assert_array_equal(np.stack(np.nonzero(nans)),
+                       np.stack(sorted(zip(z, y, x))).T)
+    assert index.isnan(z, y, x).all()
+    assert not index.isnan(np.array([1]), np.array([5]), np.array([5]))[0]
+
+    spaxels = np.zeros(cube.shape[1:], dtype=bool)
+    spaxels[1:] = True
+    z, y, x = index.voxels(spaxels=spaxels)
+    assert (y > 0).all()
+    assert len(z) == nans[:, 1:].sum()
+
+
+def test_nanindex_apply(cube):
+    index = NanIndex(cube)
+    data = np.nan_to_num(cube)
+    index.apply(data)
+    assert_array_equal(np.isnan(data), np.isnan(cube))
+
+    region = (slice(0, 5), slice(2, 8))
+    cutout = np.zeros((cube.shape[0], 5, 6))
+    index.apply(cutout, region=region)
+    assert_array_equal(np.isnan(cutout),
+                       np.isnan(cube[(slice(None), ) + region]))
+
+
+def test_nan_edges_mask(cube):
+    count = NanIndex(cube).count
+    mask = nan_edges_mask(count, cube.shape[0], threshold=50)
+    assert_array_equal(np.nonzero(mask), ([0, 0, 0], [0, 1, 2]))
+    assert not nan_edges_mask(count * 0, cube.shape[0]).any()
@@ -0,0 +1,90 @@
+import os
+import time
+
+import pytest
+
+import zap
+from zap.workqueue import WorkQueue, _partial
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WorkQueue(str(tmp_path / 'queue'), timeout=600, max_attempts=2)
+
+
+def test_add(queue, cubefits, tmp_path):
+    out = str(tmp_path / '{name}_ZAP.fits')
+    jobid = queue.add(cubefits, outcubefits=out, cfwidthSP=50)
+    assert queue.status() == dict(pending=1, running=0, done=0, failed=0)
+    # the same cube is not added twice
+    assert queue.add(cubefits) is None
+    assert queue.jobs() == [jobid]
+
+    job = queue.claim('worker1')
+    assert job['id'] == jobid
+    assert job['params']['outcubefits'] == str(tmp_path / 'CUBE_ZAP.fits')
+    assert queue.claim('worker2') is None
+    assert queue.status()['running'] == 1
+
+    with pytest.raises(ValueError):
+        queue.add(cubefits, unknown=1)
+
+
+def test_claims(queue, cubefits):
+    """A requeued job is no more owned by its first worker."""
+    queue.add(cubefits)
+    first = queue.claim('worker1')
+    assert queue.owns(first)
+    queue.heartbeat(first)
+
+    queue.timeout = 0
+    time.sleep(0.01)
+    assert queue.requeue_stale() == [first['id']]
+    queue.timeout = 600
+    second = queue.claim('worker2')
+    assert second['attempts'] == 1
+    assert second['claim'] != first['claim']
+    assert _partial('a.fits', first['claim']) != \
+        _partial('a.fits', second['claim'])
+
+    assert not queue.owns(first)
+    with pytest.raises(FileNotFoundError):
+        queue.heartbeat(first)
+    queue.release(first)
+    queue.fail(first, 'error')
+    assert queue.status() == dict(pending=0, running=1, done=0, failed=0)
+
+    queue.release(second)
+    assert queue.status() == dict(pending=1, running=0, done=0, failed=0)
+    assert queue.claim('worker3')['worker'] == 'worker3'
+
+
+def test_fail(queue, cubefits):
+    queue.add(cubefits)
+    queue.fail(queue.claim(), 'error')
+    assert queue.status()['pending'] == 1
+    queue.fail(queue.claim(), 'error')
+    assert queue.status()['failed'] == 1
+    assert queue.results('failed')[0]['error'] == 'error'
+
+    # a failed job can be queued again
+    assert queue.add(cubefits) is not None
+
+
+def test_run_worker(queue, cubefits, tmp_path):
+    out = str(tmp_path / '{name}_ZAP.fits')
+    queue.add(cubefits, outcubefits=out, cfwidthSP=50)
+    queue.add(str(tmp_path / 'missing.fits'), outcubefits=out)
+
+    assert zap.run_worker(queue.path, max_attempts=1) == 2
+    assert queue.status() == dict(pending=0, running=0, done=1, failed=1)
+    result, = queue.results()
+    assert os.path.exists(result['outputs']['outcubefits'])
+    assert result['size'] == os.path.getsize(cubefits)
+    assert result['duration'] > 0
+    assert result['maxrss'] is None or result['maxrss'] > 0
+    assert {'extract', 'svd'} <= set(result['stages'])
+    assert not [f for f in os.listdir(str(tmp_path)) if '.partial' in f]
+
+    # the done jobs are skipped
+    assert queue.add(cubefits, outcubefits=out) is None
@@ -0,0 +1,276 @@
+import shutil
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from numpy.testing import assert_allclose, assert_array_equal
+from scipy.stats import sigmaclip
+from sklearn.decomposition import PCA
+
+import zap
+from zap.zap import (_estimate_nevals, _extract_stack, _icffastmedian,
+                     _icfmedian, _insert_stack, _isigclip, _median_planes,
+                     _nanclean, _optimal_ncomp)
+
+from .common import assert_same_cube
+
+
+def test_process(cubefits, tmp_path):
+    out = str(tmp_path / 'OUT.fits')
+    zap.process(cubefits, outcubefits=out, cfwidthSP=50)
+    zobj = zap.process(cubefits, cfwidthSP=50, interactive=True)
+    with fits.open(out) as hdul:
+        assert [hdu.name for hdu in hdul] == ['PRIMARY', 'DATA', 'STAT']
+        assert hdul['DATA'].header['ZAPnseg'] == 1
+        assert_same_cube(hdul['DATA'].data, zobj.cleancube)
+
+    # the sky is removed, and the masked values stay NaN
+    data = fits.getdata(cubefits, extname='DATA')
+    assert_array_equal(np.isnan(zobj.cleancube), np.isnan(data))
+    assert np.nanstd(zobj.cleancube) < 0.5 * np.nanstd(data)
+
+
+@pytest.mark.parametrize('mask', [False, True])
+def test_process_dual_width(cubefits, tmp_path, mask):
+    """Preparing the cube once for both widths (and the mask) gives the same
+    result as computing the SVD in a separate run."""
+    if mask:
+        data = np.zeros(fits.getdata(cubefits, extname='DATA').shape[1:])
+        data[4:9, 4:9] = 1
+        mask = str(tmp_path / 'MASK.fits')
+        fits.writeto(mask, data)
+    else:
+        mask = None
+    zobj = zap.process(cubefits, cfwidthSP=50, cfwidthSVD=80, mask=mask,
+                       interactive=True)
+    assert zobj.contarraySVD is None
+
+    svd = zap.SVDoutput(cubefits, cfwidth=80, mask=mask)
+    ref = zap.process(cubefits, cfwidthSP=50, extSVD=svd, interactive=True)
+    assert_array_equal(zobj.nevals, ref.nevals)
+    assert_same_cube(zobj.cleancube, ref.cleancube, atol=1e-4)
+
+
+def test_estimate_nevals():
+    """The incremental criterion gives the same number of components as the
+    one computed on the full SVD."""
+    rng = np.random.default_rng(0)
+    x = np.dot(rng.standard_normal((3000, 8)) * np.arange(16, 0, -2),
+               rng.standard_normal((8, 400)))
+    x = (x + rng.standard_normal(x.shape)).astype(np.float32)
+    nev, neig = _estimate_nevals(x, blocksize=500)
+    full = PCA().fit(x.astype(float))
+    assert nev == _optimal_ncomp(full.explained_variance_)
+    assert nev <= neig < 100
+
+
+def test_process_incremental(cubefits):
+    ref = zap.process(cubefits, cfwidthSP=50, interactive=True)
+    zobj = zap.process(cubefits, cfwidthSP=50, optimize='incremental',
+                       interactive=True)
+    assert_array_equal(zobj.nevals, ref.nevals)
+    assert all(n <= m for n, m in zip(zobj.nevals, zobj.maxcomp))
+    # only the needed eigenvectors are computed
+    assert zobj.models[0].n_components_ == zobj.maxcomp[0]
+    assert zobj.maxcomp[0] < min(zobj.stack.shape)
+    assert_same_cube(zobj.cleancube, ref.cleancube, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        zap.process(cubefits, optimize='fast', interactive=True)
+
+
+def test_nancube(cubefits, cube):
+    """nancube gives the interpolated NaN values, i.e. those of the spaxels
+    which are not rejected."""
+    zobj = zap.process(cubefits, cfwidthSP=50, interactive=True)
+    nans = np.isnan(cube)
+    expected = nans & (nans.sum(axis=0) <= 0.25 * cube.shape[0])
+    assert expected.sum() == 20
+    assert_array_equal(zobj.nancube, expected)
+    assert zap.process(cubefits, clean=False, cfwidthSP=50,
+                       interactive=True).nancube is None
+
+
+@pytest.mark.parametrize('nplanes', [1, 7, 64, 500])
+def test_extract_stack(cube, nplanes):
+    """The stack is extracted by blocks of planes, in Fortran order."""
+    y, x = np.nonzero(~np.isnan(cube).any(axis=0))
+    data = cube.astype('>f4')
+    stack = _extract_stack(data, y, x, nplanes=nplanes)
+    assert stack.flags.f_contiguous
+    assert stack.dtype.isnative
+    assert_array_equal(stack, cube[:, y, x])
+
+    out = np.zeros_like(cube)
+    _insert_stack(out, stack, y, x, nplanes=nplanes)
+    assert_array_equal(out[:, y, x], cube[:, y, x])
+
+
+def test_extract(cubefits, cube):
+    """The interpolated NaN values are inserted in the stack, and the cube is
+    not modified."""
+    zobj = zap.Zap(cubefits)
+    zobj._nanclean()
+    zobj._extract()
+    (z, y, x, values), _, _ = _nanclean(cube.copy())
+    expected = cube.copy()
+    expected[z, y, x] = values
+    assert_array_equal(zobj.stack, expected[:, zobj.y, zobj.x])
+    assert_same_cube(zobj.cube, cube)
+    assert len(zobj.x) == 221
+
+
+def test_isigclip():
+    stack = np.asfortranarray(
+        np.random.default_rng(0).standard_normal((100, 50)))
+    stack[:, 0] = 100
+    expected = [sigmaclip(row, low=3, high=3)[0].mean() for row in stack]
+    assert_allclose(_isigclip(0, stack, nplanes=16), expected)
+
+
+def test_fastmedian():
+    rng = np.random.default_rng(0)
+    stack = (np.linspace(0, 10, 400)[:, None] +
+             rng.standard_normal((400, 20))).astype(np.float32)
+    fast, = _icffastmedian(0, stack, cfwidth=[50])
+    exact, = _icfmedian(0, stack, cfwidth=[50])
+    # exact on the coarse grid
+    assert_allclose(fast[::5], exact[::5], rtol=1e-6)
+
+    maxdev, rmsdev = zap.fastmedian_deviation(stack, cfwidth=50)
+    assert maxdev == pytest.approx(np.abs(fast - exact).max(), rel=1e-5)
+    assert 0 < rmsdev <= maxdev < 1
+
+
+@pytest.mark.parametrize('nz', [0, 1, 2])
+def test_fastmedian_short(nz):
+    """Stacks with less planes than the window are supported."""
+    stack = np.arange(nz * 3, dtype=np.float32).reshape(nz, 3)
+    fast, = _icffastmedian(0, stack, cfwidth=[50])
+    exact, = _icfmedian(0, stack, cfwidth=[50])
+    assert fast.shape == stack.shape
+    assert not np.isnan(fast).any()
+    assert_allclose(fast, exact)
+
+
+def test_process_fastmedian(cubefits):
+    ref = zap.process(cubefits, cfwidthSP=50, interactive=True)
+    zobj = zap.process(cubefits, cfwidthSP=50, cftype='fastmedian',
+                       interactive=True)
+    assert zobj._cftype == 'fastmedian'
+    assert_same_cube(zobj.cleancube, ref.cleancube, atol=0.5)
+
+
+def test_roi(cubefits, tmp_path):
+    zap.zap._roi_bases.clear()
+    full = zap.process(cubefits, interactive=True, cfwidthSP=50)
+    roi = (slice(3, 10), slice(4, 12))
+    out = str(tmp_path / 'ROI.fits')
+    skymodel = str(tmp_path / 'SKYMODEL.fits')
+    zobj = zap.process(cubefits, cfwidthSP=50, roi=roi, interactive=True)
+    zobj.mergefits(out)
+    zobj.writeskymodel(skymodel)
+    assert_same_cube(zobj.cleancube, full.cleancube[(slice(None), ) + roi],
+                     atol=1e-4)
+
+    # all the images of the file are cropped, with the same WCS
+    with fits.open(out) as hdul:
+        for name in ('DATA', 'STAT'):
+            assert hdul[name].shape == zobj.cleancube.shape
+            assert hdul[name].header['CRPIX1'] == 16 / 2 - 4
+            assert hdul[name].header['CRPIX2'] == 14 / 2 - 3
+
+    # the sky model is stored in the frame of the full cube
+    assert fits.getheader(skymodel)['CRPIX1'] == 16 / 2
+    with zap.SkyModel(skymodel) as sky:
+        assert sky.shape == full.cube.shape
+        assert_allclose(sky[(slice(None), ) + roi],
+                        zobj.make_skycube(), atol=1e-4)
+
+    # the full-field basis is reused for another region
+    assert len(zap.zap._roi_bases.keys()) == 1
+    zap.process(cubefits, cfwidthSP=50, roi=(slice(0, 4), slice(0, 4)),
+                interactive=True)
+    assert len(zap.zap._roi_bases.keys()) == 1
+
+
+
+def test_mask_nan_edges(cube):
+    orig = cube.copy()
+    mask, masked = zap.mask_nan_edges(cube, threshold=50)
+    assert mask.sum() == 3
+    assert np.isnan(masked[:, mask]).all()
+    assert_array_equal(np.isnan(cube), np.isnan(orig))
+
+    mask, masked = zap.mask_nan_edges(cube, threshold=50, inplace=True)
+    assert masked is cube
+
+
+def test_process_maskedges(cubefits, tmp_path):
+    """Spaxels of the edges with many NaNs are masked before the SVD."""
+    edges = str(tmp_path / 'EDGES.fits')
+    masked = str(tmp_path / 'MASKED.fits')
+    for filename, nz in ((edges, 200), (masked, None)):
+        shutil.copy(cubefits, filename)
+        with fits.open(filename, mode='update') as hdul:
+            hdul['DATA'].data[:nz, 0, 3] = np.nan
+            hdul['DATA'].data[:nz, 1, :2] = np.nan
+
+    zobj = zap.process(edges, interactive=True, cfwidthSP=50,
+                       maskedges=50)
+    ref = zap.process(masked, interactive=True, cfwidthSP=50)
+    assert np.isnan(zobj.cleancube[:, 0, :4]).all()
+    assert np.isnan(zobj.cleancube[:, 1, :2]).all()
+    assert_same_cube(zobj.cleancube, ref.cleancube, atol=1e-4)
+
+
+@pytest.mark.parametrize('nthreads,nplanes', [(1, 64), (3, 7)])
+@pytest.mark.parametrize('nspec', [20, 21])
+def test_median_planes(nthreads, nplanes, nspec):
+    rng = np.random.default_rng(0)
+    stack = rng.standard_normal((100, nspec)).astype(np.float32)
+    stack[10, 3] = np.nan
+    orig = stack.copy()
+    zl = _median_planes(stack, nthreads=nthreads, nplanes=nplanes)
+    assert_array_equal(zl, np.median(stack, axis=1))
+    assert_array_equal(stack, orig)
+
+    index = np.arange(1, nspec, 2)
+    zl = _median_planes(stack, index=index, nthreads=nthreads,
+                        nplanes=nplanes)
+    assert_array_equal(zl, np.median(stack[:, index], axis=1))
+    assert np.isnan(_median_planes(stack, index=[])).all()
+
+
+@pytest.mark.parametrize('ncpu', [1, 3])
+@pytest.mark.parametrize('sky', [False, True])
+def test_zlevel_median(cubefits, ncpu, sky):
+    """The median zlevel is the median of the planes of the stack, on the sky
+    spaxels if a mask is given."""
+    zobj = zap.Zap(cubefits, context=zap.ExecutionContext(ncpu=ncpu))
+    zobj._nanclean()
+    zobj._extract()
+    if sky:
+        mask = np.zeros(zobj.cube.shape[1:], dtype=int)
+        mask[5:8, 5:8] = 1
+        zobj._selectsky(mask)
+        stack = zobj.stack[:, zobj.sky].copy()
+    else:
+        stack = zobj.stack.copy()
+    zobj._zlevel(calctype='median')
+    assert_array_equal(zobj.zlsky, np.median(stack, axis=1))
+
+
+@pytest.mark.parametrize('params', [dict(cfwidth=30), dict(zlevel='sigclip'),
+                                    dict(nevals=[2]),
+                                    dict(cftype='fastmedian')])
+def test_set(cubefits, params):
+    """Recomputing the invalidated stages gives the same result as a fresh
+    run."""
+    zobj = zap.process(cubefits, interactive=True, cfwidthSP=50)
+    zobj.set(**params)
+
+    kwargs = dict(cfwidthSP=params.pop('cfwidth', 50), **params)
+    ref = zap.process(cubefits, interactive=True, **kwargs)
+    assert_array_equal(np.ravel(zobj.nevals), np.ravel(ref.nevals))
+    assert_same_cube(zobj.cleancube, ref.cleancube, atol=1e-4)
@@ -3,11 +3,122 @@ import numpy as np
 from astropy.io import fits
 from scipy import ndimage as ndi
 
-__all__ = ['mask_nan_edges']
+__all__ = ['mask_nan_edges', 'nan_edges_mask', 'NanIndex']
+
+
+class NanIndex(object):
+
+    """Compact index of the NaN values of a cube.
+
+    The NaN map is computed in a single pass over the cube, by chunks of
+    planes, and stored as a bit-packed array (one bit per voxel, i.e. 8 times
+    less than a boolean cube), with the number of NaNs per spaxel.
+
+    Parameters
+    ----------
+    cube : ndarray
+        The (nz, ny, nx) cube, can be a memory-mapped array.
+    nplanes : int
+        Number of planes processed at once.
+
+    Attributes
+    ----------
+    count : ndarray
+        The (ny, nx) map of the number of NaNs per spaxel.
+    bits : ndarray
+        The (nz, nbytes) array of bit-packed NaN maps for each plane.
+
+    """
+
+    def __init__(self, cube, nplanes=64):
+        self.shape = cube.shape
+        self.nplanes = nplanes
+        nz, ny, nx = cube.shape
+        self.count = np.zeros((ny, nx), dtype=int)
+        self.bits = np.empty((nz, (ny * nx + 7) // 8), dtype=np.uint8)
+        for k in range(0, nz, nplanes):
+            bad = ~np.isfinite(cube[k:k + nplanes])
+            self.count += bad.sum(axis=0)
+            self.bits[k:k + nplanes] = np.packbits(
+                bad.reshape(bad.shape[0], -1), axis=1)
+
+    def __repr__(self):
+        return '<NanIndex(shape={}, nnan={})>'.format(self.shape, self.nnan)
+
+    @property
+    def nnan(self):
+        """Total number of NaN values."""
+        return int(self.count.sum())
+
+    def planes(self, start=0, stop=None):
+        """Return the boolean NaN map for a range of planes."""
+        nz, ny, nx = self.shape
+        bits = self.bits[start:stop]
+        bad = np.unpackbits(bits, axis=1, count=ny * nx).astype(bool)
+        return bad.reshape(bits.shape[0], ny, nx)
+
+    def chunks(self):
+        """Iterate on (start, stop, NaN map) for chunks of planes."""
+        for k in range(0, self.shape[0], self.nplanes):
+            stop = min(k + self.nplanes, self.shape[0])
+            yield k, stop, self.planes(k, stop)
+
+    def voxels(self, spaxels=None):
+        """Return the (z, y, x) positions of the NaNs, optionally only for
+        the spaxels selected by a (ny, nx) boolean array."""
+        pos = []
+        for start, stop, bad in self.chunks():
+            if spaxels is not None:
+                bad &= spaxels
+            z, y, x = np.nonzero(bad)
+            pos.append((z + start, y, x))
+        return tuple(np.concatenate(p) for p in zip(*pos))
+
+    def isnan(self, z, y, x):
+        """Return True for the (z, y, x) voxels which are NaN."""
+        flat = y * self.shape[2] + x
+        bits = self.bits[z, flat // 8]
+        return ((bits >> (7 - flat % 8)) & 1).astype(bool)
+
+    def apply(self, cube, spaxels=None, value=np.nan, region=None):
+        """Set NaN (or ``value``) in cube, chunk by chunk, optionally only
+        for the spaxels selected by a (ny, nx) boolean array. If ``cube`` is
+        a cutout, ``region`` gives the (y, x) slices of the index it covers.
+        """
+        for start, stop, bad in self.chunks():
+            if spaxels is not None:
+                bad &= spaxels
+            if region is not None:
+                bad = bad[(slice(None), ) + tuple(region)]
+            cube[start:stop][bad] = value
+        return cube
+
+
+def nan_edges_mask(count, nz, threshold=50):
+    """Compute the mask of the edges from the number of NaNs per spaxel.
+
+    The spaxels with more than ``threshold`` percent of NaNs are labeled, and
+    the biggest connected region is selected.
+
+    """
+    logger = logging.getLogger(__name__)
+    mask = (100 / nz) * count > threshold
+    labels, nlabels = ndi.label(mask)
+    if nlabels == 0:
+        logger.warning('Nothing masked')
+        return mask
+
+    # area of each region, the background (label 0) is excluded
+    area = np.bincount(labels.ravel())
+    area[0] = 0
+    mask = labels == np.argmax(area)
+    logger.info('%i label(s), selected one contain %i pixels', nlabels,
+                area.max())
+    return mask
 
 
 def mask_nan_edges(cube, outfile=None, plot=False, threshold=50,
-                   extname='DATA'):
+                   extname='DATA', nanindex=None, inplace=False):
     """Mask the edges of a cube, using the number of nans in a spaxel.
 
     At the edges of MUSE cubes, spaxels can contain many NaNs in the spectral
@@ -30,6 +141,11 @@ def mask_nan_edges(cube, outfile=None, plot=False, threshold=50,
         Percentage of NaNs above which the spaxel will be masked.
     extname : str
         Extension name for the data, defaults to DATA.
+    nanindex : `~zap.NanIndex`
+        NaN index of the cube, computed if not given.
+    inplace : bool
+        If ``cube`` is an array, mask it in place instead of returning a
+        masked copy (default: False).
 
     Returns
     -------
@@ -44,22 +160,19 @@ def mask_nan_edges(cube, outfile=None, plot=False, threshold=50,
     else:
         data = cube
 
-    nans = (100 / data.shape[0]) * np.sum(np.isnan(data), axis=0)
-    mask = nans > threshold
-    labels, nlabels = ndi.label(mask)
-
-    if nlabels > 0:
-        area = [np.sum(mask[labels == l]) for l in range(1, nlabels + 1)]
-        mask = labels == (np.argmax(area) + 1)
-        logger.info('%i label(s), selected one contain %i pixels', nlabels,
-                    np.sum(mask))
-    else:
-        logger.warning('Nothing masked')
+    if nanindex is None:
+        nanindex = NanIndex(data)
+    mask = nan_edges_mask(nanindex.count, data.shape[0], threshold=threshold)
+    if not mask.any():
         return mask, data
 
     if plot:
         im = np.nanmean(data, axis=0)
 
+    if data is cube and not inplace:
+        data = data.copy()
+    data[:, mask] = np.nan
+
     if outfile is not None:
         if not isinstance(cube, str):
             raise ValueError('cannot save the file if the output was given '
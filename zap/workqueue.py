@@ -0,0 +1,420 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import traceback
+import uuid
+from glob import glob
+from time import time
+
+from .server import PROCESS_PARAMS
+from .zap import process, Cancelled, ExecutionContext
+
+__all__ = ['WorkQueue', 'run_worker']
+
+logger = logging.getLogger(__name__)
+
+# sub-directories of a queue, one per state of the jobs
+QUEUE_STATES = ('pending', 'running', 'done', 'failed')
+
+# parameters of the jobs giving output files
+OUTPUT_PARAMS = ('outcubefits', 'skycubefits', 'skymodelfits',
+                 'varcurvefits')
+
+
+def _job_id(cubefits):
+    """Return the id of the job of a cube, from its name and its absolute
+    path, so adding again the same cube gives the same job."""
+    path = os.path.abspath(cubefits)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return '{}-{}'.format(name, hashlib.sha1(path.encode()).hexdigest()[:10])
+
+
+def _partial(filename, claim):
+    """Return the name used while an output file is written, unique for each
+    claim of the job."""
+    root, ext = os.path.splitext(filename)
+    return '{}.partial-{}{}'.format(root, claim, ext)
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, content):
+    """Write a JSON file atomically: it is written with a temporary name in
+    the same directory and then renamed."""
+    tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp, 'w') as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+class WorkQueue(object):
+
+    """A queue of ZAP jobs in a directory of a shared filesystem, without a
+    central broker.
+
+    Each job is a JSON file, moved between the ``pending``, ``running``,
+    ``done`` and ``failed`` sub-directories with atomic renames, so several
+    workers on different nodes can claim jobs concurrently: only one of them
+    succeeds in renaming a pending job. A worker touches the file of its
+    running job periodically, and a running job which was not touched for
+    ``timeout`` seconds (e.g. because the node was killed) is put back in the
+    queue by the next worker looking for a job; its first worker then leaves
+    it to the new one, and the outputs are written with names unique to each
+    claim so they do not collide. The completion marker in ``done`` contains
+    the timings and metrics of the job, and adding again a cube whose job is
+    done (or still queued) does nothing, so a restarted run skips the
+    finished cubes.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the queue, created if needed.
+    timeout : float
+        Time in seconds after which a running job that is not updated is
+        considered lost.
+    max_attempts : int
+        Number of times a job is tried before being moved to ``failed``.
+
+    """
+
+    def __init__(self, path, timeout=600, max_attempts=3):
+        self.path = path
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        for state in QUEUE_STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def __repr__(self):
+        return '<WorkQueue({}, {})>'.format(self.path, ', '.join(
+            '{}={}'.format(k, v) for k, v in self.status().items()))
+
+    def _path(self, state, jobid):
+        return os.path.join(self.path, state, jobid + '.json')
+
+    def jobs(self, state='pending'):
+        """Return the ids of the jobs in the given state, the oldest first."""
+        files = []
+        for f in glob(os.path.join(self.path, state, '*.json')):
+            try:
+                files.append((os.path.getmtime(f), f))
+            except FileNotFoundError:
+                # moved by another worker
+                continue
+        return [os.path.basename(f)[:-5] for _, f in sorted(files)]
+
+    def status(self):
+        """Return the number of jobs in each state."""
+        return {state: len(self.jobs(state)) for state in QUEUE_STATES}
+
+    def results(self, state='done'):
+        """Return the records of the finished (or failed) jobs, with their
+        timings and metrics."""
+        return [_read_json(self._path(state, jobid))
+                for jobid in self.jobs(state)]
+
+    def add(self, cubefits, outcubefits='{name}_ZAP.fits', **params):
+        """Add a job to process ``cubefits`` with the parameters of
+        :func:`~zap.process`.
+
+        The output paths can contain ``{name}`` (the input file name without
+        extension), and are made absolute as the workers may run in another
+        directory. Returns the id of the job, or None if the job is already
+        done, queued or running. A failed job is queued again.
+
+        """
+        unknown = set(params) - set(PROCESS_PARAMS)
+        if unknown:
+            raise ValueError('unknown parameters: {}'.format(
+                ', '.join(sorted(unknown))))
+        params['outcubefits'] = outcubefits
+        name = os.path.splitext(os.path.basename(cubefits))[0]
+        for key in OUTPUT_PARAMS + ('mask', ):
+            if isinstance(params.get(key), str):
+                params[key] = os.path.abspath(params[key].format(name=name))
+
+        jobid = _job_id(cubefits)
+        for state in ('done', 'pending', 'running'):
+            if os.path.exists(self._path(state, jobid)):
+                logger.info('Job %s is already %s', jobid, state)
+                return None
+
+        _write_json(self._path('pending', jobid), dict(
+            id=jobid, cubefits=os.path.abspath(cubefits), params=params,
+            attempts=0, submitted=time()))
+        failed = self._path('failed', jobid)
+        if os.path.exists(failed):
+            os.remove(failed)
+        return jobid
+
+    def requeue_stale(self):
+        """Put back in the queue the running jobs which were not updated for
+        ``timeout`` seconds, and return their ids."""
+        requeued = []
+        for jobid in self.jobs('running'):
+            path = self._path('running', jobid)
+            try:
+                if time() - os.path.getmtime(path) < self.timeout:
+                    continue
+                # rename it first, so only one worker requeues the job
+                stale = '{}.{}.stale'.format(path, uuid.uuid4().hex)
+                os.rename(path, stale)
+            except FileNotFoundError:
+                continue
+            job = _read_json(stale)
+            logger.warning('Job %s was not updated for %d sec., requeued',
+                           jobid, self.timeout)
+            self._retry(job, 'the worker {} stopped updating the job'.format(
+                job.get('worker')))
+            os.remove(stale)
+            requeued.append(jobid)
+        return requeued
+
+    def claim(self, worker=None):
+        """Move the oldest pending job to ``running`` and return it, or None
+        if there is no pending job."""
+        worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+        for jobid in self.jobs('pending'):
+            pending = self._path('pending', jobid)
+            running = self._path('running', jobid)
+            try:
+                # renaming keeps the modification time, which must be recent
+                # to not be taken as a stale job
+                os.utime(pending)
+                os.rename(pending, running)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            if os.path.exists(self._path('done', jobid)):
+                # finished, but the worker was killed before cleaning up
+                os.remove(running)
+                continue
+            job = _read_json(running)
+            job['worker'] = worker
+            job['claim'] = uuid.uuid4().hex[:12]
+            job['started'] = time()
+            _write_json(running, job)
+            return job
+        return None
+
+    def owns(self, job):
+        """Return True if the running file of the job is still the one of
+        this claim, i.e. if the job was not requeued (and maybe claimed by
+        another worker) in the meantime."""
+        try:
+            running = _read_json(self._path('running', job['id']))
+        except FileNotFoundError:
+            return False
+        return (running.get('worker') == job.get('worker') and
+                running.get('claim') == job.get('claim'))
+
+    def heartbeat(self, job):
+        """Mark a running job as alive. Raises FileNotFoundError if the job
+        is no more running with this claim, e.g. if it was requeued."""
+        if not self.owns(job):
+            raise FileNotFoundError('job {} is not running for {}'.format(
+                job['id'], job.get('worker')))
+        os.utime(self._path('running', job['id']))
+
+    def complete(self, job, metrics):
+        """Record the completion of a job, with its metrics."""
+        _write_json(self._path('done', job['id']), dict(job, **metrics))
+        self._remove_running(job)
+
+    def fail(self, job, error):
+        """Record the failure of a job, which is queued again unless it was
+        tried ``max_attempts`` times. Nothing is done if the job was
+        requeued in the meantime."""
+        if self._remove_running(job):
+            self._retry(job, error)
+
+    def release(self, job):
+        """Put back a running job in the queue, without counting an attempt
+        (e.g. when the worker is stopped). Nothing is done if the job was
+        requeued in the meantime."""
+        if self._remove_running(job):
+            job = {k: v for k, v in job.items()
+                   if k not in ('worker', 'claim', 'started')}
+            _write_json(self._path('pending', job['id']), job)
+
+    def _retry(self, job, error):
+        job = dict(job, attempts=job.get('attempts', 0) + 1, error=error)
+        if job['attempts'] >= self.max_attempts:
+            logger.warning('Job %s failed %d times, moved to failed',
+                           job['id'], job['attempts'])
+            _write_json(self._path('failed', job['id']), job)
+        else:
+            _write_json(self._path('pending', job['id']), job)
+
+    def _remove_running(self, job):
+        """Remove the running file of the job if it is owned by this claim,
+        and return True if it was removed."""
+        if not self.owns(job):
+            logger.warning('Job %s is no more running for %s', job['id'],
+                           job.get('worker'))
+            return False
+        try:
+            os.remove(self._path('running', job['id']))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class _AnyEvent(object):
+
+    """Set when any of the given events is set."""
+
+    def __init__(self, *events):
+        self.events = [e for e in events if e is not None]
+
+    def is_set(self):
+        return any(e.is_set() for e in self.events)
+
+
+def _maxrss():
+    """Return the peak resident memory of the process in bytes, or None if it
+    is not available."""
+    try:
+        # only on Unix, so it is imported when a job is run
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run_job(queue, job, context=None, cancel=None):
+    """Run a claimed job, and record its completion or failure. The outputs
+    are written with temporary names, and renamed when the job succeeds."""
+    lost = threading.Event()
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(queue.timeout / 4):
+            try:
+                queue.heartbeat(job)
+            except FileNotFoundError:
+                logger.warning('Job %s was requeued, stopping', job['id'])
+                lost.set()
+                return
+
+    # start time of each stage, from the progress events
+    starts = {}
+
+    def progress(event):
+        starts.setdefault(event.stage, event.elapsed)
+
+    params = dict(job['params'])
+    outputs = {key: params[key] for key in OUTPUT_PARAMS
+               if params.get(key) is not None}
+    for key, filename in outputs.items():
+        params[key] = _partial(filename, job['claim'])
+    params['overwrite'] = True
+
+    logger.info('Processing job %s (%s)', job['id'], job['cubefits'])
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    t0 = time()
+    try:
+        process(job['cubefits'], context=context, progress=progress,
+                cancel=_AnyEvent(cancel, lost), **params)
+        for key, filename in outputs.items():
+            os.replace(params[key], filename)
+    except Cancelled:
+        if not lost.is_set():
+            queue.release(job)
+        raise
+    except BaseException as e:
+        if isinstance(e, Exception):
+            queue.fail(job, ''.join(traceback.format_exception_only(
+                type(e), e)).strip())
+            logger.error('Job %s failed: %s', job['id'], e)
+        else:
+            # interrupted
+            queue.release(job)
+            raise
+        return False
+    finally:
+        stop.set()
+        thread.join()
+
+    tend = time()
+    stages = sorted(starts.items(), key=lambda item: item[1])
+    ends = [t for _, t in stages[1:]] + [tend - t0]
+    queue.complete(job, dict(
+        finished=tend, duration=tend - t0, outputs=outputs,
+        stages={stage: end - start for (stage, start), end in
+                zip(stages, ends)},
+        size=os.path.getsize(job['cubefits']),
+        maxrss=_maxrss()))
+    logger.info('Job %s done in %.2f sec.', job['id'], tend - t0)
+    return True
+
+
+def run_worker(path, wait=False, poll=10, max_jobs=None, timeout=600,
+               max_attempts=3, ncpu=None, context=None, cancel=None):
+    """Process the jobs of a :class:`~zap.WorkQueue` until it is empty.
+
+    Several workers can run concurrently on the same queue, on one or
+    several nodes sharing the filesystem. Before claiming a job, the worker
+    requeues the stale ones. The outputs of a job are written with temporary
+    names and renamed when it succeeds, and the completion marker records the
+    duration of the job and of each stage, the size of the input cube, and
+    the peak resident memory of the worker.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the queue.
+    wait : bool
+        If True, wait for new jobs when the queue is empty, checking it
+        every ``poll`` seconds, instead of returning.
+    max_jobs : int
+        Maximum number of jobs processed by the worker.
+    timeout, max_attempts
+        See :class:`~zap.WorkQueue`.
+    ncpu : int
+        Number of processes used by each job, used if ``context`` is not
+        given.
+    context : `~zap.ExecutionContext`
+        Resources used by the jobs.
+    cancel : `threading.Event`
+        If given, the worker stops when the event is set, and its running
+        job is put back in the queue.
+
+    Returns
+    -------
+    int
+        The number of processed jobs (finished or failed).
+
+    """
+    queue = WorkQueue(path, timeout=timeout, max_attempts=max_attempts)
+    context = ExecutionContext.create(context, ncpu=ncpu)
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    logger.info('Worker %s started on %s', worker, path)
+    njobs = 0
+    while max_jobs is None or njobs < max_jobs:
+        if cancel is not None and cancel.is_set():
+            break
+        queue.requeue_stale()
+        job = queue.claim(worker)
+        if job is None:
+            if not wait:
+                break
+            if cancel is not None:
+                cancel.wait(poll)
+            else:
+                threading.Event().wait(poll)
+            continue
+        try:
+            _run_job(queue, job, context=context, cancel=cancel)
+        except Cancelled:
+            logger.info('Job %s stopped', job['id'])
+            continue
+        njobs += 1
+    logger.info('Worker %s processed %d job(s)', worker, njobs)
+    return njobs
@@ -23,21 +23,38 @@
 # DEALINGS IN THE SOFTWARE.
 
 import astropy.units as u
+import collections
+import copy
 import logging
 import numpy as np
 import os
+import queue
 import scipy.ndimage as ndi
+import signal
 import sys
+import threading
+import traceback
 import warnings
 
 from astropy.io import fits
 from astropy.wcs import WCS
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from contextlib import contextmanager
 from functools import wraps
 from multiprocessing import cpu_count, Manager, Process
+from scipy.linalg import eigh_tridiagonal, get_lapack_funcs
 from scipy.stats import sigmaclip
 from sklearn.decomposition import PCA
 from time import time
 
+from .cache import StageCache, array_checksum
+from .compression import image_hdu, write_image
+from .skymodel import SkyModel, write_skymodel
+from .storage import cube_format, open_cube, write_cube
+from .svd import SubspacePCA, _accumulate
+from .utils import NanIndex, nan_edges_mask
+
 from pkg_resources import get_distribution, DistributionNotFound
 try:
     __version__ = get_distribution('zap').version
@@ -45,12 +62,14 @@ except DistributionNotFound:
     # package is not installed
     __version__ = None
 
-__all__ = ['process', 'SVDoutput', 'nancleanfits', 'contsubfits', 'Zap',
-           'SKYSEG', '__version__']
+__all__ = ['process', 'process_array', 'process_many', 'SVDoutput',
+           'nancleanfits', 'contsubfits', 'Zap', 'ExecutionContext',
+           'Cancelled', 'ProgressEvent', 'SKYSEG', 'fastmedian_deviation',
+           '__version__']
 
-# Limits of the segments in Angstroms. Zap now uses by default only one
-# segment, based on the cube wavelength's min and max.  See below for the
-# old values.
+# Limits of the segments in Angstroms, used when the ``skyseg`` parameter is
+# not given. Zap now uses by default only one segment, based on the cube
+# wavelength's min and max.  See below for the old values.
 SKYSEG = []
 
 # These are the old limits from the original zap. Keeping them for reference,
@@ -65,11 +84,39 @@ NOTCH_FILTER_RANGES = {
 }
 
 # List of allowed values for cftype (continuum filter)
-CFTYPE_OPTIONS = ('median', 'fit', 'none')
-
-# Number of available CPUs
+CFTYPE_OPTIONS = ('median', 'fastmedian', 'fit', 'none')
+
+# Stride of the coarse grid used by the 'fastmedian' continuum filter, as a
+# fraction of cfwidth
+FASTMEDIAN_STEP = 0.1
+
+# List of allowed values for the optimize mode
+OPTIMIZE_OPTIONS = ('full', 'incremental')
+
+# Stages of a run, in order, with the parameters of process they depend on.
+# Changing a parameter with Zap.set invalidates its stage and the next ones.
+STAGES = (('nanclean', ('clean', )),
+          ('extract', ()),
+          ('zlevel', ('zlevel', 'mask')),
+          ('continuum', ('cftype', 'cfwidth', 'cfwidthSVD')),
+          ('normalize', ()),
+          ('svd', ('optimize', )),
+          ('reconstruct', ('nevals', )),
+          ('remold', ()))
+
+# Number of available CPUs, default number of processes of an ExecutionContext
 NCPU = cpu_count()
 
+# Estimate of the memory used to process a cube, in number of copies of the
+# cube (cube, stack, continuum, normalized stack, reconstruction, clean cube)
+MEMORY_FACTOR = 6
+
+# Attributes of a Zap object that are used when it is given as extSVD
+BASIS_ATTRS = ('models', 'zlsky', 'run_zlevel')
+
+# Number of full-field bases kept in memory for the runs with a ROI
+ROI_BASES = 4
+
 logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.INFO,
                     stream=sys.stdout)
 logger = logging.getLogger(__name__)
@@ -81,7 +128,10 @@ def process(cubefits, outcubefits='DATACUBE_ZAP.fits', clean=True,
             zlevel='median', cftype='median', cfwidthSVD=300, cfwidthSP=300,
             nevals=[], extSVD=None, skycubefits=None, mask=None,
             interactive=False, ncpu=None, pca_class=None, n_components=None,
-            overwrite=False, varcurvefits=None):
+            overwrite=False, varcurvefits=None, cache=None,
+            optimize='full', skymodelfits=None, roi=None, context=None,
+            maskedges=None, initSVD=None, progress=None, cancel=None,
+            compress=None, skyseg=None):
     """ Performs the entire ZAP sky subtraction algorithm.
 
     This is the main ZAP function. It works on an input FITS file and
@@ -103,8 +153,10 @@ def process(cubefits, outcubefits='DATACUBE_ZAP.fits', clean=True,
     zlevel : str
         Method for the zeroth order sky removal: `none`, `sigclip` or `median`
         (default).
-    cftype : {'median', 'fit', 'none'}
-        Method for the continuum filter.
+    cftype : {'median', 'fastmedian', 'fit', 'none'}
+        Method for the continuum filter. 'fastmedian' is an approximation of
+        'median', computing the median on a coarse grid and interpolating it,
+        which is much faster.
     cfwidthSVD : int or float
         Window size for the continuum filter, for the SVD computation.
         Default to 300.
@@ -141,6 +193,68 @@ def process(cubefits, outcubefits='DATACUBE_ZAP.fits', clean=True,
         to False.
     varcurvefits : str
         Path for the optional output of the explained variance curves.
+    cache : str or `~zap.StageCache`
+        Directory of an on-disk cache for the intermediate results. When
+        running again ZAP on the same cube, the stages whose inputs did not
+        change are loaded from the cache instead of being recomputed.
+    optimize : {'full', 'incremental'}
+        Method used to find the number of eigenspectra when ``nevals`` is not
+        given. With 'full' (default), the criterion is evaluated on the
+        explained variance of the full SVD. With 'incremental', the
+        eigenvalues are computed by blocks until the criterion is reached,
+        and only the needed eigenvectors are then computed, which is much
+        faster. In this case the number of eigenspectra that can be used with
+        :meth:`~zap.Zap.reprocess` is limited to the number of computed ones.
+    skymodelfits : str
+        Path for the optional output of the low-rank model of the subtracted
+        sky, which is much smaller than ``skycubefits`` and can be read with
+        :class:`~zap.SkyModel`.
+    roi : tuple of slices, str or ndarray
+        Region of interest, to process only a part of the cube, e.g. to check
+        quickly the parameters on a given object. It can be a tuple of (y, x)
+        slices, or a 2D mask (>=1 for the spaxels to process) given as an
+        array or a FITS file. The zlevel and the SVD are computed on the full
+        field (with the ``mask``), or taken from ``extSVD``, so the result is
+        the same as in the region of a full run, and the output cube is
+        cropped to the bounding box of the region. Passing the same
+        ``extSVD`` or a ``cache`` makes the next runs much faster.
+    context : `~zap.ExecutionContext`
+        Resources used for the run (number of processes, executor, thread
+        limits). By default a context with ``ncpu`` processes is used.
+    maskedges : float
+        If given, the edges of the cube are masked in the output: the biggest
+        region of spaxels with more than ``maskedges`` percent of NaN values
+        is set to NaN (see :func:`~zap.mask_nan_edges`). This uses the NaN
+        map computed for the NaN cleaning, without reading again the cube.
+    initSVD : Zap object or str
+        Basis of a previous exposure, given as a ``Zap`` object (from
+        :func:`~zap.process` with ``interactive=True`` or from
+        :func:`~zap.SVDoutput`) or as a sky model file (``skymodelfits``).
+        The SVD is then computed by subspace iteration starting from this
+        basis, which is much faster than the full decomposition when the sky
+        did not change much (see :class:`~zap.SubspacePCA`). Unless
+        ``nevals`` is given, the number of eigenspectra is estimated on the
+        cube as with ``optimize='incremental'``.
+    progress : callable
+        Function called with a `~zap.ProgressEvent` at the start and end of
+        each stage and as the stages progress, e.g. to report the progress
+        to a job scheduler.
+    cancel : `threading.Event`
+        If given, the run is stopped as soon as possible when the event is
+        set, by raising `~zap.Cancelled` (the worker processes are
+        terminated).
+    compress : str or dict
+        If given, the output cube and the sky cube are written
+        tile-compressed, with one tile per plane: 'lossless' (GZIP with byte
+        shuffling), 'quantized' (RICE on floats quantized to 1/16 of the
+        noise), a compression type of `~astropy.io.fits.CompImageHDU` (e.g.
+        'RICE_1'), or a dict of parameters for
+        `~astropy.io.fits.CompImageHDU`. The two cubes are compressed in
+        parallel. Tile-compressed input cubes are always supported, their
+        tiles are decompressed with ``ncpu`` threads.
+    skyseg : list
+        Limits of the SVD segments in Angstroms. If not given, `SKYSEG` is
+        used, which by default gives only one segment.
 
     """
     logger.info('Running ZAP %s !', __version__)
@@ -157,44 +271,328 @@ def process(cubefits, outcubefits='DATACUBE_ZAP.fits', clean=True,
 
         _check_file_exists(outcubefits)
         _check_file_exists(skycubefits)
+        _check_file_exists(skymodelfits)
 
-    if ncpu is not None:
-        global NCPU
-        NCPU = ncpu
+    context = ExecutionContext.create(context, ncpu=ncpu)
+    if isinstance(cache, str):
+        cache = StageCache(cache)
 
     if extSVD is not None and mask is not None:
         raise ValueError('extSVD and mask parameters are incompatible: if mask'
                          ' must be used, then the SVD has to be recomputed')
-
-    if mask is not None or (extSVD is None and cfwidthSVD != cfwidthSP):
-        # Compute the SVD separately, only if a mask is given, or if the
-        # cfwidth values differ and extSVD is not given. Otherwise, the SVD
-        # will be computed in the _run method, which allows to avoid running
-        # twice the zlevel and continuumfilter steps.
-        extSVD = SVDoutput(cubefits, clean=clean, zlevel=zlevel,
-                           cftype=cftype, cfwidth=cfwidthSVD, mask=mask)
-
-    zobj = Zap(cubefits, pca_class=pca_class, n_components=n_components)
-    zobj._run(clean=clean, zlevel=zlevel, cfwidth=cfwidthSP, cftype=cftype,
-              nevals=nevals, extSVD=extSVD)
+    if extSVD is not None and initSVD is not None:
+        raise ValueError('extSVD and initSVD parameters are incompatible')
+
+    # If the SVD is computed here, the cube is read, cleaned, extracted and
+    # zlevel-subtracted only once. The mask is used to select the sky spaxels
+    # for the zlevel and the SVD, and if the cfwidth values differ the two
+    # continuum filters are computed in the same pass.
+    zobj = Zap(cubefits, pca_class=pca_class, n_components=n_components,
+               cache=cache, context=context, progress=progress, cancel=cancel,
+               skyseg=skyseg)
+    with context.limits():
+        zobj._run(clean=clean, zlevel=zlevel, cfwidth=cfwidthSP,
+                  cftype=cftype, nevals=nevals, extSVD=extSVD, mask=mask,
+                  cfwidthSVD=cfwidthSVD if extSVD is None else None,
+                  optimize=optimize, roi=roi, maskedges=maskedges,
+                  initSVD=initSVD)
 
     if interactive:
         # Return the zobj object without saving files
         return zobj
 
+    zobj.monitor.start('write')
+    if compress is not None and skycubefits is not None:
+        # the compression of the two cubes is done in parallel, as the
+        # Astropy codecs release the GIL
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(zobj.writeskycube,
+                                       skycubefits=skycubefits,
+                                       overwrite=overwrite,
+                                       compress=compress),
+                       executor.submit(zobj.mergefits, outcubefits,
+                                       overwrite=overwrite,
+                                       compress=compress)]
+            _wait_futures(futures, monitor=zobj.monitor)
+        skycubefits = outcubefits = None
+
     if skycubefits is not None:
         zobj.writeskycube(skycubefits=skycubefits, overwrite=overwrite)
 
+    if skymodelfits is not None:
+        zobj.writeskymodel(skymodelfits=skymodelfits, overwrite=overwrite)
+
     if varcurvefits is not None:
         zobj.writevarcurve(varcurvefits=varcurvefits, overwrite=overwrite)
 
-    zobj.mergefits(outcubefits, overwrite=overwrite)
+    if outcubefits is not None:
+        zobj.mergefits(outcubefits, overwrite=overwrite, compress=compress)
+    zobj.monitor.update(1)
     logger.info('Zapped! (took %.2f sec.)', time() - t0)
 
 
+def process_array(data, header=None, wave=None, ins_mode=None, clean=True,
+                  zlevel='median', cftype='median', cfwidthSVD=300,
+                  cfwidthSP=300, nevals=[], extSVD=None, mask=None,
+                  interactive=False, ncpu=None, pca_class=None,
+                  n_components=None, cache=None, optimize='full', roi=None,
+                  context=None, maskedges=None, initSVD=None, progress=None,
+                  cancel=None, skycube=False, inplace=False, skyseg=None):
+    """Performs the ZAP sky subtraction on a cube given as an array.
+
+    This is the same as :func:`~zap.process`, but the cube is given as an
+    array with its header or wavelength axis (see :meth:`~zap.Zap.from_array`)
+    and the clean cube is returned instead of being written to a file.
+
+    Parameters
+    ----------
+    data : ndarray
+        The (nz, ny, nx) cube.
+    header : `~astropy.io.fits.Header`
+        Header of the cube, with the WCS of the wavelength axis.
+    wave : ndarray
+        The wavelength of each plane, in Angstrom, if ``header`` is not given.
+    ins_mode : str
+        Instrument mode, used to mask the notch filter region of the AO
+        modes (e.g. 'WFM-AO-N').
+    skycube : bool
+        If True, the subtracted sky cube is also returned.
+    inplace : bool
+        If True, the cube is processed without copy and the clean cube is
+        written in ``data``, which is returned.
+
+    The other parameters are those of :func:`~zap.process`.
+
+    Returns
+    -------
+    ndarray or tuple of ndarray or Zap
+        The clean cube, and the sky cube if ``skycube`` is True, or the
+        :class:`~zap.Zap` object if ``interactive`` is True.
+
+    """
+    t0 = time()
+    if extSVD is not None and mask is not None:
+        raise ValueError('extSVD and mask parameters are incompatible: if mask'
+                         ' must be used, then the SVD has to be recomputed')
+    if extSVD is not None and initSVD is not None:
+        raise ValueError('extSVD and initSVD parameters are incompatible')
+
+    context = ExecutionContext.create(context, ncpu=ncpu)
+    zobj = Zap.from_array(data, header=header, wave=wave, ins_mode=ins_mode,
+                          inplace=inplace, pca_class=pca_class,
+                          n_components=n_components, cache=cache,
+                          context=context, progress=progress, cancel=cancel,
+                          skyseg=skyseg)
+    with context.limits():
+        zobj._run(clean=clean, zlevel=zlevel, cfwidth=cfwidthSP,
+                  cftype=cftype, nevals=nevals, extSVD=extSVD, mask=mask,
+                  cfwidthSVD=cfwidthSVD if extSVD is None else None,
+                  optimize=optimize, roi=roi, maskedges=maskedges,
+                  initSVD=initSVD)
+    logger.info('Zapped! (took %.2f sec.)', time() - t0)
+
+    if interactive:
+        return zobj
+    if skycube:
+        return zobj.cleancube, zobj.make_skycube()
+    return zobj.cleancube
+
+
+def process_many(cubefits, outcubefits='{name}_ZAP.fits', clean=True,
+                 zlevel='median', cftype='median', cfwidthSVD=300,
+                 cfwidthSP=300, nevals=[], extSVD=None, mask=None,
+                 pca_class=None, n_components=None, overwrite=False,
+                 cache=None, context=None, prefetch=2, batchsize=4,
+                 writeback=2, maxmem=None, skyseg=None):
+    """Process several exposures of a field with a shared SVD.
+
+    The exposures go through a pipeline, so that the I/O overlaps with the
+    computation:
+
+    - a background thread reads the cubes, at most ``prefetch`` in advance,
+    - another thread prepares them (NaN cleaning, extraction, zlevel and
+      continuum subtraction, normalization),
+    - the exposures are then processed by batches of ``batchsize``: the
+      normalized stacks of a batch are concatenated, so the projection on the
+      eigenspectra and the reconstruction are done with large matrix
+      products,
+    - each cleaned cube is written by a background thread as soon as its batch
+      is done, with at most ``writeback`` cubes waiting to be written.
+
+    The memory used by the exposures in the pipeline, from their reading
+    until their writing, is limited to ``maxmem``.
+
+    The result for each exposure is the same as with :func:`~zap.process`
+    using the same ``extSVD``.
+
+    Parameters
+    ----------
+    cubefits : list of str
+        Input FITS files. The cubes must have the same wavelength axis.
+    outcubefits : str or list of str
+        Output FITS files, either a list or a pattern which can contain
+        ``{name}`` (the input file name without extension) and ``{index}``.
+        Default to ``{name}_ZAP.fits``.
+    extSVD : Zap object
+        The SVD to use, from :func:`~zap.SVDoutput`. If None, the SVD is
+        computed on the first exposure, with ``cfwidthSVD`` and ``mask``.
+    prefetch : int
+        Maximum number of exposures read and prepared in advance.
+    batchsize : int
+        Number of exposures projected together.
+    writeback : int
+        Maximum number of cubes waiting to be written.
+    maxmem : int
+        Memory budget in bytes for the exposures in the pipeline, estimated
+        from the size of the cubes. Default to the one of the context, not
+        limited if None. An exposure is always admitted if the pipeline is
+        empty.
+
+    The other parameters are the same as for :func:`~zap.process`.
+
+    Returns
+    -------
+    list of str
+        The output files.
+
+    """
+    logger.info('Running ZAP %s on %d exposures', __version__, len(cubefits))
+    t0 = time()
+    if isinstance(outcubefits, str):
+        outcubefits = [
+            outcubefits.format(index=i, name=os.path.splitext(
+                os.path.basename(f))[0]) for i, f in enumerate(cubefits)]
+    if len(outcubefits) != len(cubefits):
+        raise ValueError('outcubefits must have one file per exposure')
+    if not overwrite:
+        for filename in outcubefits:
+            if os.path.exists(filename):
+                raise IOError('Output file "{0}" exists'.format(filename))
+
+    context = ExecutionContext.create(context)
+    if isinstance(cache, str):
+        cache = StageCache(cache)
+    if extSVD is not None and mask is not None:
+        raise ValueError('extSVD and mask parameters are incompatible: if mask'
+                         ' must be used, then the SVD has to be recomputed')
+    if extSVD is None:
+        extSVD = SVDoutput(cubefits[0], clean=clean, zlevel=zlevel,
+                           cftype=cftype, cfwidth=cfwidthSVD, mask=mask,
+                           pca_class=pca_class, n_components=n_components,
+                           cache=cache, context=context, skyseg=skyseg)
+
+    budget = MemoryBudget(context.maxmem if maxmem is None else maxmem)
+
+    def read(item):
+        filename, outfile = item
+        nbytes = MEMORY_FACTOR * cube_nbytes(filename)
+        budget.acquire(nbytes)
+        try:
+            zobj = Zap(filename, pca_class=pca_class,
+                       n_components=n_components, cache=cache,
+                       context=context, skyseg=skyseg)
+            if zobj.cube.shape[0] != len(extSVD.zlsky):
+                raise ValueError('{} does not have the same wavelength axis '
+                                 'as the SVD'.format(filename))
+            # load the data now, in the I/O thread
+            zobj.cube = np.array(zobj.cube)
+        except Exception:
+            budget.release(nbytes)
+            raise
+        zobj._outcubefits, zobj._nbytes = outfile, nbytes
+        return zobj
+
+    def prepare(zobj):
+        zobj._prepare(clean=clean, zlevel=zlevel, cftype=cftype,
+                      cfwidth=cfwidthSP, extzlevel=extSVD)
+        return zobj
+
+    def write(zobj):
+        try:
+            zobj.mergefits(zobj._outcubefits, overwrite=overwrite)
+        finally:
+            zobj.cube = zobj.cleancube = zobj.stack = None
+            budget.release(zobj._nbytes)
+
+    # the eigenspectra are selected only once, on the first exposure, since
+    # they depend only on the models
+    basis = None
+    pending = collections.deque()
+
+    def flush(batch):
+        nonlocal basis
+        if basis is None:
+            basis = batch[0]
+            basis.models = copy.deepcopy(extSVD.models)
+            basis.components = [m.components_.copy() for m in basis.models]
+            if nevals == []:
+                basis.optimize()
+                basis.chooseevals(nevals=basis.nevals)
+            else:
+                basis.chooseevals(nevals=nevals)
+
+        pranges = basis.pranges
+        for zobj in batch:
+            if not np.array_equal(zobj.pranges, pranges):
+                raise ValueError('the exposures must have the same '
+                                 'wavelength segments')
+        logger.info('Reconstructing the sky residuals of %d exposures',
+                    len(batch))
+        results = _reconstruct(basis.models, pranges,
+                               [zobj.normstack for zobj in batch],
+                               [zobj.variancearray for zobj in batch])
+        for zobj, (coefs, recon) in zip(batch, results):
+            zobj.models = basis.models
+            zobj.components = basis.components
+            zobj.nevals = basis.nevals
+            zobj._coefs, zobj.recon = coefs, recon
+            zobj.remold()
+            zobj.contarray = zobj.normstack = zobj.recon = None
+            pending.append(writer.submit(write, zobj))
+            while len(pending) > writeback:
+                pending.popleft().result()
+
+    reader = _Stage(read, zip(cubefits, outcubefits), prefetch)
+    preparer = _Stage(prepare, reader, prefetch)
+    writer = ThreadPoolExecutor(max_workers=1)
+    try:
+        with context.limits():
+            batch = []
+            while True:
+                try:
+                    zobj = preparer.get(timeout=0.1)
+                except queue.Empty:
+                    # if the reader waits for memory hold by the current
+                    # batch, process it now
+                    if batch and budget.waiting:
+                        flush(batch)
+                        batch = []
+                    continue
+                if zobj is _Stage.DONE:
+                    break
+                batch.append(zobj)
+                if len(batch) == batchsize:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+            for future in pending:
+                future.result()
+    finally:
+        reader.close()
+        preparer.close()
+        budget.close()
+        writer.shutdown(wait=True)
+
+    logger.info('Zapped %d exposures! (took %.2f sec.)', len(cubefits),
+                time() - t0)
+    return outcubefits
+
+
 def SVDoutput(cubefits, clean=True, zlevel='median', cftype='median',
               cfwidth=300, mask=None, ncpu=None, pca_class=None,
-              n_components=None):
+              n_components=None, cache=None, context=None, initSVD=None,
+              progress=None, cancel=None, skyseg=None):
     """Performs the SVD decomposition of a datacube.
 
     This allows to use the SVD for a different datacube. It used to allow to
@@ -212,38 +610,53 @@ def SVDoutput(cubefits, clean=True, zlevel='median', cftype='median',
     zlevel : str
         Method for the zeroth order sky removal: `none`, `sigclip` or `median`
         (default).
-    cftype : {'median', 'fit', 'none'}
+    cftype : {'median', 'fastmedian', 'fit', 'none'}
         Method for the continuum filter.
     cfwidth : int or float
         Window size for the continuum filter, default to 300.
     mask : str
         Path of a FITS file containing a mask (1 for objects, 0 for sky).
+    cache : str or `~zap.StageCache`
+        Directory of an on-disk cache for the intermediate results.
+    context : `~zap.ExecutionContext`
+        Resources used for the run, by default a context with ``ncpu``
+        processes.
+    initSVD : Zap object or str
+        Basis of a previous exposure used as initial subspace, see
+        :func:`~zap.process`. Only the first eigenvectors are computed, and
+        the number of eigenspectra estimated on the cube with the incremental
+        criterion is kept in ``nevals``.
+    progress : callable
+        Function called with the progress of the run, see
+        :func:`~zap.process`.
+    cancel : `threading.Event`
+        Event used to cancel the run, see :func:`~zap.process`.
+    skyseg : list
+        Limits of the SVD segments in Angstroms. If not given, `SKYSEG` is
+        used, which by default gives only one segment.
 
     """
     logger.info('Processing %s to compute the SVD', cubefits)
 
-    if ncpu is not None:
-        global NCPU
-        NCPU = ncpu
-
-    zobj = Zap(cubefits, pca_class=pca_class, n_components=n_components)
-    zobj._prepare(clean=clean, zlevel=zlevel, cftype=cftype,
-                  cfwidth=cfwidth, mask=mask)
-    zobj._msvd()
+    context = ExecutionContext.create(context, ncpu=ncpu)
+    zobj = Zap(cubefits, pca_class=pca_class, n_components=n_components,
+               cache=cache, context=context, progress=progress, cancel=cancel,
+               skyseg=skyseg)
+    with context.limits():
+        zobj._fit_svd(clean=clean, zlevel=zlevel, cftype=cftype,
+                      cfwidth=cfwidth, mask=mask, initSVD=initSVD)
     return zobj
 
 
 def contsubfits(cubefits, outfits='CONTSUB_CUBE.fits', ncpu=None,
                 cftype='median', cfwidth=300, clean_nan=True, zlevel='median',
-                overwrite=False):
+                overwrite=False, context=None):
     """A standalone implementation of the continuum removal."""
-    if ncpu is not None:
-        global NCPU
-        NCPU = ncpu
-
-    zobj = Zap(cubefits)
-    zobj._prepare(clean=clean_nan, zlevel=zlevel, cftype=cftype,
-                  cfwidth=cfwidth)
+    context = ExecutionContext.create(context, ncpu=ncpu)
+    zobj = Zap(cubefits, context=context)
+    with context.limits():
+        zobj._prepare(clean=clean_nan, zlevel=zlevel, cftype=cftype,
+                      cfwidth=cfwidth)
     cube = zobj.make_contcube()
 
     outhead = _newheader(zobj)
@@ -272,8 +685,11 @@ def nancleanfits(cubefits, outfn='NANCLEAN_CUBE.fits', rejectratio=0.25,
 
     """
     with fits.open(cubefits) as hdu:
-        hdu[1].data = _nanclean(hdu[1].data, rejectratio=rejectratio,
-                                boxsz=boxsz)[0]
+        data = hdu[1].data.copy()
+        (z, y, x, values), _, _ = _nanclean(data, rejectratio=rejectratio,
+                                            boxsz=boxsz)
+        data[z, y, x] = values
+        hdu[1].data = data
         hdu.writeto(outfn, overwrite=overwrite)
 
 
@@ -287,6 +703,149 @@ def timeit(func):
     return wrapped
 
 
+# ================= Execution context =================
+
+ProgressEvent = collections.namedtuple(
+    'ProgressEvent', ['stage', 'fraction', 'elapsed', 'eta'])
+ProgressEvent.__doc__ = """Progress of a ZAP run, given to the ``progress``
+callback: the current ``stage``, the ``fraction`` of the stage that is done,
+the ``elapsed`` time since the start of the run, and the estimated remaining
+time for the stage (``eta``, None at the start of the stage)."""
+
+
+class Cancelled(Exception):
+    """Raised when a ZAP run is cancelled."""
+
+
+class _Monitor(object):
+
+    """Report the progress of a run to a callback, and check if it was
+    cancelled (``cancel`` is an object with an ``is_set`` method, e.g. a
+    `threading.Event`)."""
+
+    def __init__(self, progress=None, cancel=None):
+        self.progress = progress
+        self.cancel = cancel
+        self.stage = None
+        self._t0 = self._tstage = time()
+
+    def check(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled('cancelled during the {} stage'.format(
+                self.stage))
+
+    def start(self, stage):
+        self.stage = stage
+        self._tstage = time()
+        self.update(0)
+
+    def update(self, fraction):
+        self.check()
+        if self.progress is None:
+            return
+        t = time()
+        elapsed = t - self._tstage
+        eta = elapsed * (1 - fraction) / fraction if fraction > 0 else None
+        self.progress(ProgressEvent(self.stage, fraction, t - self._t0, eta))
+
+    def part(self, start, stop):
+        """Return a monitor reporting to this one, for the ``start`` to
+        ``stop`` fraction of the stage."""
+        return _PartMonitor(self, start, stop)
+
+
+class _PartMonitor(object):
+
+    def __init__(self, parent, start, stop):
+        self.parent = parent
+        self.start = start
+        self.stop = stop
+
+    def check(self):
+        self.parent.check()
+
+    def update(self, fraction):
+        self.parent.update(self.start + (self.stop - self.start) * fraction)
+
+
+class ExecutionContext(object):
+
+    """Resources used by a ZAP run.
+
+    Each :class:`~zap.Zap` object uses its own context, so several runs with
+    different limits can be executed concurrently in the same process (e.g.
+    with threads, or in a service).
+
+    Parameters
+    ----------
+    ncpu : int
+        Number of chunks processed in parallel by the multiprocessed steps
+        (zlevel and continuum filter), default to the number of CPUs. The
+        median zlevel uses ``ncpu`` threads instead of processes.
+    executor : `concurrent.futures.Executor`
+        Executor used to process the chunks, e.g. a ``ProcessPoolExecutor``
+        kept for several runs. By default a new process is forked for each
+        chunk.
+    nthreads : int
+        Maximum number of threads used by the BLAS and OpenMP libraries during
+        the run, not limited by default. This requires ``threadpoolctl``, and
+        as the thread pools of these libraries are global the limit applies to
+        the whole process while a run is active.
+    maxmem : int
+        Memory budget in bytes, used by :class:`~zap.ZapServer` to admit jobs.
+    nplanes : int
+        Number of planes processed at once by the steps working by blocks of
+        planes (NaN index, extraction, median zlevel), which sets the size of
+        their scratch buffers.
+
+    """
+
+    def __init__(self, ncpu=None, executor=None, nthreads=None, maxmem=None,
+                 nplanes=64):
+        self.ncpu = ncpu or NCPU
+        self.executor = executor
+        self.nthreads = nthreads
+        self.maxmem = maxmem
+        self.nplanes = nplanes
+
+    def __repr__(self):
+        return ('<ExecutionContext(ncpu={}, executor={}, nthreads={}, '
+                'maxmem={}, nplanes={})>'.format(
+                    self.ncpu, self.executor, self.nthreads, self.maxmem,
+                    self.nplanes))
+
+    @classmethod
+    def create(cls, context=None, ncpu=None):
+        """Return ``context``, or a new context with ``ncpu`` processes."""
+        if context is None:
+            return cls(ncpu=ncpu)
+        if ncpu is not None and ncpu != context.ncpu:
+            raise ValueError('ncpu and context cannot be used together')
+        return context
+
+    def map(self, func, arr, axis=None, **kwargs):
+        """Split ``arr`` in ``ncpu`` chunks along ``axis``, and run ``func``
+        on each chunk in parallel. See `parallel_map`."""
+        return parallel_map(func, arr, self.ncpu, axis=axis,
+                            executor=self.executor, **kwargs)
+
+    @contextmanager
+    def limits(self):
+        """Context manager applying the thread limits."""
+        if self.nthreads is None:
+            yield
+            return
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            logger.warning('threadpoolctl is needed to limit the number of '
+                           'threads')
+            yield
+            return
+        with threadpool_limits(limits=self.nthreads):
+            yield
+
+
 # ================= Main class =================
 
 class Zap(object):
@@ -300,8 +859,14 @@ class Zap(object):
         The final datacube after removing all of the residual features.
     contarray : numpy.ndarray
         A 2D array containing the subtracted continuum per spaxel.
+    contarraySVD : numpy.ndarray
+        A 2D array containing the continuum used for the SVD computation, when
+        a different width is used for the SVD (``cfwidthSVD``). It is only
+        kept until the SVD is computed.
     cube : numpy.ndarray
-        The original cube with the zlevel subtraction performed per spaxel.
+        The original cube. The NaN cleaning and the zlevel subtraction are
+        performed on the extracted stack, the cube is never modified, except
+        for the notch filter region of the AO modes which is set to zero.
     laxis : numpy.ndarray
         A 1d array containing the wavelength solution generated from the header
         parameters.
@@ -310,14 +875,25 @@ class Zap(object):
     lranges : list
         A list of the wavelength bin limits used in segmenting the sepctrum
         for SVD.
+    skyseg : list
+        The limits of the segments in Angstroms, from which ``lranges`` and
+        ``pranges`` are computed.
+    nanindex : zap.NanIndex
+        Compact index of the NaN values of the input cube, used to reinsert
+        the NaN values in the final datacube.
     nancube : numpy.ndarray
         A 3d boolean datacube containing True in voxels where a NaN value was
-        replaced with an interpolation.
+        replaced with an interpolation (computed from ``nanindex``).
     nevals : numpy.ndarray
         A 1d array containing the number of eigenvalues used per segment to
         reconstruct the residuals.
+    maxcomp : list
+        Number of eigenvectors computed per segment, set by the incremental
+        optimization. If None all eigenvectors are computed.
     normstack : numpy.ndarray
         A normalized version of the datacube decunstructed into a 2d array.
+    params : dict
+        Parameters of the last run, which can be changed with :meth:`set`.
     pranges : numpy.ndarray
         The pixel indices of the bounding regions for each spectral segment.
     recon : numpy.ndarray
@@ -326,8 +902,14 @@ class Zap(object):
         Boolean that indicates that the NaN cleaning method was used.
     run_zlevel : bool
         Boolean indicating that the zero level correction was used.
+    sky : numpy.ndarray
+        Optional 1d boolean array selecting the spaxels of the stack that are
+        used to compute the zlevel and the SVD. All spaxels are used if None.
     stack : numpy.ndarray
         The datacube deconstructed into a 2d array for use in the the SVD.
+        It is stored in Fortran order, so the spectra are contiguous in
+        memory, which is the efficient layout for the per-spectrum
+        operations (continuum filter, normalization, PCA).
     variancearray : numpy.ndarray
         A list of length nsegments containing variances calculated per spaxel
         used for normalization
@@ -336,68 +918,143 @@ class Zap(object):
         deconstructed stack
     zlsky : numpy.ndarray
         A 1d array containing the result of the zero level subtraction
+    cache : zap.StageCache
+        Optional on-disk cache for the intermediate results.
+    context : zap.ExecutionContext
+        Resources used for the run.
+    monitor : object
+        Reports the progress of the run to the ``progress`` callback, and
+        checks the ``cancel`` event.
 
     """
 
-    def __init__(self, cubefits, pca_class=None, n_components=None):
+    def __init__(self, cubefits, pca_class=None, n_components=None,
+                 cache=None, context=None, progress=None, cancel=None,
+                 skyseg=None):
         self.cubefits = cubefits
         self.ins_mode = None
 
-        with fits.open(cubefits) as hdul:
-            self.instrument = hdul[0].header.get('INSTRUME')
-            if self.instrument == 'MUSE':
-                self.ins_mode = hdul[0].header.get('HIERARCH ESO INS MODE')
-                self.cube = hdul[1].data
-                self.header = hdul[1].header
-            elif self.instrument == 'KCWI':
-                self.cube = hdul[0].data
-                self.header = hdul[0].header
-            elif self.instrument == 'FOCAS':
-                self.cube = hdul[0].data
-                self.header = hdul[0].header
-            elif self.instrument == 'WIFES':
-                try:
-                    self.cube = hdul['WIFES REDUCED DATA'].data
-                except KeyError:
-                    self.cube = hdul[0].data
-                self.header = hdul[0].header
+        # Resources used for the run
+        self.context = context or ExecutionContext()
+        nthreads = self.context.ncpu
+
+        # tile-compressed cubes are decompressed in parallel, and for the
+        # instruments storing the cube in the primary HDU, a compressed cube
+        # is in the first extension (the index is used by mergefits). The
+        # chunks of HDF5 and Zarr cubes are also read in parallel, the whole
+        # cube is read whatever the chunk layout.
+        with open_cube(cubefits) as cube:
+            self.instrument = cube.instrument
+            self.ins_mode = cube.ins_mode
+            self.cube = cube.read(nthreads=nthreads)
+            self.header = cube.header
+            if self.instrument == 'WIFES':
                 self.header['CUNIT3'] = 'Angstrom'
-            else:
-                raise ValueError('unsupported instrument %s' % self.instrument)
-
-        # Workaround for floating points errors in wcs computation: if cunit is
-        # specified, wcslib will convert in meters instead of angstroms, so we
-        # remove cunit before creating the wcs object
-        header = self.header.copy()
-        unit = u.Unit(header.pop('CUNIT3'))
-        self.wcs = WCS(header).sub([3])
-
-        # Create Lambda axis
-        wlaxis = np.arange(self.cube.shape[0])
-        self.laxis = self.wcs.all_pix2world(wlaxis, 0)[0]
-        if unit != u.angstrom:
-            # Make sure lambda is in angstroms
-            self.laxis = (self.laxis * unit).to(u.angstrom).value
+            self._hduindex = cube.index
+            self._primary_header = cube.primary_header
+            self._chunks = cube.chunks
+        self._inplace = False
+
+        self._setwcs()
+        self._setup(pca_class=pca_class, n_components=n_components,
+                    cache=cache, progress=progress, cancel=cancel,
+                    skyseg=skyseg)
+
+    @classmethod
+    def from_array(cls, data, header=None, wave=None, ins_mode=None,
+                   inplace=False, pca_class=None, n_components=None,
+                   cache=None, context=None, progress=None, cancel=None,
+                   skyseg=None):
+        """Create a Zap object for a cube already in memory.
+
+        Parameters
+        ----------
+        data : ndarray
+            The (nz, ny, nx) cube.
+        header : `~astropy.io.fits.Header`
+            Header of the cube, with the WCS of the wavelength axis. It is
+            also used for the headers of the output files.
+        wave : ndarray
+            The wavelength of each plane, in Angstrom, if ``header`` is not
+            given.
+        ins_mode : str
+            Instrument mode, used to mask the notch filter region of the AO
+            modes (e.g. 'WFM-AO-N').
+        inplace : bool
+            If True, the cube is used without copy: the notch filter region
+            is set to zero in ``data``, and the clean cube is written in
+            ``data`` (``cleancube`` is then a view of ``data``). Otherwise
+            ``data`` is copied.
+
+        The other parameters are those of :class:`~zap.Zap`.
 
+        """
+        if (header is None) == (wave is None):
+            raise ValueError('either header or wave must be given')
+        data = np.asarray(data) if inplace else np.array(data)
+        if data.ndim != 3:
+            raise ValueError('data must be a 3D cube')
+
+        self = cls.__new__(cls)
+        self.cubefits = None
+        self.cube = data
+        self.ins_mode = ins_mode
+        self.context = context or ExecutionContext()
+        self._hduindex = None
+        self._primary_header = None
+        self._chunks = None
+        self._inplace = inplace
+
+        if header is not None:
+            self.header = fits.Header(header)
+            self.instrument = self.header.get('INSTRUME')
+            self._setwcs()
+        else:
+            self.header = fits.Header()
+            self.instrument = None
+            self.wcs = None
+            self.laxis = np.asarray(wave, dtype=float)
+            if self.laxis.shape != data.shape[:1]:
+                raise ValueError('wave must have one value per plane')
+
+        self._setup(pca_class=pca_class, n_components=n_components,
+                    cache=cache, progress=progress, cancel=cancel,
+                    skyseg=skyseg)
+        return self
+
+    def _setwcs(self):
+        """Compute the wavelength axis from the header."""
+        self.wcs, self.laxis = _wavelength_axis(self.header,
+                                                self.cube.shape[0])
+
+    def _setup(self, pca_class=None, n_components=None, cache=None,
+               progress=None, cancel=None, skyseg=None):
+        """Initialize the processing attributes, once the cube and the
+        wavelength axis are set."""
         # Change laser region into zeros if AO
-        if self.ins_mode in NOTCH_FILTER_RANGES:
-            logger.info('Cleaning laser region for AO, mode=%s, limits=%s',
-                        self.ins_mode, NOTCH_FILTER_RANGES[self.ins_mode])
-            self.notch_limits = self.wcs.all_world2pix(
-                NOTCH_FILTER_RANGES[self.ins_mode], 0)[0].astype(int)
+        self.notch_limits = _notch_limits(self.ins_mode, self.wcs, self.laxis)
+        if self.notch_limits is not None:
             lmin, lmax = self.notch_limits
             self.cube[lmin:lmax + 1] = 0.0
-        else:
-            self.notch_limits = None
 
         # NaN Cleaning
         self.run_clean = False
-        self.nancube = None
+        self.nanindex = None
+        self._badmap = None
+        self._nanfix = None
         self._boxsz = 1
         self._rejectratio = 0.25
 
         # Mask file
         self.maskfile = None
+        self.sky = None
+
+        # Region of interest, (y, x) slices of its bounding box
+        self.roi = None
+        self._roimask = None
+
+        # Mask of the edges, set to NaN in the output
+        self.edgemask = None
 
         # zlevel parameters
         self.run_zlevel = False
@@ -408,31 +1065,19 @@ class Zap(object):
         self.y = None
         self.x = None
 
+        # Continuum filter parameters
+        self._cftype = None
+        self._cfwidth = None
+
         # Normalization Maps
         self.contarray = None
+        self.contarraySVD = None
         self.variancearray = None
         self.normstack = None
 
-        # identify the spectral range of the dataset
-        laxmin = min(self.laxis)
-        laxmax = max(self.laxis)
-
-        # List of segmentation limits in the optical
-        skyseg = np.array(SKYSEG)
-        skyseg = skyseg[(skyseg > laxmin) & (skyseg < laxmax)]
-
-        # segment limit in angstroms
-        self.lranges = (np.vstack([np.append(laxmin - 10, skyseg),
-                                   np.append(skyseg, laxmax + 10)])).T
-
-        # segment limit in pixels
-        laxis = self.laxis
-        lranges = self.lranges
-        pranges = []
-        for i in range(len(lranges)):
-            paxis = wlaxis[(laxis > lranges[i, 0]) & (laxis <= lranges[i, 1])]
-            pranges.append((np.min(paxis), np.max(paxis) + 1))
-        self.pranges = np.array(pranges)
+        # segment limits in angstroms and in pixels
+        self.skyseg = list(SKYSEG if skyseg is None else skyseg)
+        self.lranges, self.pranges = _segment_ranges(self.laxis, self.skyseg)
 
         # eigenspace Subset
         if pca_class is not None:
@@ -443,38 +1088,185 @@ class Zap(object):
 
         # Reconstruction of sky features
         self.n_components = n_components
+        self.maxcomp = None
+        self._initbasis = None
         self.recon = None
+        self._coefs = None
         self.cleancube = None
 
+        # On-disk cache of the intermediate results
+        if isinstance(cache, str):
+            cache = StageCache(cache)
+        self.cache = cache
+        self._cachekey = None
+
+        # Progress reporting and cancellation
+        self.monitor = _Monitor(progress=progress, cancel=cancel)
+
+        # Parameters of the last run, and number of stages up to date
+        self.params = None
+        self._done = 0
+
     @timeit
     def _prepare(self, clean=True, zlevel='median', cftype='median',
-                 cfwidth=300, extzlevel=None, mask=None):
-        # clean up the nan values
-        if clean:
-            self._nanclean()
+                 cfwidth=300, extzlevel=None, mask=None, cfwidthSVD=None,
+                 roi=None, maskedges=None):
+        if self.cache is not None:
+            if self.cubefits is None:
+                self._cachekey = array_checksum(self.cube)
+            else:
+                self._cachekey = self.cache.checksum(self.cubefits)
 
-        # if mask is supplied, apply it
-        if mask is not None:
-            self._applymask(mask)
+        params = dict(clean=clean, rejectratio=self._rejectratio,
+                      boxsz=self._boxsz)
+        if roi is not None:
+            self._setroi(roi)
+            params['roi'] = self._roimask
 
-        # Extract the spectra that we will be working with
-        self._extract()
+        def extract():
+            # clean up the nan values
+            if clean:
+                self._nanclean()
+                self.monitor.update(0.5)
+
+            # Extract the spectra that we will be working with
+            self._extract()
+
+        self._stage('extract', extract,
+                    ('stack', 'y', 'x', 'nanindex', 'run_clean'), **params)
+
+        # mask the edges, using the NaN index computed for the extraction
+        if maskedges is not None:
+            self._mask_nan_edges(threshold=maskedges)
+
+        # if mask is supplied, select the sky spaxels
+        if mask is not None:
+            self._selectsky(mask)
 
         # remove the median along the spectral axis
         if extzlevel is None:
             if zlevel.lower() != 'none':
-                self._zlevel(calctype=zlevel)
+                self._stage('zlevel', lambda: self._zlevel(calctype=zlevel),
+                            ('zlsky', 'run_zlevel'),
+                            restore=self._subtract_zlevel, zlevel=zlevel,
+                            sky=self.sky)
         else:
             self._externalzlevel(extzlevel)
+            self._stage('zlevel', None, zlsky=self.zlsky)
 
         # remove the continuum level - this is multiprocessed to speed it up
-        self._continuumfilter(cfwidth=cfwidth, cftype=cftype)
+        self._stage('continuum',
+                    lambda: self._continuumfilter(cfwidth=cfwidth,
+                                                  cftype=cftype,
+                                                  cfwidthSVD=cfwidthSVD),
+                    ('contarray', 'contarraySVD', '_cftype', '_cfwidth'),
+                    restore=self._subtract_continuum,
+                    cftype=cftype, cfwidth=cfwidth, cfwidthSVD=cfwidthSVD)
 
         # normalize the variance in the segments.
-        self._normalize_variance()
+        self._stage('normalize', self._normalize_variance, ('variancearray',),
+                    restore=self._apply_variance, pranges=self.pranges)
+
+    def _fit_svd(self, clean=True, zlevel='median', cftype='median',
+                 cfwidth=300, mask=None, initSVD=None):
+        """Prepare the cube and compute the SVD, see :func:`~zap.SVDoutput`.
+        """
+        self._prepare(clean=clean, zlevel=zlevel, cftype=cftype,
+                      cfwidth=cfwidth, mask=mask)
+        if initSVD is not None:
+            self._warmstart(initSVD)
+        self._msvd()
+
+    def _sibling(self):
+        """Return a new Zap object for the same cube, with the same
+        settings."""
+        kwargs = dict(pca_class=self.pca_class, n_components=self.n_components,
+                      cache=self.cache, context=self.context,
+                      progress=self.monitor.progress,
+                      cancel=self.monitor.cancel, skyseg=self.skyseg)
+        if self.cubefits is not None:
+            return Zap(self.cubefits, **kwargs)
+        # the cube is only read to compute the SVD
+        if self.wcs is None:
+            return Zap.from_array(self.cube, wave=self.laxis, inplace=True,
+                                  ins_mode=self.ins_mode, **kwargs)
+        return Zap.from_array(self.cube, header=self.header, inplace=True,
+                              ins_mode=self.ins_mode, **kwargs)
+
+    def _roi_basis(self, initSVD=None, **params):
+        """Return the zlevel and the SVD of the full field, used for a run
+        with a ROI.
+
+        For a cube read from a file the basis is kept in an in-memory LRU
+        cache, keyed on the file, its modification time and the parameters,
+        so it is computed only once for several regions of the same cube.
+
+        """
+        def compute():
+            zobj = self._sibling()
+            zobj._fit_svd(initSVD=initSVD, **params)
+            if initSVD is not None:
+                return zobj
+            # only keep what is used for the ROI
+            basis = Zap.__new__(Zap)
+            for attr in BASIS_ATTRS:
+                setattr(basis, attr, getattr(zobj, attr))
+            return basis
+
+        if self.cubefits is None or initSVD is not None:
+            return compute()
+
+        path = os.path.realpath(self.cubefits)
+        mask = params['mask']
+        if mask is not None and not isinstance(mask, str):
+            mask = array_checksum(np.asarray(mask))
+        key = (path, os.stat(path).st_mtime_ns, self.pca_class,
+               self.n_components, tuple(self.skyseg),
+               tuple(sorted(dict(params, mask=mask).items())))
+        basis, cached = _roi_bases.get(key, compute)
+        if cached:
+            logger.info('Using the full-field basis of a previous run')
+        return basis
+
+    def _stage(self, name, compute, attrs=(), restore=None, **params):
+        """Run a stage, or restore its results from the cache.
+
+        Without cache this simply calls ``compute``. Otherwise the cache key is
+        updated with the stage parameters, and the attributes listed in
+        ``attrs`` are either loaded from the cache (and then ``restore`` is
+        called to apply them), or computed and saved to the cache. The start
+        and the end of the stage are reported to the monitor.
+
+        """
+        if compute is not None:
+            self.monitor.start(name)
+
+        if self.cache is None:
+            if compute is not None:
+                compute()
+                self.monitor.update(1)
+            return
+
+        self._cachekey = self.cache.key(self._cachekey, name, **params)
+        if compute is None:
+            return
+
+        data = self.cache.load(self._cachekey)
+        if data is None:
+            compute()
+            self.cache.save(self._cachekey,
+                            {attr: getattr(self, attr) for attr in attrs})
+        else:
+            logger.info('Using cached results for the %s stage', name)
+            for attr in attrs:
+                setattr(self, attr, data[attr])
+            if restore is not None:
+                restore()
+        self.monitor.update(1)
 
     def _run(self, clean=True, zlevel='median', cftype='median',
-             cfwidth=300, nevals=[], extSVD=None):
+             cfwidth=300, nevals=[], extSVD=None, mask=None, cfwidthSVD=None,
+             optimize='full', roi=None, maskedges=None, initSVD=None):
         """ Perform all steps to ZAP a datacube:
 
         - NaN re/masking,
@@ -487,42 +1279,120 @@ class Zap(object):
         - residual reconstruction and subtraction,
         - data cube reconstruction.
 
+        If ``cfwidthSVD`` is given, the continuum is computed with both widths
+        in the same pass, and the SVD is computed on the stack filtered with
+        ``cfwidthSVD``.
+
+        If ``roi`` is given, only the spaxels of the region are processed,
+        with the zlevel and the SVD computed on the full field (or taken from
+        ``extSVD``), so the result is the same as for the region in a full
+        run. The full-field basis of a cube file is kept in memory (see
+        `ROI_BASES`), so the next runs on other regions of the same cube with
+        the same parameters do not compute it again.
+
+        If ``initSVD`` is given, the SVD is computed by subspace iteration
+        starting from its basis (see :class:`~zap.SubspacePCA`).
+
         """
+        if roi is not None and extSVD is None:
+            extSVD = self._roi_basis(clean=clean, zlevel=zlevel, cftype=cftype,
+                                     cfwidth=cfwidthSVD or cfwidth, mask=mask,
+                                     initSVD=initSVD)
+            mask = cfwidthSVD = None
+        if nevals == [] and getattr(extSVD, '_initbasis', None) is not None:
+            # only the first eigenvectors were computed, so the criterion
+            # cannot be evaluated on the explained variance: use the number
+            # of components estimated on the full field
+            nevals = list(extSVD.nevals)
+
         self._prepare(clean=clean, zlevel=zlevel, cftype=cftype,
-                      cfwidth=cfwidth, extzlevel=extSVD)
+                      cfwidth=cfwidth, extzlevel=extSVD, mask=mask,
+                      cfwidthSVD=cfwidthSVD, roi=roi, maskedges=maskedges)
+        self._reconstruct_sky(nevals=nevals, extSVD=extSVD, optimize=optimize,
+                              initSVD=initSVD)
+
+        # the stages can be recomputed with set, except when the zlevel or
+        # the SVD come from another object (also with a ROI)
+        if extSVD is None and initSVD is None:
+            self.params = dict(clean=clean, zlevel=zlevel, mask=mask,
+                               cftype=cftype, cfwidth=cfwidth,
+                               cfwidthSVD=cfwidthSVD, optimize=optimize,
+                               nevals=nevals)
+            self._done = len(STAGES)
+
+    def _reconstruct_sky(self, nevals=[], extSVD=None, optimize='full',
+                         initSVD=None):
+        """Compute the SVD of the prepared stack (or use the one of
+        ``extSVD``), choose the eigenspectra, and reconstruct and subtract the
+        sky residuals."""
+        if optimize not in OPTIMIZE_OPTIONS:
+            raise ValueError('optimize must be full or incremental, got {}'
+                             .format(optimize))
+        if extSVD is not None or nevals != []:
+            optimize = 'full'
 
         # do the multiprocessed SVD calculation
         if extSVD is None:
+            if optimize == 'incremental':
+                # find the number of components before the SVD, to compute
+                # only the needed eigenvectors
+                self.monitor.start('optimize')
+                self.optimize(mode='incremental')
+            if initSVD is not None:
+                self._warmstart(initSVD, nevals=nevals)
             self._msvd()
+            self.contarraySVD = None
         else:
-            self.models = extSVD.models
+            # the components are modified by chooseevals, so the models are
+            # copied to allow using extSVD for several cubes
+            self.models = copy.deepcopy(extSVD.models)
 
         self.components = [m.components_.copy() for m in self.models]
 
         # choose some fraction of eigenspectra or some finite number of
         # eigenspectra
         if nevals == []:
-            self.optimize()
+            if optimize == 'full' and self._initbasis is None:
+                self.optimize()
             self.chooseevals(nevals=self.nevals)
         else:
             self.chooseevals(nevals=nevals)
 
         # reconstruct the sky residuals using the subset of eigenspace
+        self.monitor.start('reconstruct')
         self.reconstruct()
 
         # stuff the new spectra back into the cube
+        self.monitor.start('remold')
         self.remold()
+        self.monitor.update(1)
 
     def _nanclean(self):
         """
-        Detects NaN values in cube and removes them by replacing them with an
+        Detects NaN values in cube and computes their replacement with an
         interpolation of the nearest neighbors in the data cube. The positions
-        in the cube are retained in nancube for later remasking.
+        in the cube are retained in nanindex for later remasking.
+
+        The interpolated values are inserted in the stack by :meth:`_extract`,
+        this avoids to copy the cube.
         """
-        self.cube, self.nancube = _nanclean(
-            self.cube, rejectratio=self._rejectratio, boxsz=self._boxsz)
+        if self.nanindex is None:
+            self.nanindex = NanIndex(self.cube, nplanes=self.context.nplanes)
+        self._nanfix, self.nanindex, self._badmap = _nanclean(
+            self.cube, rejectratio=self._rejectratio, boxsz=self._boxsz,
+            nanindex=self.nanindex, spaxels=self._roimask)
         self.run_clean = True
 
+    @property
+    def nancube(self):
+        if not self.run_clean or self.nanindex is None:
+            return None
+        badmask = (self.nanindex.count >
+                   self._rejectratio * self.cube.shape[0])
+        nancube = self.nanindex.planes()
+        nancube &= ~badmask
+        return nancube
+
     @timeit
     def _extract(self):
         """Deconstruct the datacube into a 2d array.
@@ -535,15 +1405,83 @@ class Zap(object):
         Adds the x and y data of these positions into the Zap class
 
         """
-        # make a map of spaxels with NaNs
-        badmap = (np.logical_not(np.isfinite(self.cube))).sum(axis=0)
+        # make a map of spaxels with NaNs, the one computed by _nanclean if
+        # it was run
+        if self._badmap is None:
+            if self.nanindex is None:
+                self.nanindex = NanIndex(self.cube,
+                                         nplanes=self.context.nplanes)
+            self._badmap = self.nanindex.count
         # get positions of those with no NaNs
-        self.y, self.x = np.where(badmap == 0)
+        valid = self._badmap == 0
+        if self._roimask is not None:
+            valid &= self._roimask
+        self.y, self.x = np.where(valid)
         # extract those positions into a 2d array
-        self.stack = self.cube[:, self.y, self.x]
+        monitor = self.monitor.part(0.5, 1) if self.run_clean else \
+            self.monitor
+        self.stack = _extract_stack(self.cube, self.y, self.x,
+                                    nplanes=self.context.nplanes,
+                                    monitor=monitor)
+
+        if self._nanfix is not None:
+            # insert the interpolated values of the extracted spaxels
+            z, y, x, values = self._nanfix
+            column = np.full(self.cube.shape[1:], -1)
+            column[self.y, self.x] = np.arange(self.y.size)
+            column = column[y, x]
+            valid = column >= 0
+            self.stack[z[valid], column[valid]] = values[valid]
+            self._nanfix = None
+
         logger.info('Extract to 2D, %d valid spaxels (%d%%)', len(self.x),
                     len(self.x) / np.prod(self.cube.shape[1:]) * 100)
 
+    def _mask_nan_edges(self, threshold=50):
+        """Compute the mask of the edges of the cube, which are set to NaN in
+        the output. See :func:`~zap.mask_nan_edges`."""
+        logger.info('Masking the edges with more than %.1f%% of NaNs',
+                    threshold)
+        if self.nanindex is None:
+            self.nanindex = NanIndex(self.cube, nplanes=self.context.nplanes)
+        self.edgemask = nan_edges_mask(self.nanindex.count,
+                                       self.cube.shape[0], threshold=threshold)
+
+    def _setroi(self, roi):
+        """Restrict the processing to a region of interest.
+
+        ``roi`` can be a tuple of (y, x) slices, or a 2D mask (>=1 for the
+        spaxels to process) given as an array or a FITS file. The output cubes
+        are cropped to the bounding box of the region, and the spaxels of the
+        bounding box which are outside the mask are left unchanged.
+
+        """
+        if isinstance(roi, str):
+            roi = fits.getdata(roi)
+        if isinstance(roi, tuple):
+            mask = np.zeros(self.cube.shape[1:], dtype=bool)
+            mask[roi] = True
+        else:
+            mask = np.asarray(roi).astype(bool)
+            if mask.shape != self.cube.shape[1:]:
+                raise ValueError('the ROI mask must have the same shape as '
+                                 'the images of the cube')
+        if not mask.any():
+            raise ValueError('the ROI is empty')
+
+        y, x = np.where(mask)
+        self.roi = (slice(y.min(), y.max() + 1), slice(x.min(), x.max() + 1))
+        self._roimask = mask
+        logger.info('Using a ROI of %d spaxels, output region [%d:%d, %d:%d]',
+                    np.count_nonzero(mask), self.roi[0].start,
+                    self.roi[0].stop, self.roi[1].start, self.roi[1].stop)
+
+        # shift the spatial WCS to the output region
+        self.header = self.header.copy()
+        for key, sl in (('CRPIX1', self.roi[1]), ('CRPIX2', self.roi[0])):
+            if key in self.header:
+                self.header[key] -= sl.start
+
     def _externalzlevel(self, extSVD):
         """Remove the zero level from the extSVD file."""
         logger.debug('Using external zlevel from %s', extSVD)
@@ -577,21 +1515,31 @@ class Zap(object):
             logger.info('Skipping zlevel subtraction')
             return
 
+        index = None if self.sky is None else np.flatnonzero(self.sky)
         if calctype == 'median':
             logger.info('Median zlevel subtraction')
-            func = _imedian
+            # computed with threads, directly on the stack
+            self.zlsky = _median_planes(self.stack, index=index,
+                                        nthreads=self.context.ncpu,
+                                        nplanes=self.context.nplanes,
+                                        monitor=self.monitor)
         elif calctype == 'sigclip':
             logger.info('Iterative Sigma Clipping zlevel subtraction')
-            func = _isigclip
+            stack = self.stack if index is None else self.stack[:, index]
+            self.zlsky = np.hstack(self.context.map(
+                _isigclip, stack, axis=0, monitor=self.monitor,
+                nplanes=self.context.nplanes))
         else:
             raise ValueError('Unknow zlevel type, must be none, median, or '
                              'sigclip')
+        self._subtract_zlevel()
 
-        self.zlsky = np.hstack(parallel_map(func, self.stack, NCPU, axis=0))
+    def _subtract_zlevel(self):
         self.stack -= self.zlsky[:, np.newaxis]
 
     @timeit
-    def _continuumfilter(self, cfwidth=300, cftype='median'):
+    def _continuumfilter(self, cfwidth=300, cftype='median', cfwidthSVD=None,
+                         reuse=False):
         """A multiprocessed implementation of the continuum removal.
 
         This process distributes the data to many processes that then
@@ -603,28 +1551,68 @@ class Zap(object):
         contarray - the removed continuua
         normstack - "normalized" version of the stack with the continuua
             removed
+        contarraySVD - the continuua computed with cfwidthSVD, if it is given
+            and differs from cfwidth
+
+        With ``reuse``, the arrays of a previous run are overwritten instead
+        of allocating new ones.
 
         """
         if cftype not in CFTYPE_OPTIONS:
-            raise ValueError("cftype must be median, fit or none, got {}"
-                             .format(cftype))
+            raise ValueError("cftype must be {}, got {}".format(
+                ', '.join(CFTYPE_OPTIONS), cftype))
         logger.info('Applying Continuum Filter, cftype=%s', cftype)
         self._cftype = cftype
         self._cfwidth = cfwidth
 
         # remove continuum features
         if cftype == 'none':
-            self.normstack = self.stack.copy()
+            self.contarray = self.contarraySVD = None
         else:
             if cftype == 'fit' and self.instrument != 'MUSE':
                 warnings.warn('the continuum fit method is currently adapted '
                               'to MUSE and should not be used for other '
                               'instruments', UserWarning)
 
-            self.contarray = _continuumfilter(self.stack, cftype,
-                                              cfwidth=cfwidth,
-                                              notch_limits=self.notch_limits)
-            self.normstack = self.stack - self.contarray
+            if cfwidthSVD is None or cfwidthSVD == cfwidth:
+                names, widths = ['contarray'], [cfwidth]
+            else:
+                names = ['contarray', 'contarraySVD']
+                widths = [cfwidth, cfwidthSVD]
+            out = None
+            if reuse and cftype != 'fit':
+                # the fit computes a new (float64) array anyway
+                out = [self._buffer(name) for name in names]
+                out = [np.zeros_like(self.stack) if arr is None else arr
+                       for arr in out]
+            res = _continuumfilter(
+                self.stack, cftype, cfwidth=widths,
+                notch_limits=self.notch_limits, context=self.context,
+                monitor=self.monitor, out=out)
+            self.contarraySVD = None
+            for name, arr in zip(names, res):
+                setattr(self, name, arr)
+        self._subtract_continuum(reuse=reuse)
+
+    def _subtract_continuum(self, reuse=False):
+        out = self._buffer('normstack') if reuse else None
+        if self.contarray is None:
+            if out is None:
+                self.normstack = self.stack.copy(order='K')
+            else:
+                np.copyto(out, self.stack)
+        else:
+            self.normstack = np.subtract(self.stack, self.contarray, out=out)
+
+    def _buffer(self, name):
+        """Return the array ``name`` if it can receive a new result with the
+        shape and layout of the stack, None otherwise."""
+        arr = getattr(self, name)
+        if arr is None or arr.shape != self.stack.shape or \
+                arr.dtype != self.stack.dtype or \
+                arr.flags.f_contiguous != self.stack.flags.f_contiguous:
+            return None
+        return arr
 
     def _normalize_variance(self):
         """Normalize the variance in the segments."""
@@ -637,7 +1625,11 @@ class Zap(object):
         for i in range(nseg):
             pmin, pmax = self.pranges[i]
             var[i, :] = np.var(self.normstack[pmin:pmax, :], axis=0)
-            self.normstack[pmin:pmax, :] /= var[i, :]
+        self._apply_variance()
+
+    def _apply_variance(self):
+        for i, (pmin, pmax) in enumerate(self.pranges):
+            self.normstack[pmin:pmax, :] /= self.variancearray[i, :]
 
     @timeit
     def _msvd(self):
@@ -647,22 +1639,94 @@ class Zap(object):
         to the individual svd methods.
 
         """
+        init = None
+        if self._initbasis is not None:
+            init = np.concatenate([b.ravel() for b in self._initbasis])
+        self._stage('svd', self._fit_models, ('models',),
+                    pca_class=self.pca_class, n_components=self.n_components,
+                    maxcomp=self.maxcomp, sky=self.sky, init=init,
+                    separate=self.contarraySVD is not None)
+
+    def _warmstart(self, initSVD, nevals=[]):
+        """Use the basis of ``initSVD`` as initial subspace for the SVD.
+
+        Unless the ``nevals`` are given or already estimated, the number of
+        eigenspectra is estimated on this cube with the incremental criterion
+        (see :meth:`optimize`), since only the first eigenvectors are refined.
+        The number of computed eigenvectors (``maxcomp``) is the number of
+        eigenspectra of the initial basis, or the number of eigenspectra used
+        if larger.
+
+        """
+        self._initbasis, initnevals = _initial_basis(initSVD, self.pranges)
+        if len(nevals):
+            nused = [int(np.max(nevals))] * len(initnevals)
+        else:
+            if getattr(self, 'nevals', None) is None:
+                self.optimize(mode='incremental')
+                # only the used eigenvectors are refined
+                self.maxcomp = None
+            nused = np.asarray(self.nevals)
+            if nused.ndim == 2:
+                nused = nused[:, 1]
+        if self.maxcomp is None:
+            self.maxcomp = [max(n, int(m)) for n, m in zip(initnevals, nused)]
+
+    def _svd_segments(self):
+        """Return the list of (nspaxels, nlambda) arrays used for the SVD,
+        for each segment."""
+        indices = [x[0] for x in self.pranges[1:]]
+        if self.contarraySVD is not None:
+            # normalized stack computed with the continuum for the SVD
+            if self.sky is not None:
+                normstack = (self.stack[:, self.sky] -
+                             self.contarraySVD[:, self.sky])
+            else:
+                normstack = self.stack - self.contarraySVD
+            for pmin, pmax in self.pranges:
+                normstack[pmin:pmax] /= np.var(normstack[pmin:pmax], axis=0)
+        elif self.sky is not None:
+            normstack = self.normstack[:, self.sky]
+        else:
+            normstack = self.normstack
+        return np.array_split(normstack.T, indices, axis=1)
+
+    def _fit_models(self):
         logger.info('Calculating SVD on %d segments (%s)', len(self.pranges),
                     self.pranges)
-        indices = [x[0] for x in self.pranges[1:]]
-        # normstack = self.stack - self.contarray
-        Xarr = np.array_split(self.normstack.T, indices, axis=1)
+        Xarr = self._svd_segments()
 
         self.models = []
         for i, x in enumerate(Xarr):
-            if self.n_components is not None:
+            if self._initbasis is not None:
+                model = SubspacePCA(n_components=self.maxcomp[i],
+                                    init=self._initbasis[i]).fit(x)
+                logger.info('Segment %d, %d eigenvectors refined in %d '
+                            'iterations (residual %.2g, converged: %s)', i,
+                            model.n_components_, model.n_iter_,
+                            model.residuals_.max(), model.converged_)
+                self.models.append(model)
+                self.monitor.update((i + 1) / len(Xarr))
+                continue
+
+            kwargs = {}
+            if self.maxcomp is not None:
+                ncomp = self.maxcomp[i]
+                if self.pca_class is PCA and ncomp < min(x.shape):
+                    # the randomized solver, used by default for a small
+                    # number of components, is not accurate enough here
+                    kwargs['svd_solver'] = 'arpack'
+            elif self.n_components is not None:
                 ncomp = max(x.shape[1] * self.n_components, 60)
-                logger.info('Segment %d, computing %d eigenvectors out of %d',
-                            i, ncomp, x.shape[1])
             else:
                 ncomp = None
+            if ncomp is not None:
+                logger.info('Segment %d, computing %d eigenvectors out of %d',
+                            i, ncomp, x.shape[1])
 
-            self.models.append(self.pca_class(n_components=ncomp).fit(x))
+            self.models.append(
+                self.pca_class(n_components=ncomp, **kwargs).fit(x))
+            self.monitor.update((i + 1) / len(Xarr))
 
     def chooseevals(self, nevals=[]):
         """Choose the number of eigenspectra/evals to use for reconstruction.
@@ -707,36 +1771,72 @@ class Zap(object):
         eigenvalues
         """
         logger.info('Reconstructing Sky Residuals')
-        indices = [x[0] for x in self.pranges[1:]]
-        # normstack = self.stack - self.contarray
-        Xarr = np.array_split(self.normstack.T, indices, axis=1)
-        Xnew = [model.transform(x)
-                for model, x in zip(self.models, Xarr)]
-        Xinv = [model.inverse_transform(x)
-                for model, x in zip(self.models, Xnew)]
-        self.recon = np.concatenate([x.T * self.variancearray[i, :]
-                                     for i, x in enumerate(Xinv)])
-        # self.recon = np.concatenate([x.T for x in Xinv])
-        # self.recon *= self.variancearray[:, np.newaxis]
-
-    def make_cube_from_stack(self, stack, with_nans=False):
-        """Stuff the stack back into a cube."""
-        cube = self.cube.copy()
-        cube[:, self.y, self.x] = stack
+        # the coefficients are kept for the low-rank sky model
+        (self._coefs, self.recon), = _reconstruct(
+            self.models, self.pranges, [self.normstack], [self.variancearray])
+
+    def _roi_view(self):
+        """Return the part of the cube covered by the ROI (the full cube if
+        there is no ROI), and the positions of the extracted spaxels in it.
+        """
+        if self.roi is None:
+            return self.cube, self.y, self.x
+        ys, xs = self.roi
+        return self.cube[:, ys, xs], self.y - ys.start, self.x - xs.start
+
+    def make_cube_from_stack(self, stack, with_nans=False, inplace=False,
+                             out=None):
+        """Stuff the stack back into a cube, cropped to the ROI if any. With
+        ``inplace`` the input cube is modified instead of a copy, and the
+        copy can be written in an existing array ``out``."""
+        cube, y, x = self._roi_view()
+        if inplace:
+            pass
+        elif out is not None:
+            np.copyto(out, cube)
+            cube = out
+        else:
+            cube = cube.copy()
+        _insert_stack(cube, stack, y, x)
         if with_nans:
-            cube[self.nancube] = np.nan
+            # the NaN values that were cleaned are only in the valid spaxels,
+            # the other ones still have their original NaNs
+            self.nanindex.apply(cube, region=self.roi)
+        if self.edgemask is not None:
+            edgemask = self.edgemask
+            if self.roi is not None:
+                edgemask = edgemask[self.roi]
+            cube[:, edgemask] = np.nan
         if self.ins_mode in NOTCH_FILTER_RANGES:
             lmin, lmax = self.notch_limits
             cube[lmin:lmax + 1] = np.nan
         return cube
 
-    def remold(self):
+    def remold(self, reuse=False):
         """ Subtracts the reconstructed residuals and places the cleaned
-        spectra into the duplicated datacube.
+        spectra into the duplicated datacube. With ``reuse`` the previous
+        clean cube is overwritten.
         """
         logger.info('Applying correction and reshaping data product')
+        out = self.cleancube if reuse else None
         self.cleancube = self.make_cube_from_stack(self.stack - self.recon,
-                                                   with_nans=self.run_clean)
+                                                   with_nans=self.run_clean,
+                                                   inplace=self._inplace,
+                                                   out=out)
+
+    def make_skycube(self):
+        """Return the subtracted sky, i.e. the input cube minus the clean
+        cube, cropped to the ROI if any."""
+        if not self._inplace:
+            return self._roi_view()[0] - self.cleancube
+
+        # the input cube was replaced by the clean cube, so the sky is
+        # computed from the zlevel and the reconstructed residuals
+        sky = np.zeros(self.cleancube.shape, dtype=self.cleancube.dtype)
+        _, y, x = self._roi_view()
+        _insert_stack(sky, self.recon + self.zlsky[:, np.newaxis], y, x)
+        sky[np.isnan(self.cleancube)] = np.nan
+        return sky
 
     def reprocess(self, nevals=[]):
         """ A method that redoes the eigenvalue selection, reconstruction, and
@@ -746,7 +1846,151 @@ class Zap(object):
         self.reconstruct()
         self.remold()
 
-    def optimize(self):
+    def set(self, **params):
+        """Change parameters of the run, and recompute only the stages which
+        depend on them.
+
+        The stages of a run (``zap.zap.STAGES``) form a chain: nanclean,
+        extract, zlevel, continuum, normalize, svd, reconstruct and remold. A
+        changed parameter invalidates its stage and the next ones, which are
+        then recomputed, the previous ones being kept. E.g. with
+        ``zobj.set(cfwidth=50)`` the NaN cleaning, the extraction and the
+        zlevel are reused, and with ``zobj.set(zlevel='sigclip')`` the
+        previous zlevel is added back to the stack instead of extracting it
+        again (which is exact up to the rounding errors).
+
+        The arrays of the previous results (``contarray``, ``normstack``,
+        ``cleancube``, ...) are overwritten when possible, to avoid new
+        allocations, so they must be copied to be kept. The cache is not
+        used by the recomputed stages.
+
+        This requires a previous run, e.g. with
+        ``process(..., interactive=True)``, which did not use ``extSVD`` or
+        ``initSVD``. With ``Zap.from_array(..., inplace=True)``, the input
+        cube was replaced by the clean cube so the NaN cleaning and the
+        extraction cannot be recomputed.
+
+        Parameters
+        ----------
+        clean, zlevel, mask, cftype, cfwidth, cfwidthSVD, optimize, nevals
+            The parameters of :func:`~zap.process`, ``cfwidth`` being
+            ``cfwidthSP``.
+
+        Returns
+        -------
+        list of str
+            The recomputed stages.
+
+        """
+        if self.params is None:
+            raise ValueError('set needs a previous run without extSVD, '
+                             'initSVD or roi')
+
+        names = [name for name, _ in STAGES]
+        first = len(STAGES)
+        for key, value in params.items():
+            stage = [i for i, (_, keys) in enumerate(STAGES) if key in keys]
+            if not stage:
+                raise ValueError('unknown parameter {}, must be {}'.format(
+                    key, ', '.join(self.params)))
+            if not _same_value(self.params[key], value):
+                first = min(first, stage[0])
+
+        new = dict(self.params, **params)
+        if first == names.index('svd') and new['cftype'] != 'none' and \
+                new['cfwidthSVD'] not in (None, new['cfwidth']):
+            # the continuum for the SVD is deleted after the SVD
+            first = names.index('continuum')
+
+        if self._inplace and min(first, self._done) <= names.index('extract'):
+            raise ValueError('the cube was modified in place, the NaN '
+                             'cleaning and the extraction cannot be '
+                             'recomputed')
+        if params.get('zlevel', 'none') not in ('none', 'median', 'sigclip'):
+            raise ValueError('Unknow zlevel type, must be none, median, or '
+                             'sigclip')
+        if params.get('cftype', self.params['cftype']) not in CFTYPE_OPTIONS:
+            raise ValueError("cftype must be {}, got {}".format(
+                ', '.join(CFTYPE_OPTIONS), params['cftype']))
+        if params.get('optimize', 'full') not in OPTIMIZE_OPTIONS:
+            raise ValueError('optimize must be full or incremental, got {}'
+                             .format(params['optimize']))
+
+        self.params.update(params)
+        self._done = min(self._done, first)
+        return self.update()
+
+    def update(self):
+        """Recompute the stages invalidated by :meth:`set`, and return their
+        names."""
+        updated = []
+        cache, self.cache = self.cache, None
+        try:
+            for name, _ in STAGES[self._done:]:
+                self._stage(name, getattr(self, '_update_' + name))
+                self._done += 1
+                updated.append(name)
+        finally:
+            self.cache = cache
+        if updated:
+            logger.info('Recomputed the stages: %s', ', '.join(updated))
+        return updated
+
+    def _update_nanclean(self):
+        self._badmap = None
+        self._nanfix = None
+        self.run_clean = False
+        if self.params['clean']:
+            self._nanclean()
+
+    def _update_extract(self):
+        self._extract()
+        # the new stack has no zlevel subtracted
+        self.run_zlevel = False
+
+    def _update_zlevel(self):
+        if self.run_zlevel not in (False, 'none'):
+            # restore the stack before the zlevel subtraction
+            self.stack += self.zlsky[:, np.newaxis]
+        self.zlsky = np.zeros_like(self.laxis)
+        self.sky = None
+        self.maskfile = None
+        if self.params['mask'] is not None:
+            self._selectsky(self.params['mask'])
+        self._zlevel(calctype=self.params['zlevel'])
+
+    def _update_continuum(self):
+        self._continuumfilter(cfwidth=self.params['cfwidth'],
+                              cftype=self.params['cftype'],
+                              cfwidthSVD=self.params['cfwidthSVD'],
+                              reuse=True)
+
+    def _update_normalize(self):
+        self._normalize_variance()
+
+    def _update_svd(self):
+        self.maxcomp = None
+        if self.params['optimize'] == 'incremental' and \
+                np.size(self.params['nevals']) == 0:
+            self.optimize(mode='incremental')
+        self._fit_models()
+        self.contarraySVD = None
+        self.components = [m.components_.copy() for m in self.models]
+
+    def _update_reconstruct(self):
+        nevals = self.params['nevals']
+        if np.size(nevals) == 0:
+            if self.maxcomp is None:
+                # all the eigenvectors were computed
+                self.optimize()
+            nevals = self.nevals
+        self.chooseevals(nevals=nevals)
+        self.reconstruct()
+
+    def _update_remold(self):
+        self.remold(reuse=True)
+
+    def optimize(self, mode='full'):
         """Compute the optimal number of components needed to characterize
         the residuals.
 
@@ -756,14 +2000,30 @@ class Zap(object):
         this occurs, the linear reduction in variance is attributable to the
         removal of astronomical features rather than emission line residuals.
 
+        With ``mode='full'`` the variance curve is the explained variance of
+        the SVD models. With ``mode='incremental'``, the SVD is not needed:
+        the eigenvalues of the covariance matrix of each segment are computed
+        by blocks of increasing size, until the criterion is reached. The
+        number of computed eigenvalues is stored in ``maxcomp``, and can be
+        used to compute only the needed eigenvectors.
+
         """
-        logger.info('Compute number of components')
+        logger.info('Compute number of components, mode=%s', mode)
         ncomp = []
-        for model in self.models:
-            var = model.explained_variance_
-            deriv, mn1, std1 = _compute_deriv(var)
-            cross = np.append([False], deriv >= (mn1 - std1))
-            ncomp.append(np.where(cross)[0][0])
+        if mode == 'full':
+            for model in self.models:
+                ncomp.append(_optimal_ncomp(model.explained_variance_))
+        elif mode == 'incremental':
+            self.maxcomp = []
+            for i, x in enumerate(self._svd_segments()):
+                nev, neig = _estimate_nevals(x)
+                logger.info('Segment %d, %d components, using %d eigenvalues '
+                            'out of %d', i, nev, neig, min(x.shape))
+                ncomp.append(nev)
+                self.maxcomp.append(neig)
+        else:
+            raise ValueError('mode must be full or incremental, got {}'
+                             .format(mode))
 
         self.nevals = np.array(ncomp)
 
@@ -772,42 +2032,90 @@ class Zap(object):
 
         Takes the continuum stack and returns it into a familiar cube form.
         """
-        contcube = self.cube.copy() * np.nan
-        contcube[:, self.y, self.x] = self.contarray
+        cube, y, x = self._roi_view()
+        contcube = cube.copy() * np.nan
+        _insert_stack(contcube, self.contarray, y, x)
         return contcube
 
-    def _applymask(self, mask):
-        """Apply a mask to the input data to provide a cleaner basis set.
+    def _selectsky(self, mask):
+        """Select the sky spaxels of the stack, to provide a cleaner basis
+        set.
 
         mask is >1 for objects, 0 for sky so that people can use sextractor.
-        The file is read with ``astropy.io.fits.getdata`` which first tries to
-        read the primary extension, then the first extension is no data was
-        found before.
+        It can be an array or a FITS file, read with
+        ``astropy.io.fits.getdata`` which first tries to read the primary
+        extension, then the first extension is no data was found before. The
+        cube is not modified, the masked spaxels are only excluded from the
+        zlevel and SVD computations.
 
         """
-        logger.info('Applying Mask for SVD Calculation from %s', mask)
-        self.maskfile = mask
-        mask = fits.getdata(mask).astype(bool)
-        nmasked = np.count_nonzero(mask)
-        logger.info('Masking %d pixels (%d%%)', nmasked,
-                    nmasked / np.prod(mask.shape) * 100)
-        self.cube[:, mask] = np.nan
-
-    def writecube(self, outcubefits='DATACUBE_ZAP.fits', overwrite=False):
-        """Write the processed datacube to an individual fits file."""
-        outhead = _newheader(self)
-        outhdu = fits.PrimaryHDU(data=self.cleancube, header=outhead)
-        outhdu.writeto(outcubefits, overwrite=overwrite)
+        if isinstance(mask, str):
+            logger.info('Selecting sky spaxels from %s', mask)
+            self.maskfile = mask
+            mask = fits.getdata(mask)
+        mask = np.asarray(mask).astype(bool)
+        self.sky = ~mask[self.y, self.x]
+        logger.info('Using %d sky spaxels out of %d',
+                    np.count_nonzero(self.sky), self.sky.size)
+
+    def writecube(self, outcubefits='DATACUBE_ZAP.fits', overwrite=False,
+                  compress=None):
+        """Write the processed datacube to an individual fits file,
+        tile-compressed if ``compress`` is given (see :func:`~zap.process`).
+        """
+        self._writeimage(outcubefits, self.cleancube, compress=compress,
+                         overwrite=overwrite)
         logger.info('Cube file saved to %s', outcubefits)
 
-    def writeskycube(self, skycubefits='SKYCUBE_ZAP.fits', overwrite=False):
-        """Write the processed datacube to an individual fits file."""
-        outcube = self.cube - self.cleancube
-        outhead = _newheader(self)
-        outhdu = fits.PrimaryHDU(data=outcube, header=outhead)
-        outhdu.writeto(skycubefits, overwrite=overwrite)
+    def writeskycube(self, skycubefits='SKYCUBE_ZAP.fits', overwrite=False,
+                     compress=None):
+        """Write the subtracted sky to an individual fits file,
+        tile-compressed if ``compress`` is given (see :func:`~zap.process`).
+        """
+        outcube = self.make_skycube()
+        self._writeimage(skycubefits, outcube, compress=compress,
+                         overwrite=overwrite)
         logger.info('Sky cube file saved to %s', skycubefits)
 
+    def _writeimage(self, filename, data, compress=None, overwrite=False):
+        """Write a cube to a FITS file, or to a chunked HDF5 or Zarr file
+        (from the extension of ``filename``) with the chunks of the input
+        cube if it was chunked. The chunked files are always compressed
+        losslessly, ``compress`` is only used for FITS."""
+        if cube_format(filename) == 'fits':
+            write_image(filename, data, _newheader(self), compress=compress,
+                        overwrite=overwrite)
+        else:
+            write_cube(filename, data, _newheader(self),
+                       primary_header=self._primary_header,
+                       chunks=self._chunks or 'bricks',
+                       nthreads=self.context.ncpu, overwrite=overwrite)
+
+    def writeskymodel(self, skymodelfits='SKYMODEL_ZAP.fits',
+                      overwrite=False):
+        """Write the low-rank model of the subtracted sky to a fits file.
+
+        This is much smaller than the sky cube: it contains the zlevel, the
+        eigenspectra, and the coefficients and variance of each spaxel. The
+        sky can then be reconstructed for any region with
+        :class:`~zap.SkyModel`.
+
+        With a ROI, the model is stored in the frame of the full cube (the
+        positions of the spaxels and the spatial WCS), the spaxels outside
+        the region having no sky.
+
+        """
+        if self._coefs is None:
+            raise ValueError('run reconstruct first')
+        header = self.header.copy()
+        if self.roi is not None:
+            # undo the shift of the WCS to the output region
+            for key, sl in (('CRPIX1', self.roi[1]), ('CRPIX2', self.roi[0])):
+                if key in header:
+                    header[key] += sl.start
+        write_skymodel(self, skymodelfits, _newheader(self, header),
+                       overwrite=overwrite)
+
     def writevarcurve(self, varcurvefits='VARCURVE_ZAP.fits', overwrite=False):
         """Write the explained variance curves to an individual fits file."""
         from astropy.table import Table
@@ -817,25 +2125,72 @@ class Zap(object):
         hdu.writeto(varcurvefits, overwrite=overwrite)
         logger.info('Variance curve file saved to %s', varcurvefits)
 
-    def mergefits(self, outcubefits, overwrite=False):
-        """Merge the ZAP cube into the full muse datacube and write."""
+    def _crop_extensions(self, hdul, index):
+        """Crop the images of a HDUList (except the cube at ``index``) that
+        have the spatial shape of the cube to the ROI, and shift their WCS.
+        """
+        ys, xs = self.roi
+        for i, hdu in enumerate(hdul):
+            shape = hdu.shape if hdu.is_image and i != index else ()
+            if len(shape) < 2 or shape[-2:] != self.cube.shape[1:]:
+                continue
+            hdu.data = hdu.data[..., ys, xs]
+            for key, sl in (('CRPIX1', xs), ('CRPIX2', ys)):
+                if key in hdu.header:
+                    hdu.header[key] -= sl.start
+
+    def mergefits(self, outcubefits, overwrite=False, compress=None):
+        """Merge the ZAP cube into the full muse datacube and write.
+
+        If ``compress`` is given the cube is tile-compressed (see
+        :func:`~zap.process`), and for the instruments storing the cube in the
+        primary HDU it is then stored in the first extension.
+
+        If ``outcubefits`` is a HDF5 (.h5, .hdf5) or Zarr (.zarr) file, the
+        cube is written with its headers in this format (see
+        :func:`~zap.write_cube`). If the input cube was read from such a
+        file, the FITS output contains the primary header and the cube in a
+        DATA extension.
+
+        With a ROI, the other images of the file with the spatial shape of
+        the cube (e.g. the variance and the data quality of MUSE cubes) are
+        cropped to the same region as the clean cube.
+
+        """
+        if self.instrument not in ('MUSE', 'KCWI', 'FOCAS', 'WIFES'):
+            raise ValueError('unsupported instrument %s' % self.instrument)
+        if cube_format(outcubefits) != 'fits':
+            self._writeimage(outcubefits, self.cleancube, overwrite=overwrite)
+            logger.info('Cube file saved to %s', outcubefits)
+            return
+
         # make sure it has the right extension
         outcubefits = outcubefits.split('.fits')[0] + '.fits'
+        index = self._hduindex
+        if index is None:
+            hdul = fits.HDUList([
+                fits.PrimaryHDU(header=self._primary_header),
+                image_hdu(self.cleancube, _newheader(self),
+                          compress=compress, name='DATA')])
+            hdul.writeto(outcubefits, overwrite=overwrite)
+            logger.info('Cube file saved to %s', outcubefits)
+            return
+
         with fits.open(self.cubefits) as hdu:
-            if self.instrument == 'MUSE':
-                hdu[1].header = _newheader(self)
-                hdu[1].data = self.cleancube
-            elif self.instrument == 'KCWI':
-                hdu[0].header = _newheader(self)
-                hdu[0].data = self.cleancube
-            elif self.instrument == 'FOCAS':
-                hdu[0].header = _newheader(self)
-                hdu[0].data = self.cleancube
-            elif self.instrument == 'WIFES':
+            if self.roi is not None:
+                self._crop_extensions(hdu, index)
+            if index == 0 and compress is None:
                 hdu[0].header = _newheader(self)
                 hdu[0].data = self.cleancube
+            elif index == 0:
+                # a compressed image cannot be stored in the primary HDU
+                hdu[0].data = None
+                hdu.insert(1, image_hdu(self.cleancube, _newheader(self),
+                                        compress=compress))
             else:
-                raise ValueError('unsupported instrument %s' % self.instrument)
+                hdu[index] = image_hdu(self.cleancube, _newheader(self),
+                                       compress=compress,
+                                       name=hdu[index].name)
 
             hdu.writeto(outcubefits, overwrite=overwrite)
         logger.info('Cube file saved to %s', outcubefits)
@@ -881,9 +2236,13 @@ class Zap(object):
 # ================= Helper Functions =================
 
 def worker(f, i, chunk, out_q, err_q, kwargs):
+    # the parent may have a handler for SIGTERM, used to terminate the workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
     try:
         result = f(i, chunk, **kwargs)
     except Exception as e:
+        # the traceback is lost when the exception is sent to the parent
+        e.worker_traceback = traceback.format_exc()
         err_q.put(e)
         return
 
@@ -891,11 +2250,50 @@ def worker(f, i, chunk, out_q, err_q, kwargs):
     out_q.put((i, result))
 
 
+def _wait_futures(futures, monitor=None, timeout=0.1):
+    """Wait for futures, reporting the progress and checking the
+    cancellation. On error or cancellation, the pending futures are
+    cancelled and the exception is raised."""
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+            if monitor is not None:
+                monitor.update(1 - len(pending) / len(futures))
+    finally:
+        for future in pending:
+            future.cancel()
+    return [future.result() for future in futures]
+
+
 def parallel_map(func, arr, indices, **kwargs):
     logger.debug('Running function %s with %s chunks', func.__name__, indices)
     axis = kwargs.pop('axis', None)
+    executor = kwargs.pop('executor', None)
+    monitor = kwargs.pop('monitor', None)
     if isinstance(indices, (int, np.integer)) and indices == 1:
-        return [func(0, arr, **kwargs)]
+        if monitor is not None:
+            monitor.check()
+        res = [func(0, arr, **kwargs)]
+        if monitor is not None:
+            monitor.update(1)
+        return res
+
+    if executor is not None:
+        chunks = np.array_split(arr, indices, axis=axis)
+        split_arrays = kwargs.pop('split_arrays', None)
+        if split_arrays is not None:
+            split_arrays = [np.array_split(a, indices, axis=axis)
+                            for a in split_arrays]
+        futures = []
+        for i, chunk in enumerate(chunks):
+            if split_arrays:
+                kwargs['split_arrays'] = [s[i] for s in split_arrays]
+            futures.append(executor.submit(func, i, chunk, **kwargs))
+        return _wait_futures(futures, monitor=monitor)
 
     manager = Manager()
     out_q = manager.Queue()
@@ -908,29 +2306,295 @@ def parallel_map(func, arr, indices, **kwargs):
     else:
         split_arrays = None
 
-    for i, chunk in enumerate(chunks):
-        if split_arrays:
-            kwargs['split_arrays'] = [s[i] for s in split_arrays]
-        p = Process(target=worker, args=(func, i, chunk, out_q, err_q, kwargs))
-        jobs.append(p)
-        p.start()
+    try:
+        for i, chunk in enumerate(chunks):
+            if split_arrays:
+                kwargs['split_arrays'] = [s[i] for s in split_arrays]
+            p = Process(target=worker,
+                        args=(func, i, chunk, out_q, err_q, kwargs))
+            jobs.append(p)
+            p.start()
+
+        # Processes finish in arbitrary order. Process IDs double
+        # as index in the resultant array.
+        results = [None] * len(jobs)
+        ndone = 0
+        while ndone < len(jobs):
+            try:
+                idx, result = out_q.get(timeout=0.1)
+            except queue.Empty:
+                alive = any(p.is_alive() for p in jobs)
+                if not err_q.empty():
+                    # kill all on any exception from any one slave
+                    exc = err_q.get()
+                    logger.debug('Error in worker process:\n%s',
+                                 getattr(exc, 'worker_traceback', ''))
+                    raise exc
+                if not alive and out_q.empty():
+                    raise RuntimeError('a worker process died unexpectedly')
+                if monitor is not None:
+                    monitor.check()
+                continue
+            results[idx] = result
+            ndone += 1
+            if monitor is not None:
+                monitor.update(ndone / len(jobs))
+    finally:
+        # the workers are terminated if an error, a cancellation or an
+        # interruption occurred before they finished
+        for proc in jobs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        manager.shutdown()
+
+    return results
 
-    # gather the results
-    for proc in jobs:
-        proc.join()
 
-    if not err_q.empty():
-        # kill all on any exception from any one slave
-        raise err_q.get()
+def _reconstruct(models, pranges, normstacks, variancearrays):
+    """Project normalized stacks on the models and reconstruct the residuals.
 
-    # Processes finish in arbitrary order. Process IDs double
-    # as index in the resultant array.
-    results = [None] * len(jobs)
-    while not out_q.empty():
-        idx, result = out_q.get()
-        results[idx] = result
+    The stacks are concatenated, so the projection of several stacks is done
+    with one matrix product per segment. Returns a list with, for each stack,
+    the coefficients of each segment and the reconstructed residuals.
 
-    return results
+    """
+    indices = [x[0] for x in pranges[1:]]
+    if len(normstacks) == 1:
+        normstack = normstacks[0]
+    else:
+        normstack = np.concatenate(normstacks, axis=1)
+    Xarr = np.array_split(normstack.T, indices, axis=1)
+    Xnew = [model.transform(x) for model, x in zip(models, Xarr)]
+    Xinv = [model.inverse_transform(x) for model, x in zip(models, Xnew)]
+
+    res = []
+    start = 0
+    for var in variancearrays:
+        stop = start + var.shape[1]
+        coefs = [x[start:stop] for x in Xnew]
+        recon = np.concatenate([x[start:stop].T * var[i, :]
+                                for i, x in enumerate(Xinv)])
+        res.append((coefs, recon))
+        start = stop
+    return res
+
+
+def cube_nbytes(cubefits):
+    """Size of the data of a cube, from the headers of its 3D extensions."""
+    if cube_format(cubefits) != 'fits':
+        with open_cube(cubefits) as cube:
+            return cube.nbytes
+    nbytes = 0
+    with fits.open(cubefits) as hdul:
+        for hdu in hdul:
+            hdr = hdu.header
+            if hdr.get('NAXIS') == 3:
+                nbytes = max(nbytes, abs(hdr['BITPIX']) // 8 * hdr['NAXIS1'] *
+                             hdr['NAXIS2'] * hdr['NAXIS3'])
+    return nbytes
+
+
+class MemoryBudget(object):
+
+    """Memory reserved by the tasks in progress.
+
+    :meth:`acquire` waits until the requested size fits in ``maxmem`` with
+    the other tasks, a task being always admitted if nothing is reserved.
+
+    """
+
+    def __init__(self, maxmem=None):
+        self.maxmem = maxmem
+        self.used = 0
+        self.waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._cond:
+            self.waiting += 1
+            try:
+                self._cond.wait_for(
+                    lambda: (self._closed or self.used == 0 or
+                             self.maxmem is None or
+                             self.used + nbytes <= self.maxmem))
+            finally:
+                self.waiting -= 1
+            if self._closed:
+                raise RuntimeError('the memory budget is closed')
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    def close(self):
+        """Wake up and make fail the tasks waiting for memory."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class _BasisCache(object):
+
+    """LRU cache of the SVD bases, computed once even if several jobs ask for
+    the same basis concurrently."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, key, compute):
+        """Return ``(basis, cached)``, computing the basis if needed."""
+        with self._lock:
+            future = self._entries.get(key)
+            cached = future is not None
+            if cached:
+                self._entries.move_to_end(key)
+            else:
+                future = self._entries[key] = Future()
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+        if not cached:
+            try:
+                future.set_result(compute())
+            except BaseException as e:
+                future.set_exception(e)
+                with self._lock:
+                    if self._entries.get(key) is future:
+                        del self._entries[key]
+        return future.result(), cached
+
+
+# Full-field bases of the runs with a ROI, see Zap._roi_basis
+_roi_bases = _BasisCache(ROI_BASES)
+
+
+class _Stage(object):
+
+    """Run a function on the items of an iterable in a background thread,
+    with at most ``maxsize`` results waiting to be consumed."""
+
+    DONE = object()
+
+    def __init__(self, func, items, maxsize):
+        self._queue = queue.Queue(maxsize=max(maxsize, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(func, items),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, func, items):
+        try:
+            for item in items:
+                if self._stop.is_set():
+                    return
+                self._put((func(item), None))
+        except Exception as e:
+            self._put((None, e))
+        else:
+            self._put((self.DONE, None))
+
+    def _put(self, value):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, timeout=None):
+        """Return the next result, or ``DONE`` at the end. Raises the
+        exceptions of the function, or `queue.Empty` after ``timeout``."""
+        value, exc = self._queue.get(timeout=timeout)
+        if exc is not None:
+            raise exc
+        return value
+
+    def __iter__(self):
+        while True:
+            value = self.get()
+            if value is self.DONE:
+                return
+            yield value
+
+    def close(self):
+        self._stop.set()
+
+
+def _wavelength_axis(header, nz):
+    """Return the WCS of the wavelength axis, and the wavelengths in Angstrom
+    of the ``nz`` planes."""
+    # Workaround for floating points errors in wcs computation: if cunit is
+    # specified, wcslib will convert in meters instead of angstroms, so we
+    # remove cunit before creating the wcs object
+    header = header.copy()
+    unit = u.Unit(header.pop('CUNIT3'))
+    wcs = WCS(header).sub([3])
+
+    # Create Lambda axis
+    laxis = wcs.all_pix2world(np.arange(nz), 0)[0]
+    if unit != u.angstrom:
+        # Make sure lambda is in angstroms
+        laxis = (laxis * unit).to(u.angstrom).value
+    return wcs, laxis
+
+
+def _notch_limits(ins_mode, wcs, laxis):
+    """Return the first and last planes of the notch filter region for the
+    AO modes, None for the other modes."""
+    if ins_mode not in NOTCH_FILTER_RANGES:
+        return None
+    limits = NOTCH_FILTER_RANGES[ins_mode]
+    logger.info('Cleaning laser region for AO, mode=%s, limits=%s',
+                ins_mode, limits)
+    if wcs is not None:
+        return wcs.all_world2pix(limits, 0)[0].astype(int)
+    return np.interp(limits, laxis, np.arange(len(laxis))).astype(int)
+
+
+def _segment_ranges(laxis, skyseg):
+    """Return the limits of the segments in Angstroms and in pixels, for the
+    segment limits ``skyseg`` (see `SKYSEG`)."""
+    wlaxis = np.arange(len(laxis))
+
+    # identify the spectral range of the dataset
+    laxmin = min(laxis)
+    laxmax = max(laxis)
+
+    # List of segmentation limits in the optical
+    skyseg = np.array(skyseg)
+    skyseg = skyseg[(skyseg > laxmin) & (skyseg < laxmax)]
+
+    # segment limit in angstroms
+    lranges = (np.vstack([np.append(laxmin - 10, skyseg),
+                          np.append(skyseg, laxmax + 10)])).T
+
+    # segment limit in pixels
+    pranges = []
+    for i in range(len(lranges)):
+        paxis = wlaxis[(laxis > lranges[i, 0]) & (laxis <= lranges[i, 1])]
+        pranges.append((np.min(paxis), np.max(paxis) + 1))
+    return lranges, np.array(pranges)
+
+
+def _same_value(a, b):
+    """Compare two parameter values, which can be arrays."""
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(a, b)
+    return a == b
 
 
 def _compute_deriv(arr, nsigma=5):
@@ -943,7 +2607,112 @@ def _compute_deriv(arr, nsigma=5):
     return deriv, mn1, std1
 
 
-def _continuumfilter(stack, cftype, cfwidth=300, notch_limits=None):
+def _optimal_ncomp(var):
+    """Return the number of components from an explained variance curve."""
+    deriv, mn1, std1 = _compute_deriv(var)
+    cross = np.append([False], deriv >= (mn1 - std1))
+    return np.where(cross)[0][0]
+
+
+def _initial_basis(initSVD, pranges):
+    """Return the initial components of each segment and their number, from
+    a ``Zap`` object or a sky model file."""
+    if isinstance(initSVD, str):
+        try:
+            with SkyModel(initSVD) as skymodel:
+                basis = [np.array(skymodel._segment(i)[0], dtype=float)
+                         for i in range(len(skymodel.pranges))]
+        except KeyError:
+            raise ValueError('{} is not a sky model file'.format(initSVD))
+        nevals = [b.shape[0] for b in basis]
+    elif isinstance(initSVD, Zap):
+        basis = getattr(initSVD, 'components', None)
+        if basis is None:
+            basis = [m.components_ for m in initSVD.models]
+        nevals = getattr(initSVD, 'nevals', None)
+        if nevals is None:
+            nevals = [_optimal_ncomp(m.explained_variance_)
+                      for m in initSVD.models]
+        nevals = np.asarray(nevals)
+        if nevals.ndim == 2:
+            nevals = nevals[:, 1]
+        basis = [b[:n] for b, n in zip(basis, nevals)]
+    else:
+        raise TypeError('initSVD must be a Zap object or the path of a sky '
+                        'model file')
+
+    if len(basis) != len(pranges) or any(
+            b.shape[1] != pmax - pmin for b, (pmin, pmax) in
+            zip(basis, pranges)):
+        raise ValueError('the segments of initSVD do not match the cube')
+    return basis, [int(n) for n in nevals]
+
+
+def _estimate_nevals(x, nblock=32, nsigma=5, blocksize=4096):
+    """Find the number of components with the criterion used in
+    :meth:`Zap.optimize`, computing only the needed eigenvalues.
+
+    The covariance matrix of ``x`` (nsamples, nfeatures) is reduced once to a
+    tridiagonal form. Then its eigenvalues are computed by bisection, first for
+    the band used for the statistics of the derivative (see
+    :func:`_compute_deriv`), and then for the leading ones by blocks of
+    growing size (starting with ``nblock``), until the criterion is reached.
+
+    The covariance matrix is accumulated in float64 by blocks of
+    ``blocksize`` samples, as for :class:`~zap.GramPCA`.
+
+    Returns the number of components and the number of computed leading
+    eigenvalues.
+
+    """
+    nsamples, nfeat = x.shape
+    cov = total = None
+    for i in range(0, nsamples, blocksize):
+        cov, total = _accumulate(x[i:i + blocksize], cov, total)
+    mean = total / nsamples
+    cov -= nsamples * np.outer(mean, mean)
+    cov /= nsamples - 1
+
+    sytrd, = get_lapack_funcs(('sytrd',), (cov,))
+    _, diag, offdiag, _, info = sytrd(cov, lwork=64 * nfeat,
+                                      overwrite_a=True)
+    if info != 0:
+        raise ValueError('tridiagonal reduction failed, info={}'.format(info))
+    del cov
+
+    def eigvals(start, stop):
+        # eigenvalues of rank start to stop-1, in decreasing order
+        w = eigh_tridiagonal(diag, offdiag, eigvals_only=True, select='i',
+                             select_range=(nfeat - stop, nfeat - start - 1))
+        return w[::-1]
+
+    # same number of values as the explained variance of the full SVD
+    npix = int(0.25 * min(nsamples, nfeat))
+    ind = int(.15 * (npix - 1))
+    band = np.diff(eigvals(ind, npix))
+    threshold = band.mean() - band.std() * nsigma
+
+    var = np.empty(0)
+    while True:
+        nnew = min(max(nblock, var.size), npix - var.size)
+        var = np.append(var, eigvals(var.size, var.size + nnew))
+        cross = np.nonzero(np.diff(var) >= threshold)[0]
+        if cross.size > 0 or var.size >= npix:
+            break
+
+    return cross[0] + 1, var.size
+
+
+def _continuumfilter(stack, cftype, cfwidth=300, notch_limits=None,
+                     context=None, monitor=None, out=None):
+    """Compute the continuum of the stack.
+
+    ``cfwidth`` can also be a list of widths, in which case the stack is
+    filtered with all the widths in the same pass and a list is returned.
+    The progress is reported to ``monitor`` if given. The continua are
+    written in the arrays of the ``out`` list (one per width) if given.
+
+    """
     if cftype == 'fit':
         x = np.arange(stack.shape[0])
 
@@ -959,37 +2728,183 @@ def _continuumfilter(stack, cftype, cfwidth=300, notch_limits=None):
             w[lmin:lmax + 1] = 0
 
         res = np.polynomial.polynomial.polyfit(x, stack, deg=5, w=w)
-        ret = np.polynomial.polynomial.polyval(x, res, tensor=True)
-        return ret.T
+        ret = np.polynomial.polynomial.polyval(x, res, tensor=True).T
+        if out is not None:
+            for arr in out:
+                arr[:] = ret
+            ret = out[0]
+        if np.isscalar(cfwidth):
+            return ret
+        return [ret] * len(cfwidth) if out is None else out
 
     if cftype == 'median':
         func = _icfmedian
+    elif cftype == 'fastmedian':
+        func = _icffastmedian
     else:
         raise ValueError('unknown cftype option')
 
-    logger.info('Using cfwidth=%d', cfwidth)
+    widths = np.atleast_1d(cfwidth).tolist()
+    logger.info('Using cfwidth=%s', ', '.join('%d' % w for w in widths))
+
+    # the outputs keep the memory layout of the stack
+    c = out or [np.zeros_like(stack) for _ in widths]
+    context = context or ExecutionContext()
+
+    def _fill(rows, chunks):
+        # chunks is a list (one per process) of lists (one per width)
+        start = 0
+        for chunk in chunks:
+            stop = start + chunk[0].shape[1]
+            for arr, tmp in zip(c, chunk):
+                arr[rows, start:stop] = tmp
+            start = stop
 
     if notch_limits is not None:
         # To manage the notch filter which is filled with zeros, we process the
         # stack in two halves, before and after the filter.
-        c = np.zeros_like(stack)
-        ctmp = parallel_map(func, stack[:notch_limits[0]], NCPU, axis=1,
-                            cfwidth=cfwidth)
-        c[:notch_limits[0]] = np.concatenate(ctmp, axis=1)
-        ctmp = parallel_map(func, stack[notch_limits[1]:], NCPU, axis=1,
-                            cfwidth=cfwidth)
-        c[notch_limits[1]:] = np.concatenate(ctmp, axis=1)
+        for arr in c:
+            arr[notch_limits[0]:notch_limits[1]] = 0
+        for k, rows in enumerate((slice(None, notch_limits[0]),
+                                  slice(notch_limits[1], None))):
+            if stack[rows].shape[0] == 0:
+                # with a block of planes, a half can be empty
+                continue
+            part = None if monitor is None else monitor.part(k / 2,
+                                                             (k + 1) / 2)
+            _fill(rows, context.map(func, stack[rows], axis=1,
+                                    cfwidth=widths, monitor=part))
     else:
-        c = parallel_map(func, stack, NCPU, axis=1, cfwidth=cfwidth)
-        c = np.concatenate(c, axis=1)
+        _fill(slice(None), context.map(func, stack, axis=1, cfwidth=widths,
+                                       monitor=monitor))
 
-    return c
+    return c[0] if np.isscalar(cfwidth) else c
 
 
 def _icfmedian(i, stack, cfwidth=None):
     ufilt = 3  # set this to help with extreme over/under corrections
-    return ndi.median_filter(
-        ndi.uniform_filter(stack, (ufilt, 1)), (cfwidth, 1))
+    # use outputs with the same layout as the input (spectra contiguous)
+    stack = ndi.uniform_filter(stack, (ufilt, 1), output=np.empty_like(stack))
+    return [ndi.median_filter(stack, (width, 1), output=np.empty_like(stack))
+            for width in cfwidth]
+
+
+def _icffastmedian(i, stack, cfwidth=None):
+    """Approximation of _icfmedian: the running median is computed only on
+    a coarse grid, with a step of FASTMEDIAN_STEP * cfwidth, and linearly
+    interpolated. The windows, ranks and boundaries are the same as for
+    ndi.median_filter, so the values on the coarse grid are exact. With less
+    planes than the window, the exact median is used. See
+    fastmedian_deviation for the difference with _icfmedian."""
+    ufilt = 3  # set this to help with extreme over/under corrections
+    stack = ndi.uniform_filter(stack, (ufilt, 1), output=np.empty_like(stack))
+    nz = stack.shape[0]
+    if nz == 0:
+        return [stack.copy(order='K') for _ in cfwidth]
+    pos = np.arange(nz)
+
+    res = []
+    for width in cfwidth:
+        step = max(int(width * FASTMEDIAN_STEP), 1)
+        grid = np.arange(0, nz, step)
+        if grid[-1] != nz - 1:
+            grid = np.append(grid, nz - 1)
+        if grid.size < 2 or width > nz:
+            # no interval to interpolate on, or the windows are reflected
+            # several times: use the exact median, which is cheap here
+            res.append(ndi.median_filter(stack, (width, 1),
+                                         output=np.empty_like(stack)))
+            continue
+
+        coarse = np.empty((grid.size, stack.shape[1]), dtype=stack.dtype)
+        for j, p in enumerate(grid):
+            # window of the median filter, with the 'reflect' boundaries
+            idx = np.arange(p - width // 2, p - width // 2 + width)
+            idx %= 2 * nz
+            idx = np.where(idx >= nz, 2 * nz - idx - 1, idx)
+            # same rank as ndi.median_filter, for odd and even widths
+            coarse[j] = np.partition(stack[idx], width // 2,
+                                     axis=0)[width // 2]
+
+        # linear interpolation on the full grid
+        j = np.clip(np.searchsorted(grid, pos, side='right') - 1, 0,
+                    grid.size - 2)
+        w = ((pos - grid[j]) / (grid[j + 1] - grid[j]))[:, np.newaxis]
+        out = np.empty_like(stack)
+        np.multiply(coarse[j], 1 - w, out=out, casting='unsafe')
+        out += coarse[j + 1] * w
+        res.append(out)
+    return res
+
+
+def fastmedian_deviation(stack, cfwidth=300, notch_limits=None,
+                         context=None):
+    """Compare the 'fastmedian' continuum filter to the exact 'median' one
+    on the same stack.
+
+    Parameters
+    ----------
+    stack : ndarray
+        The (nz, nspec) stack of spectra, e.g. the ``stack`` attribute of a
+        :class:`~zap.Zap` object after the extraction.
+    cfwidth : int
+        Window size of the continuum filter.
+    notch_limits : tuple
+        Limits in pixels of the notch filter region of the AO modes.
+    context : `~zap.ExecutionContext`
+        Resources used to compute the continua.
+
+    Returns
+    -------
+    maxdev, rmsdev : float
+        The maximum and the RMS of the absolute difference between the two
+        continua.
+
+    """
+    exact, fast = [_continuumfilter(stack, cftype, cfwidth=cfwidth,
+                                    notch_limits=notch_limits,
+                                    context=context)
+                   for cftype in ('median', 'fastmedian')]
+    return _deviation(fast, exact)
+
+
+def _deviation(a, b):
+    """Return the maximum and the RMS of the absolute difference of two
+    arrays, computed in float64."""
+    diff = np.abs(np.subtract(a, b, dtype=float))
+    return float(diff.max(initial=0)), float(np.sqrt(np.mean(diff**2)))
+
+
+def _extract_stack(cube, y, x, nplanes=64, monitor=None):
+    """Extract the spectra of the (y, x) spaxels into a 2d array.
+
+    The cube is read by blocks of planes, which is efficient for the
+    plane-major FITS layout and avoids loading a full memory-mapped cube, and
+    the stack is created in Fortran order to have contiguous spectra. Values
+    are converted to the native byte order.
+
+    Only this spaxel-major layout is used for the stack. The per-plane steps
+    (zlevel, insertion in the output cube) work on blocks of planes, copied
+    in plane-major buffers (see ``_median_planes`` and ``_isigclip``).
+
+    """
+    nz = cube.shape[0]
+    flat = np.ravel_multi_index((y, x), cube.shape[1:])
+    dtype = cube.dtype.newbyteorder('=')
+    stack = np.empty((nz, flat.size), dtype=dtype, order='F')
+    for k in range(0, nz, nplanes):
+        planes = cube[k:k + nplanes]
+        stack[k:k + nplanes] = planes.reshape(planes.shape[0], -1)[:, flat]
+        if monitor is not None:
+            monitor.update(min(k + nplanes, nz) / nz)
+    return stack
+
+
+def _insert_stack(cube, stack, y, x, nplanes=64):
+    """Insert the stack into the (y, x) spaxels of the cube, by blocks of
+    planes."""
+    for k in range(0, cube.shape[0], nplanes):
+        cube[k:k + nplanes, y, x] = stack[k:k + nplanes]
 
 
 def rolling_window(a, window):  # function for striding to help speed up
@@ -1028,58 +2943,140 @@ def _newheader(zobj, header=None):
     return header
 
 
-def _isigclip(i, istack):
+def _isigclip(i, istack, nplanes=64):
+    # the stack is spaxel-major, so the planes (rows) are copied by blocks in
+    # a plane-major buffer to have contiguous rows
     mn = []
-    for col in istack:
-        clipped, bot, top = sigmaclip(col, low=3, high=3)
-        mn.append(clipped.mean())
+    for k in range(0, istack.shape[0], nplanes):
+        for col in np.ascontiguousarray(istack[k:k + nplanes]):
+            clipped, bot, top = sigmaclip(col, low=3, high=3)
+            mn.append(clipped.mean())
     return np.array(mn)
 
 
-def _imedian(i, istack):
-    return np.median(istack, axis=1)
+def _median_planes(stack, index=None, nthreads=1, nplanes=64, monitor=None):
+    """Compute the median of each plane (row) of the stack, optionally only
+    for the spaxels (columns) given by ``index``.
+
+    This gives the same result as ``np.median(stack[:, index], axis=1)``
+    without copying the stack: the planes are copied by blocks of ``nplanes``
+    in a scratch buffer, which is partitioned in place. The blocks are
+    processed by ``nthreads`` threads, as Numpy releases the GIL for the copy
+    and the partition. The progress is reported to ``monitor`` if given.
+
+    """
+    nz = stack.shape[0]
+    n = stack.shape[1] if index is None else len(index)
+    zl = np.empty(nz, dtype=stack.dtype)
+    if n == 0:
+        zl[:] = np.nan
+        return zl
+
+    # partition on the central values, and on the last one to check for NaNs
+    kth = sorted({(n - 1) // 2, n // 2, n - 1})
+    blocks = np.array([(k, min(k + nplanes, nz))
+                       for k in range(0, nz, nplanes)])
+
+    def run(blocks, report=True):
+        buf = np.empty((min(nplanes, nz), n), dtype=stack.dtype)
+        for start, stop in blocks:
+            if monitor is not None:
+                if report:
+                    monitor.update(start / nz)
+                else:
+                    # the threads only check the cancellation
+                    monitor.check()
+            part = buf[:stop - start]
+            if index is None:
+                part[:] = stack[start:stop]
+            else:
+                np.take(stack[start:stop], index, axis=1, out=part)
+            part.partition(kth, axis=1)
+            if n % 2:
+                zl[start:stop] = part[:, n // 2]
+            else:
+                zl[start:stop] = np.mean(part[:, n // 2 - 1:n // 2 + 1],
+                                         axis=1)
+            zl[start:stop][np.isnan(part[:, -1])] = np.nan
+
+    nthreads = max(1, min(nthreads, len(blocks)))
+    if nthreads == 1:
+        run(blocks)
+    else:
+        # each thread has its own buffer, for a contiguous range of blocks
+        parts = np.array_split(blocks, nthreads)
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            futures = [executor.submit(run, part, report=False)
+                       for part in parts]
+            _wait_futures(futures, monitor=monitor)
+    return zl
 
 
 @timeit
-def _nanclean(cube, rejectratio=0.25, boxsz=1):
+def _neighbors(z, y, x, shape, boxsz=1):
+    """Iterate on the positions of the neighbors of the (z, y, x) voxels, in
+    a box of size 2*boxsz+1, with the mask of those which are inside the
+    (nz, ny, nx) cube (the voxels on the edges of the cube are not used)."""
+    nz, ny, nx = shape
+    for j in range(-boxsz, boxsz + 1, 1):
+        for k in range(-boxsz, boxsz + 1, 1):
+            for l in range(-boxsz, boxsz + 1, 1):
+                iz, iy, ix = z + l, y + k, x + j
+                outsider = ((ix <= 0) | (ix >= nx - 1) |
+                            (iy <= 0) | (iy >= ny - 1) |
+                            (iz <= 0) | (iz >= nz - 1))
+                yield iz, iy, ix, ~outsider
+
+
+def _interpolate_nans(cube, z, y, x, boxsz=1, shape=None, zoffset=0):
+    """Return the mean of the neighbors of the (z, y, x) voxels, NaN if
+    they are all NaN. ``cube`` can also be a block of planes, starting at
+    plane ``zoffset`` of a cube of the given ``shape``."""
+    shape = shape or cube.shape
+    neighbor = np.zeros((z.size, (2 * boxsz + 1)**3))
+
+    # loop over samplecubes
+    for i, (iz, iy, ix, ins) in enumerate(_neighbors(z, y, x, shape, boxsz)):
+        neighbor[ins, i] = cube[iz[ins] - zoffset, iy[ins], ix[ins]]
+        neighbor[~ins, i] = np.nan
+
+    return np.nanmean(neighbor, axis=1)
+
+
+def _nanclean(cube, rejectratio=0.25, boxsz=1, nanindex=None, spaxels=None):
     """
-    Detects NaN values in cube and removes them by replacing them with an
+    Detects NaN values in cube and computes their replacement with an
     interpolation of the nearest neighbors in the data cube. The positions in
-    the cube are retained in nancube for later remasking.
+    the cube are retained in a `NanIndex` for later remasking.
+
+    Returns the (z, y, x) positions and the interpolated values, the NaN
+    index of the input cube, and the map of the number of NaN values per
+    spaxel remaining after the cleaning. If ``spaxels`` is given, only the
+    spaxels selected by this (ny, nx) boolean array are cleaned.
 
     """
     logger.info('Cleaning NaN values in the cube')
-    cleancube = cube.copy()
-    badcube = np.logical_not(np.isfinite(cleancube))        # find NaNs
-    badmap = badcube.sum(axis=0)  # map of total nans in a spaxel
+    if nanindex is None:
+        nanindex = NanIndex(cube)      # find NaNs
+    badmap = nanindex.count  # map of total nans in a spaxel
 
     # choose some maximum number of bad pixels in the spaxel and extract
     # positions
-    badmask = badmap > (rejectratio * cleancube.shape[0])
+    badmask = badmap > (rejectratio * cube.shape[0])
     logger.info('Rejected %d spaxels with more than %.1f%% NaN pixels',
                 np.count_nonzero(badmask), rejectratio * 100)
 
-    # make cube mask of bad spaxels
-    badcube &= (~badmask[np.newaxis, :, :])
-    z, y, x = np.where(badcube)
+    # positions of the NaNs in the other spaxels
+    selected = ~badmask
+    if spaxels is not None:
+        selected &= spaxels
+    z, y, x = nanindex.voxels(spaxels=selected)
 
-    neighbor = np.zeros((z.size, (2 * boxsz + 1)**3))
-    icounter = 0
     logger.info("Fixing %d remaining NaN pixels", len(z))
+    values = _interpolate_nans(cube, z, y, x, boxsz=boxsz)
 
-    # loop over samplecubes
-    nz, ny, nx = cleancube.shape
-    for j in range(-boxsz, boxsz + 1, 1):
-        for k in range(-boxsz, boxsz + 1, 1):
-            for l in range(-boxsz, boxsz + 1, 1):
-                iz, iy, ix = z + l, y + k, x + j
-                outsider = ((ix <= 0) | (ix >= nx - 1) |
-                            (iy <= 0) | (iy >= ny - 1) |
-                            (iz <= 0) | (iz >= nz - 1))
-                ins = ~outsider
-                neighbor[ins, icounter] = cleancube[iz[ins], iy[ins], ix[ins]]
-                neighbor[outsider, icounter] = np.nan
-                icounter = icounter + 1
-
-    cleancube[z, y, x] = np.nanmean(neighbor, axis=1)
-    return cleancube, badcube
+    # update the map of NaNs with the values that could not be interpolated
+    badmap = np.where(badmask, badmap, 0)
+    still = np.isnan(values)
+    np.add.at(badmap, (y[still], x[still]), 1)
+    return (z, y, x, values), nanindex, badmap